@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+"""Compare two result files of benchmarks/run.py."""
+
+import argparse
+import json
+
+
+def flatten(results, prefix=''):
+    values = {}
+    for name, value in results.items():
+        if name == 'args':
+            continue
+        if isinstance(value, dict):
+            values.update(flatten(value, prefix + name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + name] = value
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('old', help='Results of the reference commit')
+    parser.add_argument('new', help='Results to compare')
+    args = parser.parse_args()
+
+    with open(args.old) as old_file, open(args.new) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+
+    print('%-30s %15s %15s %9s' % ('', (old.get('commit') or 'old')[:12], (new.get('commit') or 'new')[:12], ''))
+    old_values, new_values = flatten(old), flatten(new)
+    for name in sorted(set(old_values) | set(new_values)):
+        if name in ('time', 'cpus'):
+            continue
+        old_value, new_value = old_values.get(name), new_values.get(name)
+        change = ''
+        if old_value and new_value is not None:
+            change = '%+.1f%%' % ((new_value - old_value) / old_value * 100)
+        print('%-30s %15s %15s %9s' % (name, old_value, new_value, change))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+
+"""Benchmark suite of geotaxi.
+
+Microbenchmarks measure the CPU cost of the message handling stages. The
+end-to-end benchmark starts a geotaxi server, feeds it from several sender
+processes with many taxis and operators, and records the throughput, the
+drop rates and the latency between sending a message and finding it in
+redis.
+
+Results are written as JSON, to be compared across commits with
+benchmarks/compare.py. The end-to-end benchmark writes in the redis server
+given with --redis-host and --redis-port, which must be a test instance.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+
+import orjson
+import redis
+from redis.connection import Connection
+
+from geotaxi import jsonschema
+from geotaxi.users import UsersTable
+from geotaxi.wire import encode_binary
+from geotaxi.worker import Worker
+
+FROM_ADDR = ('127.0.0.1', 4242)
+# Number of positions of the pipelines encoded by the encode_* benchmarks
+ENCODE_BATCH_SIZE = 100
+
+
+def make_message(taxi, operator, api_key, lat='48.856613', lon='2.352222'):
+    data = {
+        'timestamp': str(int(time.time())),
+        'operator': operator,
+        'version': '2',
+        'lat': lat,
+        'lon': lon,
+        'device': 'mobile',
+        'taxi': taxi,
+        'status': 'free',
+    }
+    data['hash'] = hashlib.sha1(''.join([
+        data['timestamp'],
+        data['operator'],
+        data['taxi'],
+        data['lat'],
+        data['lon'],
+        data['device'],
+        data['status'],
+        data['version'],
+        api_key
+    ]).encode('utf8')).hexdigest()
+    return data
+
+
+def measure(func, number, repeat=5):
+    """Return the best time per call of func in nanoseconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number * 1e9
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best, 1)
+
+
+def micro_benchmarks(number):
+    # Commands are only queued in pipelines, redis is never reached
+    worker = Worker(redis.Redis())
+    worker.auth_enabled = True
+    worker.users = UsersTable({'operator': 'api_key'})
+    resp_worker = Worker(redis.Redis(), resp_writer=True)
+
+    message = orjson.dumps(make_message('taxi', 'operator', 'api_key'))
+    binary_message = encode_binary(make_message('taxi', 'operator', 'api_key'))
+    data = worker.parse_message(message, FROM_ADDR)
+    assert worker.check_hash(worker.parse_message(binary_message, FROM_ADDR), FROM_ADDR)
+    assert worker.check_hash(data, FROM_ADDR)
+    converted = dict(data)
+    worker.validate_convert_coordinates(converted)
+
+    pipe = worker.redis.pipeline()
+
+    def update_redis():
+        worker.update_redis(pipe, converted, FROM_ADDR)
+        if len(pipe) > 10000:
+            pipe.reset()
+
+    def handle_message():
+        worker.handle_message(pipe, message, FROM_ADDR)
+        if len(pipe) > 10000:
+            pipe.reset()
+
+    def update_redis_resp():
+        resp_worker.update_redis(None, converted, FROM_ADDR)
+        if len(resp_worker.resp_writer) > 10000:
+            resp_worker.resp_writer.buffer.clear()
+            resp_worker.resp_writer.commands = 0
+
+    # The commands of a batch of positions, encoded in the redis protocol like
+    # they are sent, with a redis-py pipeline or with the RESP writer
+    connection = Connection()
+
+    def encode_pipeline():
+        encode_pipe = worker.redis.pipeline()
+        for _ in range(ENCODE_BATCH_SIZE):
+            worker.update_redis(encode_pipe, converted, FROM_ADDR)
+        connection.pack_commands([args for args, _ in encode_pipe.command_stack])
+
+    def encode_resp():
+        writer = resp_worker.resp_writer
+        for _ in range(ENCODE_BATCH_SIZE):
+            resp_worker.update_redis(None, converted, FROM_ADDR)
+        bytes(writer.buffer)
+        writer.buffer.clear()
+        writer.commands = 0
+
+    batches = max(1, number // ENCODE_BATCH_SIZE)
+
+    return {
+        'parse_message_ns': measure(lambda: worker.parse_message(message, FROM_ADDR), number),
+        'parse_message_binary_ns': measure(lambda: worker.parse_message(binary_message, FROM_ADDR), number),
+        'validate_ns': measure(lambda: jsonschema.validate(data), number),
+        'convert_coordinates_ns': measure(lambda: worker.validate_convert_coordinates(dict(data)), number),
+        'check_hash_ns': measure(lambda: worker.check_hash(data, FROM_ADDR), number),
+        'update_redis_ns': measure(update_redis, number),
+        'update_redis_resp_ns': measure(update_redis_resp, number),
+        'handle_message_ns': measure(handle_message, number),
+        # Per position
+        'encode_pipeline_ns': round(measure(encode_pipeline, batches) / ENCODE_BATCH_SIZE, 1),
+        'encode_resp_ns': round(measure(encode_resp, batches) / ENCODE_BATCH_SIZE, 1),
+    }
+
+
+def udp_counters():
+    """Return the UDP counters of the kernel, from /proc/net/snmp, like
+    scripts/netstat.py."""
+    try:
+        with open('/proc/net/snmp') as snmp:
+            lines = [line.split() for line in snmp if line.startswith('Udp:')]
+    except OSError:
+        return {}
+    names, values = lines[0][1:], lines[1][1:]
+    return {name: int(value) for name, value in zip(names, values)}
+
+
+def read_metrics(port):
+    """Return the counters of the metrics endpoint of the server."""
+    with urllib.request.urlopen('http://127.0.0.1:%s/metrics' % port, timeout=5) as resp:
+        lines = resp.read().decode('utf8').splitlines()
+    metrics = {}
+    for line in lines:
+        if line.startswith('#') or '{' in line:
+            continue
+        name, value = line.rsplit(' ', 1)
+        metrics[name] = float(value)
+    return metrics
+
+
+def start_server(args):
+    cmd = [
+        sys.executable, '-c', 'from geotaxi.geotaxi import main; main()',
+        '-h', '127.0.0.1', '-p', str(args.port),
+        '--redis-host', args.redis_host, '--redis-port', str(args.redis_port),
+        '--metrics-port', str(args.metrics_port), '--metrics-host', '127.0.0.1',
+        '--disable-fluent',
+    ] + args.server_args.split()
+    server = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            read_metrics(args.metrics_port)
+            return server
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError('Unable to start geotaxi: %s' % ' '.join(cmd))
+            time.sleep(0.1)
+
+
+def sender(host, port, messages, rate, duration, sent):
+    """Send messages in a loop for duration seconds, at rate messages per
+    second, or as fast as possible if rate is 0."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    start = time.monotonic()
+    count = 0
+    while time.monotonic() < start + duration:
+        for message in messages[count % len(messages):][:100]:
+            sock.sendto(message, (host, port))
+            count += 1
+        if rate:
+            delay = start + count / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    with sent.get_lock():
+        sent.value += count
+
+
+def probe_latency(args, client, stop):
+    """Send a message with a new taxi id every 1 / --probe-rate seconds, and
+    return the delays in seconds before the taxi is found in redis."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    run_id = uuid.uuid4().hex[:8]
+    outstanding = {}
+    latencies = []
+    next_probe = time.monotonic()
+    idx = 0
+
+    # Wait for the last probes at most 5 seconds after the end
+    while not stop.is_set() or (outstanding and time.monotonic() < stop.stopped_at + 5):
+        now = time.monotonic()
+        if not stop.is_set() and now >= next_probe:
+            taxi = 'probe-%s-%s' % (run_id, idx)
+            idx += 1
+            sock.sendto(orjson.dumps(make_message(taxi, 'probe', 'api_key')), (args.host, args.port))
+            outstanding[taxi] = now
+            next_probe = now + 1 / args.probe_rate
+
+        if outstanding:
+            pipe = client.pipeline()
+            for taxi in outstanding:
+                pipe.zscore('timestamps_id', taxi)
+            found_at = time.monotonic()
+            for (taxi, sent_at), score in zip(list(outstanding.items()), pipe.execute()):
+                if score is not None:
+                    latencies.append(found_at - sent_at)
+                    del outstanding[taxi]
+        time.sleep(0.001)
+
+    pipe = client.pipeline()
+    for taxi in range(idx):
+        taxi = 'probe-%s-%s' % (run_id, taxi)
+        pipe.zrem('timestamps_id', taxi).zrem('timestamps', taxi + ':probe').zrem('geoindex', taxi)
+        pipe.zrem('geoindex_2', taxi + ':probe').delete('taxi:' + taxi)
+    pipe.execute()
+    return latencies, len(outstanding)
+
+
+def percentile(values, ratio):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def e2e_benchmark(args):
+    client = redis.Redis(host=args.redis_host, port=args.redis_port)
+    client.ping()
+
+    encode = encode_binary if args.format == 'binary' else orjson.dumps
+    messages = [
+        [
+            encode(make_message(
+                'taxi-%s-%s' % (idx, taxi), 'operator-%s' % (taxi % args.operators), 'api_key',
+                lat='%.6f' % (48.8 + taxi * 1e-5)
+            ))
+            for taxi in range(args.taxis // args.senders)
+        ]
+        for idx in range(args.senders)
+    ]
+
+    server = start_server(args)
+    try:
+        metrics_before = read_metrics(args.metrics_port)
+        udp_before = udp_counters()
+
+        sent = multiprocessing.Value('q', 0)
+        procs = [
+            multiprocessing.Process(target=sender, args=(
+                args.host, args.port, messages[idx], args.rate / args.senders, args.duration, sent
+            ))
+            for idx in range(args.senders)
+        ]
+        stop = threading.Event()
+        probes = {}
+        prober = threading.Thread(target=lambda: probes.update(result=probe_latency(args, client, stop)))
+        prober.start()
+
+        start = time.monotonic()
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        elapsed = time.monotonic() - start
+
+        stop.stopped_at = time.monotonic()
+        stop.set()
+        prober.join()
+        # Let workers empty the queue
+        time.sleep(args.drain)
+
+        metrics_after = read_metrics(args.metrics_port)
+        udp_after = udp_counters()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    def delta(name):
+        return int(metrics_after.get(name, 0) - metrics_before.get(name, 0))
+
+    latencies, lost_probes = probes['result']
+    sent = sent.value
+    received = delta('geotaxi_received_total')
+    handled = delta('geotaxi_handled_total')
+    queue_dropped = delta('geotaxi_queue_dropped_total')
+    kernel_dropped = udp_after.get('RcvbufErrors', 0) - udp_before.get('RcvbufErrors', 0)
+
+    return {
+        'duration': round(elapsed, 3),
+        'sent': sent,
+        'sent_per_sec': round(sent / elapsed),
+        'received': received,
+        'handled': handled,
+        'handled_per_sec': round(handled / elapsed),
+        'queue_dropped': queue_dropped,
+        'queue_drop_rate': round(queue_dropped / sent, 6) if sent else None,
+        'kernel_dropped': kernel_dropped,
+        'kernel_drop_rate': round(kernel_dropped / sent, 6) if sent else None,
+        'redis_errors': delta('geotaxi_redis_errors_total'),
+        'latency_p50_ms': latencies and round(percentile(latencies, 0.5) * 1000, 3),
+        'latency_p99_ms': latencies and round(percentile(latencies, 0.99) * 1000, 3),
+        'probes': len(latencies),
+        'lost_probes': lost_probes,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--output', type=str, default=None,
+                        help='Write results to this file instead of stdout')
+    parser.add_argument('--skip-micro', action='store_true',
+                        help='Do not run microbenchmarks')
+    parser.add_argument('--skip-e2e', action='store_true',
+                        help='Do not run the end-to-end benchmark')
+    parser.add_argument('--number', type=int, default=20000,
+                        help='Number of calls of each microbenchmark')
+
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Address of the geotaxi server started by the benchmark')
+    parser.add_argument('--port', type=int, default=18080,
+                        help='Port of the geotaxi server started by the benchmark')
+    parser.add_argument('--metrics-port', type=int, default=19100,
+                        help='Metrics port of the geotaxi server started by the benchmark')
+    parser.add_argument('--server-args', type=str, default='',
+                        help='Additional arguments of the geotaxi server, for example "-w 4 --batch-size 100"')
+    parser.add_argument('--redis-host', type=str, default='127.0.0.1',
+                        help='Redis host')
+    parser.add_argument('--redis-port', type=int, default=6379,
+                        help='Redis port')
+
+    parser.add_argument('--senders', type=int, default=4,
+                        help='Number of sender processes')
+    parser.add_argument('--taxis', type=int, default=10000,
+                        help='Number of distinct taxis')
+    parser.add_argument('--operators', type=int, default=20,
+                        help='Number of distinct operators')
+    parser.add_argument('--rate', type=float, default=20000,
+                        help='Total number of messages sent per second. Set to 0 to send as fast as possible')
+    parser.add_argument('--format', choices=('json', 'binary'), default='json',
+                        help='Encoding of the messages sent')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Duration of the end-to-end benchmark in seconds')
+    parser.add_argument('--probe-rate', type=float, default=50,
+                        help='Number of messages per second whose latency is measured')
+    parser.add_argument('--drain', type=float, default=1,
+                        help='Time in seconds to wait for the server to handle queued messages')
+    args = parser.parse_args()
+
+    results = {
+        'commit': git_commit(),
+        'time': int(time.time()),
+        'python': platform.python_version(),
+        'cpus': multiprocessing.cpu_count(),
+        'args': vars(args),
+    }
+    if not args.skip_micro:
+        results['micro'] = micro_benchmarks(args.number)
+    if not args.skip_e2e:
+        results['e2e'] = e2e_benchmark(args)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,14 +12,33 @@ DOCKER_IMAGE=openmaraude/geotaxi-python:latest
 CONTAINER_NAME=geotaxi-dev
 FAILOVER_IP=x.x.x.x  # Must be configured in the network interfaces
 
-docker rm -f "${CONTAINER_NAME}"
+# Hot restart: the new container binds the port next to the old one, with
+# SO_REUSEPORT (SHARE_PORT). The old container is then stopped: it stops
+# receiving, stores the messages already received and exits within
+# SHUTDOWN_TIMEOUT seconds, so no position is lost during the deployment.
+# Both containers share the network of the host to bind the same address.
+#
+# The image runs geotaxi as the unprivileged user geotaxi, which can't bind
+# port 80. geotaxi binds LISTEN_PORT instead, and the datagrams sent to port
+# 80 of FAILOVER_IP are sent to FAILOVER_IP:LISTEN_PORT by a DNAT rule of the
+# host, added once. REDIRECT can't be used: it rewrites the destination to
+# the primary address of the interface, not to the failover IP bound by
+# geotaxi.
+LISTEN_PORT=8080
+iptables -t nat -C PREROUTING -d "${FAILOVER_IP}" -p udp --dport 80 -j DNAT --to-destination "${FAILOVER_IP}:${LISTEN_PORT}" 2>/dev/null \
+	|| iptables -t nat -A PREROUTING -d "${FAILOVER_IP}" -p udp --dport 80 -j DNAT --to-destination "${FAILOVER_IP}:${LISTEN_PORT}"
+
+OLD_CONTAINERS=$(docker ps -a -q --filter "name=^${CONTAINER_NAME}$" --filter "name=^${CONTAINER_NAME}-[0-9]{14}$")
 
 docker run -ti \
 	-d \
 	--pull=always \
 	--restart=unless-stopped \
-	-e HOST=0.0.0.0 \
-	-e PORT=8080 \
+	--network host \
+	-e HOST="${FAILOVER_IP}" \
+	-e PORT="${LISTEN_PORT}" \
+	-e SHARE_PORT=1 \
+	-e SHUTDOWN_TIMEOUT=5 \
 	-e REDIS_HOST=xxx \
 	-e REDIS_PORT=xxx \
 	-e REDIS_PASSWORD=xxx \
@@ -28,6 +47,12 @@ docker run -ti \
 	-e SENTRY_DSN=xxxxxxxxxxxx \
 	-e WORKERS=4 \
 	-e DISABLE_FLUENT=true \
-	-p "${FAILOVER_IP}:80:8080/udp" \
-	--name "$CONTAINER_NAME" \
+	--name "${CONTAINER_NAME}-$(date +%Y%m%d%H%M%S)" \
 	"$DOCKER_IMAGE"
+
+# Let the new container start before stopping the old ones
+sleep 5
+if [ -n "${OLD_CONTAINERS}" ]; then
+	docker stop -t 10 ${OLD_CONTAINERS}
+	docker rm ${OLD_CONTAINERS}
+fi
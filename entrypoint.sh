@@ -6,14 +6,52 @@ cmdline=""
 for value_env in \
     HOST \
     PORT \
+    MODE \
+    MAX_PIPELINES \
     WORKERS \
+    MIN_WORKERS \
+    MAX_WORKERS \
+    SUPERVISE_INTERVAL \
+    SHUTDOWN_TIMEOUT \
+    TRANSPORT \
+    QUEUE_SIZE \
+    RECV_BATCH_SIZE \
+    BATCH_SIZE \
+    BATCH_LATENCY \
+    COALESCE_WINDOW \
+    THROTTLE_CACHE_SIZE \
+    MIN_INTERVAL \
+    MIN_DISTANCE \
+    MOVEMENT_CACHE_SIZE \
+    SHED_HIGH_WATER \
+    SHED_MAX_AGE \
+    SHED_CACHE_SIZE \
     REDIS_HOST \
     REDIS_PORT \
     REDIS_PASSWORD \
+    REDIS_SHARDS \
+    GEO_CELL_PRECISION \
+    REDIS_SCRIPT \
+    JANITOR_TTL \
+    JANITOR_INTERVAL \
+    JANITOR_CHUNK_SIZE \
     FLUENT_HOST \
     FLUENT_PORT \
+    FLUENT_BUFFER_SIZE \
+    FLUENT_SPILL_PATH \
+    FLUENT_SPILL_MAX_SIZE \
     API_URL \
+    USERS_REFRESH_INTERVAL \
+    BADHASH_FLUSH_INTERVAL \
+    BADHASH_FLUSH_THRESHOLD \
+    REJECTIONS_LOG_INTERVAL \
     SENTRY_DSN \
+    CAPTURE_PATH \
+    CAPTURE_MAX_SIZE \
+    CAPTURE_BACKUPS \
+    METRICS_PORT \
+    METRICS_HOST \
+    STAGE_TIMING_SAMPLE \
     WORKERS;
 do
     value=$(eval "echo \${$value_env}")
@@ -27,6 +65,10 @@ done
 for bool_env in \
     DISABLE_FLUENT \
     VERBOSE \
+    REUSEPORT \
+    SHARE_PORT \
+    SUPPRESS_HSET \
+    RESP_WRITER \
     AUTH_ENABLED;
 do
     value=$(eval "echo \${$bool_env}")
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import signal
+import sys
+import time
+
+from redis.exceptions import NoScriptError, RedisError
+
+from geotaxi.worker import UPDATE_SCRIPT
+
+logger = logging.getLogger("geotaxi")
+
+
+class GeotaxiProtocol(asyncio.DatagramProtocol):
+    """Receive datagrams and store positions with redis.asyncio pipelines.
+
+    geotaxi is a Worker created with a redis.asyncio client. Messages are
+    parsed and checked by the Worker methods, so both engines behave the
+    same. Up to max_pipelines pipelines are executed concurrently;
+    meanwhile, received messages are kept in memory, up to max_pending.
+    """
+
+    def __init__(self, geotaxi, max_pipelines=16, max_pending=32768):
+        self.geotaxi = geotaxi
+        self.max_pipelines = max_pipelines
+        self.max_pending = max_pending
+
+        self.pending = []
+        self.inflight = set()
+        self.flush_scheduled = False
+        self.pending_timer = None
+        geotaxi.load = lambda: len(self.pending) / self.max_pending
+
+    def datagram_received(self, data, addr):
+        self.geotaxi.counters.incr('received')
+        if self.geotaxi.capture:
+            self.geotaxi.capture.write([(data, addr)])
+        if len(self.pending) >= self.max_pending:
+            self.geotaxi.counters.incr('queue_dropped')
+            logger.warning('Queue is full - drop message...')
+            return
+        self.pending.append((data, addr))
+        self.schedule_flush()
+
+    def error_received(self, exc):
+        logger.error('Error while receiving datagram: %s', exc)
+
+    def schedule_flush(self):
+        # Datagrams received during the same loop iteration are flushed
+        # together.
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+
+        while self.pending and len(self.inflight) < self.max_pipelines:
+            batch = self.pending[:self.geotaxi.batch_size]
+            del self.pending[:len(batch)]
+
+            pipe = self.geotaxi.redis.pipeline()
+            self.geotaxi.queue_batch(pipe, batch)
+            self.geotaxi.flush_pending(pipe)
+            self.execute_pipeline(pipe)
+
+        self.schedule_pending_flush()
+
+    def schedule_pending_flush(self):
+        """Make sure data kept in memory by the worker, like coalesced
+        positions, is stored when due, even if no more datagram is received."""
+        timeout = self.geotaxi.pending_timeout()
+        if timeout is not None and self.pending_timer is None:
+            self.pending_timer = asyncio.get_running_loop().call_later(timeout, self.flush_pending)
+
+    def flush_pending(self):
+        self.pending_timer = None
+
+        pipe = self.geotaxi.redis.pipeline()
+        self.geotaxi.flush_pending(pipe)
+        self.execute_pipeline(pipe)
+
+        self.schedule_pending_flush()
+
+    def execute_pipeline(self, pipe):
+        if not len(pipe):
+            return
+
+        task = asyncio.create_task(self.execute(pipe))
+        self.inflight.add(task)
+        task.add_done_callback(self.pipeline_done)
+
+    async def execute(self, pipe):
+        """Like Worker.execute_pipeline, for redis.asyncio pipelines."""
+        commands = list(pipe.command_stack)
+        start = time.perf_counter()
+        try:
+            results = await pipe.execute(raise_on_error=False)
+
+            retries = self.geotaxi.failed_scripts(commands, results)
+            if retries:
+                logger.warning('Script not loaded in redis, load it and run %s commands again', len(retries))
+                await self.geotaxi.redis.script_load(UPDATE_SCRIPT)
+                pipe = self.geotaxi.redis.pipeline()
+                for args in retries:
+                    pipe.execute_command(*args)
+                results = [result for result in results if not isinstance(result, NoScriptError)]
+                results.extend(await pipe.execute(raise_on_error=False))
+        except Exception as exc:
+            self.geotaxi.counters.incr('redis_errors', len(commands))
+            logger.error('Exception %s, continue execution', str(exc))
+            return
+
+        self.geotaxi.counters.observe('redis', time.perf_counter() - start)
+        self.geotaxi.log_redis_errors(results)
+
+    def pipeline_done(self, task):
+        self.inflight.discard(task)
+        if self.pending:
+            self.schedule_flush()
+
+    async def drain(self):
+        """Handle the messages received, store the data kept in memory, and
+        wait for the pipelines in flight."""
+        while self.pending or self.inflight:
+            self.flush()
+            if self.inflight:
+                await asyncio.wait(set(self.inflight))
+
+        if self.pending_timer:
+            self.pending_timer.cancel()
+            self.pending_timer = None
+        pipe = self.geotaxi.redis.pipeline()
+        self.geotaxi.flush_pending(pipe, force=True)
+        self.execute_pipeline(pipe)
+        if self.inflight:
+            await asyncio.wait(set(self.inflight))
+
+    def print_status(self):
+        sys.stdout.write('Queue size: %s\n' % len(self.pending))
+        sys.stdout.write('Pipelines in flight: %s\n' % len(self.inflight))
+        for name, value in self.geotaxi.stats().items():
+            sys.stdout.write('%s: %s\n' % (name, value))
+        sys.stdout.flush()
+
+
+async def serve(host, port, geotaxi, max_pipelines=16, metrics=None, shutdown_timeout=0, share_port=False):
+    """Receive datagrams until SIGTERM or SIGINT. Then stop receiving, and
+    wait at most shutdown_timeout seconds for the messages received to be
+    stored. With share_port, the socket is bound with SO_REUSEPORT."""
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: GeotaxiProtocol(geotaxi, max_pipelines=max_pipelines),
+        local_addr=(host, port),
+        reuse_port=share_port or None
+    )
+    logger.info('Server started on %s:%s!', host, port)
+
+    if geotaxi.redis_script:
+        try:
+            await geotaxi.redis.script_load(UPDATE_SCRIPT)
+        except RedisError as exc:
+            logger.warning('Unable to load script in redis: %s', exc)
+
+    # The users table is refreshed, stale taxis are removed and fluent
+    # records are sent from threads, to never block the loop.
+    geotaxi.start()
+    geotaxi.start_background_tasks()
+
+    if metrics:
+        metrics.gauges['queue_size'] = lambda: len(protocol.pending)
+        metrics.gauges['pipelines_inflight'] = lambda: len(protocol.inflight)
+        metrics.start()
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    loop.add_signal_handler(signal.SIGUSR1, protocol.print_status)
+
+    try:
+        await stop.wait()
+        transport.close()
+        if shutdown_timeout:
+            logger.info('Stop receiving, wait for %s messages to be stored', len(protocol.pending))
+            try:
+                await asyncio.wait_for(protocol.drain(), shutdown_timeout)
+            except asyncio.TimeoutError:
+                logger.warning('Messages not stored after %s seconds, stop anyway', shutdown_timeout)
+        if geotaxi.fluent:
+            geotaxi.fluent.close(shutdown_timeout)
+    finally:
+        transport.close()
+        if geotaxi.capture:
+            geotaxi.capture.close()
+        await geotaxi.redis.aclose()
+
+
+def run_asyncio_server(host, port, geotaxi, max_pipelines=16, metrics=None, shutdown_timeout=0, share_port=False):
+    asyncio.run(serve(
+        host, port, geotaxi, max_pipelines=max_pipelines, metrics=metrics,
+        shutdown_timeout=shutdown_timeout, share_port=share_port
+    ))
@@ -0,0 +1,32 @@
+import collections
+
+
+class LRUCache:
+    """Dictionary holding at most maxsize items. When full, the least
+    recently used item is evicted."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        try:
+            self.items.move_to_end(key)
+        except KeyError:
+            return default
+        return self.items[key]
+
+    def __setitem__(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
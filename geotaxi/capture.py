@@ -0,0 +1,108 @@
+import os
+import socket
+import struct
+import time
+
+# Written at the beginning of each capture file
+MAGIC = b'GEOTAXI-CAPTURE-1\n'
+# Each datagram is preceded by its arrival time, the source IPv4 address and
+# port, and its length.
+RECORD = struct.Struct('=d4sHH')
+
+
+class CaptureWriter:
+    """Append received datagrams to a binary log, to replay them with
+    scripts/replay-traffic.py.
+
+    The file name is suffixed with the PID of the process writing datagrams.
+    When the file reaches max_size bytes, it is renamed with the suffix .1,
+    previous files are shifted, and only backups files are kept. Writes are
+    buffered, and flushed at most flush_interval seconds after being written:
+    by write(), or by flush() which must be called when no datagram is
+    received, at the latest after timeout() seconds.
+    """
+
+    def __init__(self, path, max_size=100 * 1024 * 1024, backups=10, flush_interval=1):
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.file = None
+        self.size = 0
+        self.flushed_at = 0
+        self.buffered = False
+
+    def open(self):
+        self.path = '%s.%s' % (self.path, os.getpid())
+        self.file = open(self.path, 'ab')
+        self.size = self.file.tell()
+        if not self.size:
+            self.file.write(MAGIC)
+            self.size = len(MAGIC)
+
+    def rotate(self):
+        self.file.close()
+        for idx in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%s' % (self.path, idx)):
+                os.replace('%s.%s' % (self.path, idx), '%s.%s' % (self.path, idx + 1))
+        if self.backups:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.unlink(self.path)
+        self.file = open(self.path, 'ab')
+        self.file.write(MAGIC)
+        self.size = len(MAGIC)
+
+    def write(self, datagrams):
+        """Write a list of (datagram, (ip, port)) received now."""
+        if self.file is None:
+            self.open()
+
+        now = time.time()
+        for data, (ip, port) in datagrams:
+            record = RECORD.pack(now, socket.inet_aton(ip), port, len(data)) + data
+            if self.size + len(record) > self.max_size and self.size > len(MAGIC):
+                self.rotate()
+            self.file.write(record)
+            self.size += len(record)
+
+        self.buffered = True
+        self.flush()
+
+    def timeout(self):
+        """Time in seconds before buffered datagrams must be flushed, or None
+        if nothing is buffered."""
+        if not self.buffered:
+            return None
+        return max(0, self.flushed_at + self.flush_interval - time.time())
+
+    def flush(self, force=False):
+        """Flush buffered datagrams if the interval is over, or if force is
+        set."""
+        if not self.buffered or (not force and self.timeout() > 0):
+            return
+        self.file.flush()
+        self.flushed_at = time.time()
+        self.buffered = False
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_capture(path):
+    """Yield (arrival time, datagram, (ip, port)) from a capture file."""
+    with open(path, 'rb') as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a geotaxi capture file' % path)
+        while True:
+            header = capture.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, ip, port, length = RECORD.unpack(header)
+            data = capture.read(length)
+            # Last record truncated, if geotaxi was killed
+            if len(data) < length:
+                return
+            yield timestamp, data, (socket.inet_ntoa(ip), port)
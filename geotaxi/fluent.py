@@ -0,0 +1,275 @@
+import fcntl
+import glob
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+import msgpack
+
+from geotaxi.stats import Counters
+
+logger = logging.getLogger("geotaxi")
+
+
+class FluentForwarder:
+    """Send records to fluentd from a background thread.
+
+    emit() only puts the record in a bounded in-memory buffer. The thread
+    sends records in chunks, using the Forward mode of the fluentd forward
+    protocol: [tag, [[time, record], ...]].
+
+    If the buffer is full, or if fluentd can't be reached, records are
+    appended to the spill file, up to spill_max_size bytes. Records which
+    can't be buffered nor spilled are dropped. The spill file is replayed once
+    fluentd is reachable again.
+
+    The thread must be started with start() in the process which emits
+    records. The spill file name is suffixed with the process id, and the
+    file is locked while the process runs. Unlocked spill files, left by
+    stopped processes sharing the same spill_path, are claimed and replayed
+    at start and then every orphans_interval seconds.
+    """
+
+    def __init__(self, tag, host='127.0.0.1', port=24224, buffer_size=10000, chunk_size=500,
+                 flush_interval=1, spill_path=None, spill_max_size=100 * 1024 * 1024,
+                 timeout=3, retry_interval=5, orphans_interval=60, counters=None):
+        self.tag = tag
+        self.host = host
+        self.port = port
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.spill_base = spill_path
+        self.spill_path = spill_path
+        self.spill_max_size = spill_max_size
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.orphans_interval = orphans_interval
+        self.counters = counters or Counters()
+
+        self.buffer = queue.Queue(buffer_size)
+        self.sock = None
+        self.retry_at = 0
+        self.thread = None
+        self.stopping = threading.Event()
+
+        # The spill file is written by emit() and by the thread
+        self.spill_lock = threading.Lock()
+        self.spill_file = None
+        self.spill_size = 0
+        self.orphans_at = 0
+
+    def emit(self, label, data):
+        entry = ('%s.%s' % (self.tag, label), int(time.time()), data)
+        try:
+            self.buffer.put_nowait(entry)
+        except queue.Full:
+            self.spill([entry])
+            return
+        self.counters.incr('fluent_queued')
+
+    def start(self):
+        self.spill_path = self.spill_path and '%s.%s' % (self.spill_path, os.getpid())
+        self.thread = threading.Thread(target=self.run, name='fluent-forwarder', daemon=True)
+        self.thread.start()
+
+    def close(self, timeout=5):
+        """Stop the thread once the buffer is sent, waiting at most timeout
+        seconds. Records still in the buffer are then spilled."""
+        self.stopping.set()
+        if self.thread:
+            self.thread.join(timeout)
+
+        entries = []
+        while True:
+            try:
+                entries.append(self.buffer.get_nowait())
+            except queue.Empty:
+                break
+        if entries:
+            self.spill(entries)
+
+        # Unlock the spill file, so it is replayed by the next process
+        with self.spill_lock:
+            if self.spill_file:
+                self.spill_file.close()
+                self.spill_file = None
+
+    def run(self):
+        while not (self.stopping.is_set() and self.buffer.empty()):
+            try:
+                entries = self.get_chunk()
+                if entries and not self.send(entries):
+                    self.spill(entries)
+                if self.sock and self.spill_size:
+                    self.replay()
+                if self.spill_base and time.monotonic() >= self.orphans_at and self.connect():
+                    self.orphans_at = time.monotonic() + self.orphans_interval
+                    self.replay_orphans()
+            except Exception as exc:
+                logger.error('Exception %s in fluent forwarder, continue execution', str(exc))
+
+    def get_chunk(self):
+        """Wait at most flush_interval for a record, then return up to
+        chunk_size records."""
+        try:
+            entries = [self.buffer.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+
+        while len(entries) < self.chunk_size:
+            try:
+                entries.append(self.buffer.get_nowait())
+            except queue.Empty:
+                break
+        return entries
+
+    @staticmethod
+    def pack(entries):
+        """Build Forward mode messages from a list of (tag, time, record)."""
+        by_tag = {}
+        for tag, timestamp, record in entries:
+            by_tag.setdefault(tag, []).append((timestamp, record))
+        return b''.join(msgpack.packb((tag, events)) for tag, events in by_tag.items())
+
+    def connect(self):
+        """Connect to fluentd if not connected. Return False if fluentd can't
+        be reached."""
+        if self.sock:
+            return True
+        # Do not try to reconnect for every chunk while fluentd is down
+        if time.monotonic() < self.retry_at:
+            return False
+        try:
+            self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError as exc:
+            logger.warning('Unable to connect to fluentd %s:%s: %s', self.host, self.port, exc)
+            self.retry_at = time.monotonic() + self.retry_interval
+            return False
+        return True
+
+    def send(self, entries):
+        """Send entries to fluentd. Return False if fluentd can't be reached."""
+        if not self.connect():
+            return False
+
+        try:
+            self.sock.sendall(self.pack(entries))
+        except OSError as exc:
+            logger.warning('Unable to send records to fluentd: %s', exc)
+            self.sock.close()
+            self.sock = None
+            self.retry_at = time.monotonic() + self.retry_interval
+            return False
+
+        self.counters.incr('fluent_sent', len(entries))
+        return True
+
+    def spill(self, entries, replayed=False):
+        """Append entries to the spill file, or drop them if there is no spill
+        file or if it is full. Entries spilled again after a failed replay are
+        not counted twice."""
+        with self.spill_lock:
+            data = b''.join(msgpack.packb(entry) for entry in entries)
+            if not self.spill_path or self.spill_size + len(data) > self.spill_max_size:
+                self.counters.incr('fluent_dropped', len(entries))
+                return
+
+            if not self.spill_file:
+                self.open_spill_file()
+                if self.spill_size + len(data) > self.spill_max_size:
+                    self.counters.incr('fluent_dropped', len(entries))
+                    return
+            self.spill_file.write(data)
+            self.spill_file.flush()
+            self.spill_size += len(data)
+        if not replayed:
+            self.counters.incr('fluent_spilled', len(entries))
+
+    def open_spill_file(self):
+        """Open and lock the spill file. The file is reopened if it was
+        claimed by another process between open() and flock(). If another
+        running process uses the same name, the name is suffixed."""
+        path, suffix = self.spill_path, 0
+        while True:
+            spill_file = open(path, 'a+b')
+            try:
+                fcntl.flock(spill_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                spill_file.close()
+                suffix += 1
+                path = '%s.%s' % (self.spill_path, suffix)
+                continue
+            if self.same_file(spill_file, path):
+                break
+            spill_file.close()
+        self.spill_path = path
+        self.spill_file = spill_file
+        # Records left by a stopped process with the same PID are kept
+        self.spill_size = os.fstat(spill_file.fileno()).st_size
+
+    @staticmethod
+    def same_file(opened, path):
+        try:
+            return os.stat(path).st_ino == os.fstat(opened.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    def claim(self, path):
+        """Lock and rename a spill file left by a stopped process. Return the
+        opened file, or None if the file is used or was claimed by another
+        process."""
+        try:
+            orphan = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(orphan, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            orphan.close()
+            return None
+        if not self.same_file(orphan, path):
+            orphan.close()
+            return None
+        os.rename(path, self.spill_path + '.replay')
+        return orphan
+
+    def replay(self):
+        """Send the records of the spill file. Records which can't be sent are
+        spilled again."""
+        with self.spill_lock:
+            # The file is kept open, thus locked, while it is replayed
+            replay_file = self.spill_file
+            self.spill_file = None
+            self.spill_size = 0
+            os.rename(self.spill_path, self.spill_path + '.replay')
+        self.replay_file(replay_file)
+
+    def replay_orphans(self):
+        """Replay the spill files left by stopped processes."""
+        for path in sorted(glob.glob(glob.escape(self.spill_base) + '.*')):
+            orphan = self.claim(path)
+            if orphan:
+                logger.info('Replay the spill file %s of a stopped process', path)
+                self.replay_file(orphan)
+
+    def replay_file(self, replay_file):
+        """Send the records of a claimed spill file, and remove it."""
+        with replay_file:
+            replay_file.seek(0)
+            unpacker = msgpack.Unpacker(replay_file, use_list=False, raw=False)
+            entries = []
+            sent = True
+            for entry in unpacker:
+                entries.append(entry)
+                if len(entries) < self.chunk_size:
+                    continue
+                sent = sent and self.send(entries)
+                if not sent:
+                    self.spill(entries, replayed=True)
+                entries = []
+            if entries and not (sent and self.send(entries)):
+                self.spill(entries, replayed=True)
+            os.unlink(self.spill_path + '.replay')
@@ -4,14 +4,26 @@ import logging.config
 import multiprocessing
 import os
 import queue
+import selectors
 import signal
 import socket
 import sys
+import time
 
-from fluent.sender import FluentSender
 from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
 import sentry_sdk
 
+from geotaxi.aio import run_asyncio_server
+from geotaxi.capture import CaptureWriter
+from geotaxi.fluent import FluentForwarder
+from geotaxi.janitor import Janitor
+from geotaxi.metrics import MetricsServer
+from geotaxi.ring import RingBuffer
+from geotaxi.shards import ShardedRedis
+from geotaxi.stats import Counters
+from geotaxi.supervisor import Supervisor
+from geotaxi.wire import MAX_DATAGRAM_SIZE
 from geotaxi.worker import Worker
 
 logger = logging.getLogger("geotaxi")
@@ -21,46 +33,218 @@ def signal_handler(signals, signum):
     signals.append(signum)
 
 
-def run_server(workers, host, port, geotaxi):
-    msg_queue = multiprocessing.Queue(1024)
+def print_status(geotaxi, status):
+    """Display the status lines, and the stats of geotaxi."""
+    for line in status:
+        sys.stdout.write('%s\n' % line)
+    for name, value in geotaxi.stats().items():
+        sys.stdout.write('%s: %s\n' % (name, value))
+    sys.stdout.flush()
 
-    procs = [
-        multiprocessing.Process(target=geotaxi.handle_messages, args=(msg_queue,))
-        for _ in range(workers)
-    ]
-    for proc in procs:
-        proc.start()
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind((host, port))
-    sock.settimeout(0.5)
 
-    # Catch Ctrl^C, SIGTERM and SIGUSR1
+def catch_signals():
+    """Catch Ctrl^C, SIGTERM and SIGUSR1. Return the list where received
+    signals are appended."""
     signals = []
     for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1):
         signal.signal(sig, lambda signum, _: signal_handler(signals, signum))
+    return signals
+
+
+def bind_socket(host, port, reuseport=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuseport:
+        # Several sockets can be bound to the same address, and the kernel
+        # spreads incoming datagrams between them.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def run_reuseport_server(workers, host, port, geotaxi, metrics=None, supervise_interval=5, shutdown_timeout=0):
+    """Each worker receives datagrams from its own socket bound with
+    SO_REUSEPORT. The parent process only supervises workers, and restarts
+    them when they die.
+
+    On SIGTERM or SIGINT, workers handle the datagrams waiting in their
+    socket and store the data kept in memory, within shutdown_timeout
+    seconds."""
+    def start_worker(row):
+        sock = bind_socket(host, port, reuseport=True)
+        proc = multiprocessing.Process(target=geotaxi.handle_socket, args=(sock, row))
+        proc.start()
+        # The socket is now owned by the worker
+        sock.close()
+        return proc
+
+    supervisor = Supervisor(start_worker, workers, counters=geotaxi.counters, interval=supervise_interval)
+    supervisor.start()
+
+    geotaxi.load_script()
+    geotaxi.start_background_tasks()
+
+    if metrics:
+        metrics.gauges['workers_alive'] = supervisor.alive
+        metrics.start()
+
+    signals = catch_signals()
 
     while True:
         if signal.SIGINT in signals or signal.SIGTERM in signals:
-            for proc in procs:
-                os.kill(proc.pid, signal.SIGKILL)
+            logger.info('Stop workers')
+            supervisor.stop(shutdown_timeout)
             break
 
         if signal.SIGUSR1 in signals:
             signals.remove(signal.SIGUSR1)
-            sys.stdout.write('Queue size: %s\n' % msg_queue.qsize())
-            sys.stdout.flush()
+            print_status(geotaxi, ['Workers alive: %s/%s' % (supervisor.alive(), len(supervisor.procs))])
+
+        supervisor.check()
+        time.sleep(0.5)
+
 
+def recv_datagrams(sock, max_count):
+    """Read up to max_count datagrams from the non-blocking socket sock,
+    without waiting for new datagrams."""
+    datagrams = []
+    while len(datagrams) < max_count:
         try:
-            data, addr = sock.recvfrom(4096)
-        except socket.timeout:
-            continue
+            datagrams.append(sock.recvfrom(MAX_DATAGRAM_SIZE))
+        except BlockingIOError:
+            break
+    return datagrams
+
 
+def put_before(msg_queue, datagrams, deadline):
+    """Put datagrams in msg_queue, and wait while it is full until the
+    deadline. Return False if they couldn't be put."""
+    while True:
         try:
-            # Put in the queue, but do not block
-            msg_queue.put((data, addr), False)
+            msg_queue.put(datagrams, False)
+            return True
         except queue.Full:
-            logger.warning('Queue is full - drop message...')
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+
+
+def run_server(workers, host, port, geotaxi, recv_batch_size=32, transport='queue', queue_size=1024,
+               metrics=None, min_workers=None, max_workers=None, supervise_interval=5, shutdown_timeout=0,
+               share_port=False):
+    """The main process reads datagrams and sends them to workers through a
+    queue. Workers are restarted when they die, and their number is scaled
+    between min_workers and max_workers according to the queue size and to
+    the time they spend handling messages.
+
+    On SIGTERM or SIGINT, the main process stops receiving, and waits at most
+    shutdown_timeout seconds for workers to drain the queue and store the
+    data kept in memory. With share_port, the socket is bound with
+    SO_REUSEPORT, so a new geotaxi can receive datagrams before this one
+    stops."""
+    if transport == 'ring':
+        msg_queue = RingBuffer(queue_size, slot_size=MAX_DATAGRAM_SIZE)
+    else:
+        msg_queue = multiprocessing.Queue(queue_size)
+    geotaxi.load = lambda: msg_queue.qsize() / queue_size
+
+    def start_worker(row):
+        proc = multiprocessing.Process(target=geotaxi.handle_messages, args=(msg_queue, row))
+        proc.start()
+        return proc
+
+    supervisor = Supervisor(
+        start_worker, workers, min_workers=min_workers, max_workers=max_workers,
+        counters=geotaxi.counters, load=geotaxi.load, interval=supervise_interval
+    )
+    supervisor.start()
+
+    geotaxi.load_script()
+    geotaxi.start_background_tasks()
+
+    if metrics:
+        metrics.gauges['queue_size'] = msg_queue.qsize
+        metrics.gauges['workers_alive'] = supervisor.alive
+        if transport == 'ring':
+            metrics.gauges['ring_overruns'] = lambda: msg_queue.stats()['overruns']
+            metrics.gauges['ring_oversized'] = lambda: msg_queue.stats()['oversized']
+        metrics.start()
+
+    sock = bind_socket(host, port, reuseport=share_port)
+    sock.setblocking(False)
+
+    # When a signal is received, a byte is written to wakeup_w so select()
+    # returns immediately and the signal is processed without delay.
+    wakeup_r, wakeup_w = socket.socketpair()
+    wakeup_r.setblocking(False)
+    wakeup_w.setblocking(False)
+    signal.set_wakeup_fd(wakeup_w.fileno())
+
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    selector.register(wakeup_r, selectors.EVENT_READ)
+
+    signals = catch_signals()
+
+    while True:
+        if signal.SIGINT in signals or signal.SIGTERM in signals:
+            # Datagrams waiting in the socket buffer would be lost once the
+            # socket is closed
+            deadline = time.monotonic() + shutdown_timeout
+            datagrams = recv_datagrams(sock, queue_size * recv_batch_size) if shutdown_timeout else []
+            sock.close()
+            for start in range(0, len(datagrams), recv_batch_size):
+                if not put_before(msg_queue, datagrams[start:start + recv_batch_size], deadline):
+                    geotaxi.counters.incr('queue_dropped', len(datagrams) - start)
+                    break
+
+            logger.info('Stop receiving, wait for workers to handle %s queued items', msg_queue.qsize())
+            supervisor.stop(max(0, deadline - time.monotonic()), drained=lambda: not msg_queue.qsize())
+            if transport == 'ring':
+                msg_queue.close()
+            if geotaxi.capture:
+                geotaxi.capture.close()
+            break
+
+        if signal.SIGUSR1 in signals:
+            signals.remove(signal.SIGUSR1)
+            status = [
+                'Queue size: %s' % msg_queue.qsize(),
+                'Workers alive: %s/%s' % (supervisor.alive(), len(supervisor.procs)),
+            ]
+            if transport == 'ring':
+                stats = msg_queue.stats()
+                status.append('Ring buffer overruns: %s' % stats['overruns'])
+                status.append('Ring buffer oversized datagrams: %s' % stats['oversized'])
+            print_status(geotaxi, status)
+
+        supervisor.check()
+        if geotaxi.capture:
+            geotaxi.capture.flush()
+            capture_timeout = geotaxi.capture.timeout()
+        else:
+            capture_timeout = None
+
+        timeout = supervisor.timeout() if capture_timeout is None else min(supervisor.timeout(), capture_timeout)
+        for key, _ in selector.select(timeout):
+            if key.fileobj is wakeup_r:
+                wakeup_r.recv(4096)
+                continue
+
+            # Empty the socket buffer, and send datagrams to workers as a
+            # single queue item.
+            datagrams = recv_datagrams(sock, recv_batch_size)
+            if not datagrams:
+                continue
+            geotaxi.counters.incr('received', len(datagrams))
+            if geotaxi.capture:
+                geotaxi.capture.write(datagrams)
+
+            try:
+                # Put in the queue, but do not block
+                msg_queue.put(datagrams, False)
+            except queue.Full:
+                geotaxi.counters.incr('queue_dropped', len(datagrams))
+                logger.warning('Queue is full - drop %s messages...', len(datagrams))
 
 
 class FormatWithPID(logging.Formatter):
@@ -89,11 +273,92 @@ def main():
     parser.add_argument('-p', '--port', type=int, default=8080,
                         help='Listen port')
 
+    parser.add_argument('--mode', choices=('multiprocessing', 'asyncio'), default='multiprocessing',
+                        help='With multiprocessing, messages are processed by --workers processes. With asyncio, '
+                             'a single process receives messages and runs several redis pipelines concurrently')
+    parser.add_argument('--max-pipelines', type=int, default=16,
+                        help='Maximum number of redis pipelines in flight, with --mode asyncio')
     parser.add_argument('-w', '--workers', type=int,
                         default=max(1, multiprocessing.cpu_count() - 1),
                         help='Number of workers')
+    parser.add_argument('--min-workers', type=int, default=None,
+                        help='Minimum number of workers when the queue is idle. Defaults to --workers')
+    parser.add_argument('--max-workers', type=int, default=None,
+                        help='Maximum number of workers when the queue fills up or workers are busy. '
+                             'Defaults to --workers')
+    parser.add_argument('--shutdown-timeout', type=float, default=5,
+                        help='On SIGTERM, stop receiving messages, and wait at most this number of seconds for '
+                             'workers to handle the messages received and to store the data kept in memory. '
+                             'Set to 0 to stop immediately')
+    parser.add_argument('--share-port', action='store_true', default=False,
+                        help='Bind the listen socket with SO_REUSEPORT, so a new geotaxi can be started on the '
+                             'same address before this one is stopped. Always set with --reuseport')
+    parser.add_argument('--supervise-interval', type=float, default=5,
+                        help='Interval in seconds between two checks of the workers, to restart the dead ones '
+                             'and to scale their number')
+    parser.add_argument('--reuseport', action='store_true', default=False,
+                        help='Each worker receives messages from its own socket bound with SO_REUSEPORT, '
+                             'instead of reading them from a queue filled by the main process')
+    parser.add_argument('--transport', choices=('queue', 'ring'), default='queue',
+                        help='How the main process sends datagrams to workers: a multiprocessing queue, '
+                             'or a ring buffer in shared memory which avoids pickling messages')
+    parser.add_argument('--queue-size', type=int, default=1024,
+                        help='Maximum number of items in the queue, or number of slots of the ring buffer')
+    parser.add_argument('--recv-batch-size', type=int, default=32,
+                        help='Maximum number of datagrams read by the main process and sent to workers '
+                             'as a single queue item')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Maximum number of messages stored in redis with a single pipeline')
+    parser.add_argument('--batch-latency', type=float, default=0,
+                        help='Maximum time in milliseconds to wait for a batch to fill up')
+    parser.add_argument('--coalesce-window', type=float, default=0,
+                        help='If set, positions are kept in memory during this time in milliseconds, and only '
+                             'the most recent position of each taxi and operator is stored in redis. Requires '
+                             '--reuseport, --mode asyncio or a single worker')
+
+    parser.add_argument('--throttle-cache-size', type=int, default=0,
+                        help='If set, keep the timestamp of the last position of this number of taxis, to ignore '
+                             'positions older than the last one, or received before --min-interval')
+    parser.add_argument('--min-interval', type=float, default=0,
+                        help='Minimum interval in seconds between two positions of a taxi, with --throttle-cache-size')
+    parser.add_argument('--operator-min-interval', type=str, action='append', default=[],
+                        metavar='OPERATOR=SECONDS',
+                        help='Override --min-interval for an operator. Can be repeated')
+    parser.add_argument('--min-distance', type=float, default=0,
+                        help='If set, do not update geoindexes when a taxi moved less than this distance in meters '
+                             'since its last position written, and its status did not change. Requires --reuseport, '
+                             '--mode asyncio or a single worker')
+    parser.add_argument('--suppress-hset', action='store_true', default=False,
+                        help='With --min-distance, do not update the taxi hash either')
+    parser.add_argument('--movement-cache-size', type=int, default=100000,
+                        help='Number of taxis for which the last position written is kept, with --min-distance')
+
+    parser.add_argument('--shed-high-water', type=float, default=0,
+                        help='If set, when the queue of messages is fuller than this ratio, drop the positions of '
+                             'taxis seen recently whose status did not change, until the queue is half drained. '
+                             'Not supported with --reuseport')
+    parser.add_argument('--shed-max-age', type=float, default=30,
+                        help='With --shed-high-water, keep a position if the last one of the taxi was accepted more '
+                             'than this number of seconds ago')
+    parser.add_argument('--shed-cache-size', type=int, default=100000,
+                        help='Number of taxis for which the status of the last position is kept, with '
+                             '--shed-high-water')
 
     parser.add_argument('--sentry-dsn', type=str, help='Sentry DSN')
+    parser.add_argument('--capture-path', type=str, default=None,
+                        help='If set, write the datagrams received to this file, suffixed with the PID of the '
+                             'receiving process, to replay them with scripts/replay-traffic.py')
+    parser.add_argument('--capture-max-size', type=int, default=100 * 1024 * 1024,
+                        help='Size in bytes of a capture file before rotation')
+    parser.add_argument('--capture-backups', type=int, default=10,
+                        help='Number of rotated capture files kept')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='If set, serve metrics in the Prometheus format on this port, on /metrics')
+    parser.add_argument('--metrics-host', type=str, default='0.0.0.0',
+                        help='Address of the metrics endpoint')
+    parser.add_argument('--stage-timing-sample', type=int, default=100,
+                        help='Time the parsing, hash checking and fluentd stages of one message every N in the '
+                             'latency histograms. Set to 0 to disable')
 
     parser.add_argument('--redis-host', type=str, default='127.0.0.1',
                         help='Redis host')
@@ -101,6 +366,24 @@ def main():
                         help='Redis port')
     parser.add_argument('--redis-password', type=str, default=None,
                         help='Redis password')
+    parser.add_argument('--redis-shards', type=str, default=None, metavar='HOST:PORT,HOST:PORT',
+                        help='If set, spread the keys over these redis servers instead of --redis-host')
+    parser.add_argument('--geo-cell-precision', type=int, default=4,
+                        help='With --redis-shards, length of the geohash of the cells partitioning geoindexes')
+    parser.add_argument('--redis-script', choices=('position', 'batch'), default=None,
+                        help='If set, store positions with a Lua script called with EVALSHA once per position or '
+                             'once per batch, instead of sending each command separately')
+    parser.add_argument('--resp-writer', action='store_true', default=False,
+                        help='Encode the commands storing positions directly in the redis protocol, instead of '
+                             'using redis-py pipelines. Not supported with --mode asyncio and --redis-script')
+
+    parser.add_argument('--janitor-ttl', type=int, default=0,
+                        help='If set, remove from redis the taxis which did not send any position for this number '
+                             'of seconds')
+    parser.add_argument('--janitor-interval', type=float, default=60,
+                        help='Interval in seconds between two janitor runs')
+    parser.add_argument('--janitor-chunk-size', type=int, default=500,
+                        help='Maximum number of taxis retrieved and removed by the janitor with a single command')
 
     parser.add_argument('--disable-fluent', action='store_true', default=False,
                         help='If set, do not send logs to fluent')
@@ -108,11 +391,30 @@ def main():
                         help='Fluentd host')
     parser.add_argument('--fluent-port', type=int, default=24224,
                         help='Fluentd port')
+    parser.add_argument('--fluent-buffer-size', type=int, default=10000,
+                        help='Maximum number of records waiting to be sent to fluentd, per worker')
+    parser.add_argument('--fluent-spill-path', type=str, default=None,
+                        help='If set, records which can not be buffered or sent to fluentd are appended to this '
+                             'file, suffixed with the worker PID, and sent once fluentd is reachable. Otherwise, '
+                             'they are dropped')
+    parser.add_argument('--fluent-spill-max-size', type=int, default=100 * 1024 * 1024,
+                        help='Maximum size of the spill file in bytes, per worker')
 
     parser.add_argument('--auth-enabled', action='store_true', default=False,
                         help='Enable authentication')
     parser.add_argument('--api-url', type=str, default='http://127.0.0.1:5000',
                         help='APITaxi URL, used when authentication is enabled to retrieve users')
+    parser.add_argument('--badhash-flush-interval', type=float, default=10,
+                        help='Bad hashes are counted in memory, and counters are stored in redis at this interval '
+                             'in seconds')
+    parser.add_argument('--badhash-flush-threshold', type=int, default=1000,
+                        help='Store bad hash counters in redis as soon as this number of bad hashes is reached')
+    parser.add_argument('--rejections-log-interval', type=float, default=10,
+                        help='Rejected messages are counted, and a summary is logged at this interval in seconds. '
+                             'Set to 0 to log each rejected message. With --verbose, all of them are logged')
+    parser.add_argument('--users-refresh-interval', type=float, default=60,
+                        help='Interval in seconds between two retrievals of users from APITaxi. '
+                             'Set to 0 to only retrieve them at startup')
 
     args = parser.parse_args()
 
@@ -152,22 +454,146 @@ def main():
     if args.auth_enabled and not api_key:
         parser.error('--enable-auth is set but API_KEY environment variable is not set')
 
+    operators_min_interval = {}
+    for value in args.operator_min_interval:
+        operator, _, interval = value.rpartition('=')
+        try:
+            operators_min_interval[operator] = float(interval)
+        except ValueError:
+            operator = None
+        if not operator:
+            parser.error('--operator-min-interval must be formatted as OPERATOR=SECONDS')
+
+    if args.mode == 'asyncio' and args.reuseport:
+        parser.error('--reuseport is not supported with --mode asyncio')
+    if args.reuseport and args.shed_high_water:
+        parser.error('--shed-high-water is not supported with --reuseport')
+    min_workers = args.workers if args.min_workers is None else args.min_workers
+    max_workers = args.workers if args.max_workers is None else args.max_workers
+    if not 1 <= min_workers <= args.workers <= max_workers:
+        parser.error('--min-workers, --workers and --max-workers must be in increasing order')
+    if args.reuseport and not min_workers == max_workers == args.workers:
+        parser.error('--min-workers and --max-workers are not supported with --reuseport')
+    if args.mode == 'asyncio' and args.resp_writer:
+        parser.error('--resp-writer is not supported with --mode asyncio')
+    if args.redis_script and args.resp_writer:
+        parser.error('--resp-writer is not supported with --redis-script')
+    # Coalesced positions and the last position written of each taxi are kept
+    # in memory by the worker which received them. Workers reading from the
+    # queue receive positions from any source, so a worker could store a
+    # position older than the one stored by another worker, or compare a
+    # position to an outdated one.
+    affinity = args.mode == 'asyncio' or args.reuseport or max_workers == 1
+    if args.coalesce_window and not affinity:
+        parser.error('--coalesce-window requires --reuseport, --mode asyncio or a single worker')
+    if args.min_distance and not affinity:
+        parser.error('--min-distance requires --reuseport, --mode asyncio or a single worker')
+
+    shards = []
+    for value in (args.redis_shards or '').split(','):
+        if not value:
+            continue
+        host, _, port = value.rpartition(':')
+        if not host or not port.isdigit():
+            parser.error('--redis-shards must be formatted as HOST:PORT,HOST:PORT')
+        shards.append((host, int(port)))
+    if shards and (args.mode == 'asyncio' or args.redis_script or args.resp_writer):
+        parser.error('--redis-shards is not supported with --mode asyncio, --redis-script and --resp-writer')
+
+    def make_redis(redis_class=Redis):
+        if not shards:
+            return redis_class(
+                host=args.redis_host,
+                port=args.redis_port,
+                password=args.redis_password,
+                socket_keepalive=True,
+            )
+        return ShardedRedis(
+            [
+                Redis(host=host, port=port, password=args.redis_password, socket_keepalive=True)
+                for host, port in shards
+            ],
+            ['%s:%s' % shard for shard in shards],
+            cell_precision=args.geo_cell_precision
+        )
+
+    # Row 0 belongs to the main process, then each worker has its own row.
+    # Workers retired when the load drops keep their row until they exit, while
+    # their replacements start on the next rows.
+    counters = Counters(rows=1 + max_workers + (max_workers - min_workers))
+
     if args.disable_fluent:
         fluent = None
     else:
-        fluent = FluentSender('geotaxi', host=args.fluent_host, port=args.fluent_port)
+        fluent = FluentForwarder(
+            'geotaxi', host=args.fluent_host, port=args.fluent_port,
+            buffer_size=args.fluent_buffer_size,
+            spill_path=args.fluent_spill_path, spill_max_size=args.fluent_spill_max_size,
+            counters=counters
+        )
+
+    redis = make_redis(AsyncRedis if args.mode == 'asyncio' else Redis)
+
+    if args.janitor_ttl:
+        # The janitor runs in a thread, with its own synchronous client
+        janitor = Janitor(
+            make_redis(),
+            args.janitor_ttl,
+            interval=args.janitor_interval,
+            chunk_size=args.janitor_chunk_size,
+            counters=counters
+        )
+    else:
+        janitor = None
 
-    redis = Redis(
-        host=args.redis_host,
-        port=args.redis_port,
-        password=args.redis_password,
-        socket_keepalive=True,
-    )
+    if args.capture_path:
+        capture = CaptureWriter(args.capture_path, max_size=args.capture_max_size, backups=args.capture_backups)
+    else:
+        capture = None
 
     worker = Worker(
         redis,
         fluent=fluent,
-        auth_enabled=args.auth_enabled, api_url=args.api_url, api_key=api_key
+        auth_enabled=args.auth_enabled, api_url=args.api_url, api_key=api_key,
+        users_refresh_interval=args.users_refresh_interval,
+        badhash_flush_interval=args.badhash_flush_interval,
+        badhash_flush_threshold=args.badhash_flush_threshold,
+        rejections_log_interval=args.rejections_log_interval,
+        shed_high_water=args.shed_high_water,
+        shed_max_age=args.shed_max_age,
+        shed_cache_size=args.shed_cache_size,
+        stage_timing_sample=args.stage_timing_sample,
+        counters=counters,
+        throttle_cache_size=args.throttle_cache_size,
+        min_interval=args.min_interval,
+        operators_min_interval=operators_min_interval,
+        min_distance=args.min_distance,
+        suppress_hset=args.suppress_hset,
+        movement_cache_size=args.movement_cache_size,
+        janitor=janitor,
+        capture=capture,
+        redis_script=args.redis_script, resp_writer=args.resp_writer,
+        batch_size=args.batch_size, batch_timeout=args.batch_latency / 1000,
+        coalesce_timeout=args.coalesce_window / 1000
     )
 
-    run_server(args.workers, args.host, args.port, worker)
+    metrics = MetricsServer(worker, host=args.metrics_host, port=args.metrics_port) if args.metrics_port else None
+
+    if args.mode == 'asyncio':
+        run_asyncio_server(
+            args.host, args.port, worker, max_pipelines=args.max_pipelines, metrics=metrics,
+            shutdown_timeout=args.shutdown_timeout, share_port=args.share_port
+        )
+    elif args.reuseport:
+        run_reuseport_server(
+            args.workers, args.host, args.port, worker,
+            metrics=metrics, supervise_interval=args.supervise_interval, shutdown_timeout=args.shutdown_timeout
+        )
+    else:
+        run_server(
+            args.workers, args.host, args.port, worker,
+            recv_batch_size=args.recv_batch_size, transport=args.transport, queue_size=args.queue_size,
+            metrics=metrics, min_workers=min_workers, max_workers=max_workers,
+            supervise_interval=args.supervise_interval, shutdown_timeout=args.shutdown_timeout,
+            share_port=args.share_port
+        )
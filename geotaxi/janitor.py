@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+
+from geotaxi.stats import Counters
+
+logger = logging.getLogger("geotaxi")
+
+
+class Janitor:
+    """Remove the positions of taxis which haven't sent any position for ttl
+    seconds.
+
+    Stale members of timestamps ("<taxi>:<operator>") are removed from
+    timestamps, geoindex_2 and from the hash taxi:<taxi>. Stale members of
+    timestamps_id ("<taxi>") are removed from timestamps_id and geoindex.
+
+    If redis is a ShardedRedis, stale members are retrieved from each shard,
+    and removed from all the cells of the geoindexes.
+
+    Members are retrieved and removed by chunks of chunk_size, so redis is
+    never blocked by a large command. A taxi sending a position between the
+    retrieval and the removal of a chunk is removed, and added back with its
+    next position.
+    """
+
+    def __init__(self, redis, ttl, interval=60, chunk_size=500, pause=0.01, counters=None):
+        self.redis = redis
+        self.ttl = ttl
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.counters = counters or Counters()
+
+    def evict_chunk(self, cutoff, source=None):
+        """Remove a chunk of members older than cutoff, retrieved from source
+        (by default, redis). Return the number of members removed from
+        timestamps and from timestamps_id."""
+        source = source or self.redis
+        members = source.zrangebyscore('timestamps', '-inf', cutoff, start=0, num=self.chunk_size)
+        taxi_ids = source.zrangebyscore('timestamps_id', '-inf', cutoff, start=0, num=self.chunk_size)
+        if not members and not taxi_ids:
+            return 0, 0
+
+        pipe = self.redis.pipeline()
+        for member in members:
+            taxi, _, operator = member.partition(b':')
+            pipe.zrem('timestamps', member)
+            pipe.zrem('geoindex_2', member)
+            pipe.hdel(b'taxi:' + taxi, operator)
+        for taxi_id in taxi_ids:
+            pipe.zrem('timestamps_id', taxi_id)
+            pipe.zrem('geoindex', taxi_id)
+        pipe.execute()
+
+        self.counters.incr('janitor_evicted', len(members))
+        self.counters.incr('janitor_evicted_ids', len(taxi_ids))
+        return len(members), len(taxi_ids)
+
+    def run_once(self):
+        """Remove all the members older than ttl, chunk by chunk."""
+        cutoff = int(time.time() - self.ttl)
+        evicted = evicted_ids = 0
+        for source in getattr(self.redis, 'shards', [self.redis]):
+            while True:
+                members, taxi_ids = self.evict_chunk(cutoff, source)
+                evicted += members
+                evicted_ids += taxi_ids
+                if members < self.chunk_size and taxi_ids < self.chunk_size:
+                    break
+                time.sleep(self.pause)
+
+        if evicted or evicted_ids:
+            logger.info('Janitor removed %s stale positions and %s stale taxis', evicted, evicted_ids)
+        return evicted, evicted_ids
+
+    def run_forever(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as exc:
+                logger.error('Exception %s in janitor, continue execution', str(exc))
+            time.sleep(self.interval)
+
+    def start(self):
+        threading.Thread(target=self.run_forever, name='janitor', daemon=True).start()
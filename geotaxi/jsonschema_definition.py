@@ -1,8 +1,6 @@
 # After editing this file, run `geotaxi-generate-jsonschema`, it will generate geotaxi/jsonschema.py file
 # Never edit geotaxi/jsonschema.py by yourself
 
-import fastjsonschema
-
 API_SCHEMA = {
     'type': 'object',
     'properties': {
@@ -27,7 +25,84 @@ WARNING_MESSAGE = """# File generated by the command `geotaxi-generate-jsonschem
 """
 
 
+# Python types of JSON schema types, and whether booleans must be excluded,
+# like fastjsonschema does.
+TYPES = {
+    'string': ('str', False),
+    'number': ('int, float', True),
+    'integer': ('int', True),
+    'boolean': ('bool', False),
+    'null': ('NoneType', False),
+    'object': ('dict', False),
+    'array': ('list, tuple', False),
+}
+
+
+def generate_validator(schema):
+    """Generate the code of validate(data), a validator specialized for
+    schema, an object with typed properties.
+
+    Unlike the generic code generated by fastjsonschema, properties are read
+    in a single pass, without copying the keys of data. Errors are the same
+    JsonSchemaValueException, with the same messages.
+    """
+    if set(schema) - {'type', 'properties', 'required'} or schema.get('type') != 'object':
+        raise ValueError('Only objects with typed properties are supported')
+
+    properties = schema.get('properties', {})
+    required = schema.get('required', [])
+    lines = [
+        'from fastjsonschema import JsonSchemaValueException',
+        '',
+        '',
+        'NoneType = type(None)',
+        'DEFINITION = %r' % (schema,),
+        '',
+        '',
+        'def validate(data):',
+        '    if not isinstance(data, dict):',
+        '        raise JsonSchemaValueException("data must be object", value=data, name="data", '
+        'definition=DEFINITION, rule=\'type\')',
+    ]
+
+    if required:
+        lines.append('    try:')
+        for name in required:
+            lines.append('        data__%s = data[%r]' % (name, name))
+        lines.extend([
+            '    except KeyError:',
+            '        raise JsonSchemaValueException(%r, value=data, name="data", definition=DEFINITION, '
+            'rule=\'required\') from None' % ('data must contain %s properties' % required),
+        ])
+
+    for name, definition in properties.items():
+        if set(definition) != {'type'}:
+            raise ValueError('Only typed properties are supported, not %s' % definition)
+        types = definition['type'] if isinstance(definition['type'], list) else [definition['type']]
+        python_types = ', '.join(TYPES[json_type][0] for json_type in types)
+        if ',' in python_types:
+            python_types = '(%s)' % python_types
+        condition = 'not isinstance(data__%s, %s)' % (name, python_types)
+        if any(TYPES[json_type][1] for json_type in types) and 'boolean' not in types:
+            condition += ' or isinstance(data__%s, bool)' % name
+
+        indent = '    '
+        if name not in required:
+            lines.append('    if %r in data:' % name)
+            lines.append('        data__%s = data[%r]' % (name, name))
+            indent = '        '
+        lines.extend([
+            '%sif %s:' % (indent, condition),
+            '%s    raise JsonSchemaValueException(%r, value=data__%s, name=%r, definition=%r, rule=\'type\')' % (
+                indent, 'data.%s must be %s' % (name, ' or '.join(types)), name, 'data.%s' % name, definition
+            ),
+        ])
+
+    lines.append('    return data')
+    return '\n'.join(lines) + '\n'
+
+
 def main():
     with open('geotaxi/jsonschema.py', 'w') as f:
         f.write(WARNING_MESSAGE)
-        f.write(fastjsonschema.compile_to_code(API_SCHEMA))
+        f.write(generate_validator(API_SCHEMA))
@@ -0,0 +1,83 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+
+logger = logging.getLogger("geotaxi")
+
+PREFIX = 'geotaxi_'
+
+
+class MetricsServer:
+    """Serve the metrics of geotaxi in the Prometheus text format on
+    /metrics, from a thread of the main process.
+
+    Counters and histograms are read from the shared memory written by
+    workers, so requests don't involve them. Gauges are the stats of geotaxi
+    which aren't counters, and the functions registered in gauges by the
+    server, like the queue size.
+    """
+
+    def __init__(self, geotaxi, host='0.0.0.0', port=9100):
+        self.geotaxi = geotaxi
+        self.host = host
+        self.port = port
+        self.gauges = {}
+
+    def render(self):
+        counters = self.geotaxi.counters
+        lines = []
+
+        for name in counters.names:
+            lines.append('# TYPE %s%s_total counter' % (PREFIX, name))
+            lines.append('%s%s_total %s' % (PREFIX, name, counters.get(name)))
+
+        # Messages handled by each process, row 0 is the main process
+        lines.append('# TYPE %sworker_handled_total counter' % PREFIX)
+        for row, value in enumerate(counters.get_rows('handled')):
+            if value:
+                lines.append('%sworker_handled_total{worker="%s"} %s' % (PREFIX, row, value))
+
+        for name in counters.histograms:
+            metric = '%s%s_duration_seconds' % (PREFIX, name)
+            buckets, count, total = counters.get_histogram(name)
+            lines.append('# TYPE %s histogram' % metric)
+            for bound, value in zip(counters.buckets, buckets):
+                lines.append('%s_bucket{le="%s"} %s' % (metric, bound, value))
+            lines.append('%s_bucket{le="+Inf"} %s' % (metric, count))
+            lines.append('%s_sum %s' % (metric, total))
+            lines.append('%s_count %s' % (metric, count))
+
+        gauges = {
+            name: value for name, value in self.geotaxi.stats().items()
+            if name not in counters.index
+        }
+        gauges.update((name, func()) for name, func in self.gauges.items())
+        for name, value in gauges.items():
+            lines.append('# TYPE %s%s gauge' % (PREFIX, name))
+            lines.append('%s%s %s' % (PREFIX, name, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug('Metrics request: ' + format, *args)
+
+        server = ThreadingHTTPServer((self.host, self.port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logger.info('Metrics available on http://%s:%s/metrics', self.host, self.port)
+        return server
@@ -0,0 +1,78 @@
+import collections
+import logging
+import time
+
+
+logger = logging.getLogger("geotaxi")
+
+# Key of the rejections counted once max_keys is reached
+OTHER = 'other'
+
+
+class Rejections:
+    """Count rejected messages per (reason, operator, source IP) instead of
+    logging each of them.
+
+    Every interval seconds, flush logs a summary of the counts, and one
+    example of each reason. If interval is 0, each rejection is logged as a
+    warning. In any case, rejections are logged with their payload at debug
+    level, so they are all displayed with --verbose.
+    """
+
+    def __init__(self, interval=10, max_keys=10000, summary_size=20):
+        self.interval = interval
+        # Maximum number of (reason, operator, IP) counted, to bound memory
+        # when messages come from many addresses. Beyond, the operator and
+        # the IP of rejections are replaced by OTHER.
+        self.max_keys = max_keys
+        # Maximum number of lines of the summary
+        self.summary_size = summary_size
+        self.counts = collections.Counter()
+        self.samples = {}
+        self.deadline = None
+
+    def add(self, reason, operator, from_addr, msg, *args):
+        """Count a rejection. msg and args are the log message of the
+        rejection, only formatted if it is logged."""
+        logger.debug(msg, *args)
+        if not self.interval:
+            logger.warning(msg, *args)
+            return
+
+        key = (reason, operator, from_addr[0])
+        if key not in self.counts and len(self.counts) >= self.max_keys:
+            key = (reason, OTHER, OTHER)
+        if not self.counts:
+            self.deadline = time.monotonic() + self.interval
+        self.counts[key] += 1
+        if reason not in self.samples:
+            self.samples[reason] = (msg, args)
+
+    def timeout(self):
+        """Time in seconds before the summary must be logged, or None if
+        nothing was rejected."""
+        if not self.counts:
+            return None
+        return max(0, self.deadline - time.monotonic())
+
+    def flush(self, force=False):
+        """Log the summary of rejections if the interval is over, or if force
+        is set, and reset the counts."""
+        if not self.counts or (not force and self.timeout() > 0):
+            return
+
+        logger.warning(
+            '%s messages rejected in the last %s seconds',
+            sum(self.counts.values()), self.interval
+        )
+        for (reason, operator, ip), count in self.counts.most_common(self.summary_size):
+            logger.warning('%s rejected (%s), operator %s from %s', count, reason, operator or '-', ip)
+        if len(self.counts) > self.summary_size:
+            logger.warning('and %s other operators and addresses', len(self.counts) - self.summary_size)
+
+        for reason, (msg, args) in self.samples.items():
+            logger.warning('Example of rejection (%s): ' + msg, reason, *args)
+
+        self.counts = collections.Counter()
+        self.samples = {}
+        self.deadline = None
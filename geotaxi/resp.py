@@ -0,0 +1,93 @@
+from redis.exceptions import ResponseError
+
+# Fields of the message stored in the taxi hash, separated by spaces
+HASH_FIELDS = ('timestamp', 'lat', 'lon', 'status', 'device', 'version')
+
+HSET = b'*4\r\n$4\r\nHSET\r\n'
+GEOADD = b'*5\r\n$6\r\nGEOADD\r\n$8\r\ngeoindex\r\n'
+GEOADD_2 = b'*5\r\n$6\r\nGEOADD\r\n$10\r\ngeoindex_2\r\n'
+ZADD = b'*4\r\n$4\r\nZADD\r\n$10\r\ntimestamps\r\n'
+ZADD_ID = b'*4\r\n$4\r\nZADD\r\n$13\r\ntimestamps_id\r\n'
+
+
+def encode(value):
+    """Encode value like redis-py: str in UTF-8, numbers with repr()."""
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode('utf8')
+    return repr(value).encode('utf8')
+
+
+def bulk(value):
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+class RespWriter:
+    """Write the commands storing positions directly in RESP, the redis
+    protocol, and send them on a connection of the pool of a redis-py client.
+
+    Commands are appended to a single buffer, reused for every batch, and the
+    constant parts of the commands are encoded once. This skips the argument
+    packing of redis-py pipelines. Only the commands of Worker.update_redis
+    are supported, other commands are still sent with redis-py.
+    """
+
+    def __init__(self, redis):
+        self.pool = redis.connection_pool
+        self.buffer = bytearray()
+        self.commands = 0
+
+    def __len__(self):
+        return self.commands
+
+    def add_position(self, data, now, write_hset=True, write_geoindex=True):
+        """Append the commands of Worker.update_redis for the position data."""
+        taxi = encode(data['taxi'])
+        operator = encode(data['operator'])
+        member = bulk(b'%s:%s' % (taxi, operator))
+        score = bulk(encode(now))
+        buf = self.buffer
+
+        if write_hset:
+            buf += HSET
+            buf += bulk(b'taxi:' + taxi)
+            buf += bulk(operator)
+            buf += bulk(b' '.join([encode(data[field]) for field in HASH_FIELDS]))
+            self.commands += 1
+
+        if write_geoindex:
+            lon_lat = bulk(encode(data['lon'])) + bulk(encode(data['lat']))
+            buf += GEOADD
+            buf += lon_lat
+            buf += bulk(taxi)
+            buf += GEOADD_2
+            buf += lon_lat
+            buf += member
+            self.commands += 2
+
+        buf += ZADD
+        buf += score
+        buf += member
+        buf += ZADD_ID
+        buf += score
+        buf += bulk(taxi)
+        self.commands += 2
+
+    def execute(self):
+        """Send the buffer and return the replies, errors included. The buffer
+        is cleared even if redis can't be reached, like a redis-py pipeline."""
+        connection = self.pool.get_connection('PIPELINE')
+        try:
+            connection.send_packed_command([self.buffer])
+            results = []
+            for _ in range(self.commands):
+                try:
+                    results.append(connection.read_response())
+                except ResponseError as exc:
+                    results.append(exc)
+            return results
+        finally:
+            self.buffer.clear()
+            self.commands = 0
+            self.pool.release(connection)
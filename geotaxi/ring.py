@@ -0,0 +1,180 @@
+import fcntl
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import socket
+import struct
+import tempfile
+import time
+
+from geotaxi.wire import MAX_DATAGRAM_SIZE
+
+# Write index, read index, number of datagrams dropped because the ring was
+# full, number of datagrams dropped because they didn't fit in a slot, and
+# index up to which slots read by consumers are freed. The read and freed
+# indexes are written by consumers, other fields by the producer: fields are
+# always written one by one.
+HEADER = struct.Struct('=QQQQQ')
+COUNTER = struct.Struct('=Q')
+WRITE_INDEX, READ_INDEX, OVERRUNS, OVERSIZED, FREED_INDEX = (idx * COUNTER.size for idx in range(5))
+# Each slot starts with a sequence number, followed by the datagram length,
+# the source port and the source IPv4 address.
+SLOT_INFO = struct.Struct('=HH4s')
+SLOT_HEADER_SIZE = COUNTER.size + SLOT_INFO.size
+
+
+class RingBuffer:
+    """Queue of datagrams stored in the fixed-size slots of a shared memory
+    segment, written by a single producer and read by several consumers.
+
+    Datagrams are copied as raw bytes, without pickling. Each slot holds a
+    sequence number telling whether it is free or filled for the current lap
+    of the ring. The producer never takes a lock; consumers take a lock to
+    claim a burst of consecutive slots, copy and free them. A semaphore wakes
+    consumers up when datagrams are available.
+
+    A consumer can be killed at any time. The lock is a POSIX record lock on
+    a temporary file, released by the kernel when its owner dies, and slots
+    claimed by a consumer which died before freeing them are freed by the
+    next consumer. Their datagrams are lost.
+
+    The interface mimics multiprocessing.Queue: items are lists of
+    (datagram, (ip, port)).
+    """
+
+    def __init__(self, size=1024, slot_size=MAX_DATAGRAM_SIZE, burst=64):
+        self.size = size
+        self.data_size = slot_size
+        # Keep slots aligned on 8 bytes
+        self.slot_size = (SLOT_HEADER_SIZE + slot_size + 7) // 8 * 8
+        self.burst = burst
+
+        self.shm = shared_memory.SharedMemory(create=True, size=HEADER.size + size * self.slot_size)
+        self.buf = self.shm.buf
+        # Record locks belong to processes, not to file descriptors, so the
+        # descriptor is shared by forked consumers
+        self.lock_file = tempfile.TemporaryFile()
+        self.items = multiprocessing.Semaphore(0)
+
+        HEADER.pack_into(self.buf, 0, 0, 0, 0, 0, 0)
+        for idx in range(size):
+            COUNTER.pack_into(self.buf, self.slot_offset(idx), idx)
+
+    def slot_offset(self, index):
+        return HEADER.size + (index % self.size) * self.slot_size
+
+    def sequence(self, index):
+        return COUNTER.unpack_from(self.buf, self.slot_offset(index))[0]
+
+    def is_filled(self, index):
+        return self.sequence(index) == index + 1
+
+    def put(self, datagrams, block=False):
+        """Store all the datagrams, or none of them and raise queue.Full if
+        there are not enough free slots. The ring never blocks the producer,
+        block is only accepted for compatibility with multiprocessing.Queue."""
+        write, _, overruns, oversized, _ = HEADER.unpack_from(self.buf, 0)
+
+        fitting = [(data, addr) for data, addr in datagrams if len(data) <= self.data_size]
+        if len(fitting) < len(datagrams):
+            COUNTER.pack_into(self.buf, OVERSIZED, oversized + len(datagrams) - len(fitting))
+
+        # Slots are freed by consumers in any order, make sure all of them
+        # are free before writing.
+        if any(self.sequence(write + idx) != write + idx for idx in range(len(fitting))):
+            COUNTER.pack_into(self.buf, OVERRUNS, overruns + len(fitting))
+            raise queue.Full
+
+        for data, (ip, port) in fitting:
+            offset = self.slot_offset(write)
+            data_offset = offset + SLOT_HEADER_SIZE
+            self.buf[data_offset:data_offset + len(data)] = data
+            SLOT_INFO.pack_into(self.buf, offset + COUNTER.size, len(data), port, socket.inet_aton(ip))
+            # The sequence number is written last, to publish the slot
+            COUNTER.pack_into(self.buf, offset, write + 1)
+            write += 1
+
+        COUNTER.pack_into(self.buf, WRITE_INDEX, write)
+        if fitting:
+            self.items.release()
+
+    def free_claimed(self):
+        """Free the slots read but not freed, if the consumer which claimed
+        them died. Must be called with the lock."""
+        read = COUNTER.unpack_from(self.buf, READ_INDEX)[0]
+        freed = COUNTER.unpack_from(self.buf, FREED_INDEX)[0]
+        for index in range(freed, read):
+            COUNTER.pack_into(self.buf, self.slot_offset(index), index + self.size)
+        COUNTER.pack_into(self.buf, FREED_INDEX, read)
+
+    def claim(self):
+        """Claim up to burst consecutive filled slots, copy and free them.
+        Return a list of (datagram, (ip, port))."""
+        fcntl.lockf(self.lock_file, fcntl.LOCK_EX)
+        try:
+            self.free_claimed()
+            read = COUNTER.unpack_from(self.buf, READ_INDEX)[0]
+            items = []
+            while len(items) < self.burst and self.is_filled(read + len(items)):
+                offset = self.slot_offset(read + len(items))
+                length, port, ip = SLOT_INFO.unpack_from(self.buf, offset + COUNTER.size)
+                data_offset = offset + SLOT_HEADER_SIZE
+                items.append((
+                    bytes(self.buf[data_offset:data_offset + length]),
+                    (socket.inet_ntoa(ip), port)
+                ))
+            COUNTER.pack_into(self.buf, READ_INDEX, read + len(items))
+            # Free the slots for the next lap
+            self.free_claimed()
+            remaining = self.is_filled(read + len(items))
+        finally:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_UN)
+
+        # The producer wakes a single consumer up per put(). Wake another one
+        # if datagrams are left.
+        if remaining:
+            self.items.release()
+        return items
+
+    def get(self, block=True, timeout=None):
+        """Return a list of (datagram, (ip, port)), or raise queue.Empty."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+            if not self.items.acquire(block, timeout):
+                raise queue.Empty
+
+            items = self.claim()
+            if items:
+                return items
+
+            # The semaphore was released for datagrams already claimed by
+            # another consumer.
+            if not block or (deadline is not None and time.monotonic() >= deadline):
+                raise queue.Empty
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        """Number of datagrams waiting to be claimed by consumers."""
+        write, read, _, _, _ = HEADER.unpack_from(self.buf, 0)
+        return write - read
+
+    def stats(self):
+        write, read, overruns, oversized, _ = HEADER.unpack_from(self.buf, 0)
+        return {
+            'occupancy': write - read,
+            'overruns': overruns,
+            'oversized': oversized,
+        }
+
+    def close(self):
+        """Release the shared memory segment. Must be called once, by the
+        process which created the ring."""
+        self.buf = None
+        self.lock_file.close()
+        self.shm.close()
+        self.shm.unlink()
@@ -0,0 +1,261 @@
+import bisect
+import hashlib
+
+from redis.exceptions import NoScriptError, RedisError
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+# Hash {cell: shard name} listing the cells of the geoindexes, stored on the
+# first shard.
+CELLS_KEY = 'geoindex_cells'
+GEO_KEYS = ('geoindex', 'geoindex_2')
+# Hash {<geo key>:<member>: cell} of the current cell of each member of the
+# geoindexes, stored on the shard of the taxi.
+MEMBER_CELLS_KEY = 'geoindex_member_cells'
+
+# Set the cell of a member, and return its previous cell. KEYS[1] is
+# MEMBER_CELLS_KEY, ARGV[1] the field of the member and ARGV[2] the cell.
+SWAP_CELL_SCRIPT = """
+local previous = redis.call('HGET', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return previous
+"""
+SWAP_CELL_SCRIPT_SHA = hashlib.sha1(SWAP_CELL_SCRIPT.encode('utf8')).hexdigest()
+
+
+def geohash(lat, lon, precision):
+    """Return the geohash of (lat, lon) with precision characters."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = value = 0
+    even = True
+    while len(chars) < precision:
+        coord, bounds = (lon, lon_range) if even else (lat, lat_range)
+        middle = (bounds[0] + bounds[1]) / 2
+        value <<= 1
+        if coord >= middle:
+            value |= 1
+            bounds[0] = middle
+        else:
+            bounds[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = value = 0
+    return ''.join(chars)
+
+
+class HashRing:
+    """Consistent hashing of keys over nodes. Each node is placed replicas
+    times on the ring, so keys are spread evenly and adding a node only
+    moves the keys of its segments."""
+
+    def __init__(self, nodes, replicas=160):
+        self.nodes = list(nodes)
+        points = sorted(
+            (self.hash('%s#%s' % (node, idx)), node_idx)
+            for node_idx, node in enumerate(self.nodes)
+            for idx in range(replicas)
+        )
+        self.points = [point for point, _ in points]
+        self.owners = [node_idx for _, node_idx in points]
+
+    @staticmethod
+    def hash(key):
+        if isinstance(key, str):
+            key = key.encode('utf8')
+        return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+    def get(self, key):
+        """Return the index of the node owning key."""
+        idx = bisect.bisect(self.points, self.hash(key)) % len(self.points)
+        return self.owners[idx]
+
+
+def to_str(value):
+    return value.decode('utf8') if isinstance(value, bytes) else str(value)
+
+
+def member_field(name, member):
+    """Field of member of the geo key name in MEMBER_CELLS_KEY."""
+    return '%s:%s' % (name, to_str(member))
+
+
+class ShardedRedis:
+    """Spread the keys written by geotaxi over several redis clients.
+
+    Per-taxi keys (taxi:<id>, and the members of timestamps and
+    timestamps_id) are routed by consistent hashing on the taxi id, so each
+    shard has its own timestamps and timestamps_id sorted sets. geoindex and
+    geoindex_2 are partitioned by geohash cells of cell_precision characters
+    into geoindex:<cell> and geoindex_2:<cell>, routed by consistent hashing
+    on the cell. Readers find the shard of each cell in the hash
+    geoindex_cells of the first shard, which also holds the bad hash
+    counters.
+
+    The current cell of each member is stored in geoindex_member_cells, on
+    the shard of the taxi, and swapped atomically with the new cell when a
+    position is stored. When the cell changes, the member is removed from its
+    previous cell once the new position is stored, whichever process stored
+    the previous position. If two positions of a taxi moving back and forth
+    between two cells are stored concurrently, the taxi can be missing from
+    its cell until its next position.
+    """
+
+    def __init__(self, shards, names, cell_precision=4):
+        self.shards = shards
+        self.names = names
+        self.ring = HashRing(names)
+        self.cell_precision = cell_precision
+        self.known_cells = set()
+
+    def shard_for_taxi(self, taxi):
+        return self.ring.get(to_str(taxi))
+
+    def shard_for_cell(self, cell):
+        return self.ring.get('cell:' + cell)
+
+    def cells(self):
+        """Return {cell: shard index} of the cells listed in the directory."""
+        return {
+            to_str(cell): self.names.index(to_str(name))
+            for cell, name in self.shards[0].hgetall(CELLS_KEY).items()
+            if to_str(name) in self.names
+        }
+
+    def pipeline(self):
+        return ShardedPipeline(self)
+
+
+class ShardedPipeline:
+    """Pipeline routing commands to a pipeline per shard. Only supports the
+    commands sent by the worker and the janitor. Results are returned in the
+    order of the shards, like command_stack."""
+
+    def __init__(self, sharded):
+        self.sharded = sharded
+        self.pipes = [shard.pipeline() for shard in sharded.shards]
+        # (shard, index of the command in its pipe, geo key, member, cell) of
+        # the cells swapped by geoadd, or looked up by zrem with cell None
+        self.cell_swaps = []
+
+    def __len__(self):
+        return sum(len(pipe) for pipe in self.pipes)
+
+    @property
+    def command_stack(self):
+        return [command for pipe in self.pipes for command in pipe.command_stack]
+
+    def taxi_pipe(self, taxi):
+        return self.pipes[self.sharded.shard_for_taxi(taxi)]
+
+    def hset(self, name, key, value):
+        taxi = to_str(name).partition(':')[2]
+        return self.taxi_pipe(taxi).hset(name, key, value)
+
+    def hdel(self, name, *keys):
+        taxi = to_str(name).partition(':')[2]
+        return self.taxi_pipe(taxi).hdel(name, *keys)
+
+    def zadd(self, name, mapping):
+        for member, score in mapping.items():
+            taxi = to_str(member).partition(':')[0]
+            self.taxi_pipe(taxi).zadd(name, {member: score})
+
+    def geoadd(self, name, values):
+        sharded = self.sharded
+        lon, lat, member = values
+        cell = geohash(float(lat), float(lon), sharded.cell_precision)
+        shard = sharded.shard_for_cell(cell)
+
+        if cell not in sharded.known_cells:
+            self.pipes[0].hset(CELLS_KEY, cell, sharded.names[shard])
+            sharded.known_cells.add(cell)
+
+        taxi_shard = sharded.shard_for_taxi(to_str(member).partition(':')[0])
+        taxi_pipe = self.pipes[taxi_shard]
+        taxi_pipe.evalsha(SWAP_CELL_SCRIPT_SHA, 1, MEMBER_CELLS_KEY, member_field(name, member), cell)
+        self.cell_swaps.append((taxi_shard, len(taxi_pipe) - 1, name, member, cell))
+
+        self.pipes[shard].geoadd('%s:%s' % (name, cell), values)
+
+    def zrem(self, name, *members):
+        if name in GEO_KEYS:
+            # Members are removed from their cell, looked up in
+            # MEMBER_CELLS_KEY, once the pipes are executed
+            for member in members:
+                taxi_shard = self.sharded.shard_for_taxi(to_str(member).partition(':')[0])
+                taxi_pipe = self.pipes[taxi_shard]
+                taxi_pipe.hget(MEMBER_CELLS_KEY, member_field(name, member))
+                self.cell_swaps.append((taxi_shard, len(taxi_pipe) - 1, name, member, None))
+                taxi_pipe.hdel(MEMBER_CELLS_KEY, member_field(name, member))
+            return
+        for member in members:
+            taxi = to_str(member).partition(':')[0]
+            self.taxi_pipe(taxi).zrem(name, member)
+
+    def zincrby(self, name, amount, value):
+        return self.pipes[0].zincrby(name, amount, value)
+
+    def execute(self, raise_on_error=True):
+        # Errors are raised once all the shards ran their commands, and the
+        # failed swaps are retried
+        shard_results = self.execute_pipes()
+
+        # Members are removed from their previous cell once their new
+        # position is stored, or once they are removed from the taxi shard
+        cell_swaps, self.cell_swaps = self.cell_swaps, []
+        self.retry_swaps(cell_swaps, shard_results)
+        for shard, idx, name, member, cell in cell_swaps:
+            previous = shard_results[shard][idx]
+            if previous is None or isinstance(previous, Exception) or to_str(previous) == cell:
+                continue
+            previous = to_str(previous)
+            self.pipes[self.sharded.shard_for_cell(previous)].zrem('%s:%s' % (name, previous), member)
+
+        removal_results = self.execute_pipes()
+        results = [result for results in shard_results + removal_results for result in results]
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    def retry_swaps(self, cell_swaps, shard_results):
+        """Load SWAP_CELL_SCRIPT in the shards where it isn't loaded, for
+        example after SCRIPT FLUSH or a restart of redis, and swap the cells
+        again. The results of the swaps are replaced in shard_results."""
+        failed = [swap for swap in cell_swaps if isinstance(shard_results[swap[0]][swap[1]], NoScriptError)]
+        loaded = set()
+        for shard in {shard for shard, _, _, _, _ in failed}:
+            try:
+                self.sharded.shards[shard].script_load(SWAP_CELL_SCRIPT)
+            except RedisError:
+                continue
+            loaded.add(shard)
+
+        retries = [swap for swap in failed if swap[0] in loaded]
+        if not retries:
+            return
+        for shard, _, name, member, cell in retries:
+            self.pipes[shard].evalsha(SWAP_CELL_SCRIPT_SHA, 1, MEMBER_CELLS_KEY, member_field(name, member), cell)
+        retry_results = self.execute_pipes()
+        for shard, idx, _, _, _ in retries:
+            shard_results[shard][idx] = retry_results[shard].pop(0)
+
+    def execute_pipes(self):
+        """Execute the pipe of each shard, and return the results of each
+        shard. Errors are returned as results."""
+        shard_results = []
+        for pipe in self.pipes:
+            count = len(pipe)
+            if not count:
+                shard_results.append([])
+                continue
+            try:
+                shard_results.append(pipe.execute(raise_on_error=False))
+            except Exception as exc:
+                # A shard which can't be reached doesn't prevent the commands
+                # of the other shards from being run
+                shard_results.append([exc] * count)
+        return shard_results
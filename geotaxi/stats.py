@@ -0,0 +1,116 @@
+import bisect
+import multiprocessing
+
+# Name of the counters shared by all geotaxi processes
+COUNTERS = (
+    'received',
+    'handled',
+    'parsed',
+    'decode_rejected',
+    'schema_rejected',
+    'unknown_user_rejected',
+    'coordinates_rejected',
+    'badhash',
+    'queue_dropped',
+    'shed_same_status',
+    'shed_kept_status_change',
+    'shed_kept_not_seen',
+    'redis_errors',
+    'worker_busy_us',
+    'workers_restarted',
+    'fluent_queued',
+    'fluent_sent',
+    'fluent_spilled',
+    'fluent_dropped',
+    'throttle_hits',
+    'throttled',
+    'reordered',
+    'geoadd_suppressed',
+    'hset_suppressed',
+    'janitor_evicted',
+    'janitor_evicted_ids',
+)
+
+# Latency histograms of the stages of message handling, and upper bounds of
+# their buckets in seconds
+HISTOGRAMS = ('parse', 'hash', 'fluent', 'redis')
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+
+
+class Counters:
+    """Counters and histograms stored in shared memory, incremented by
+    workers and read by the main process.
+
+    Each process increments its own row of the array, so no lock is needed on
+    the hot path. Values are summed over all rows when read. The row of the
+    process creating the counters is 0, other processes must call bind()
+    once started.
+
+    Each histogram is stored in the row as the count of each bucket, followed
+    by the count of values above the last bucket and the sum of values in
+    nanoseconds.
+    """
+
+    def __init__(self, names=COUNTERS, rows=64, histograms=HISTOGRAMS, buckets=BUCKETS):
+        self.names = names
+        self.index = {name: idx for idx, name in enumerate(names)}
+        self.histograms = histograms
+        self.buckets = buckets
+        self.histogram_index = {
+            name: len(names) + idx * (len(buckets) + 2)
+            for idx, name in enumerate(histograms)
+        }
+        self.width = len(names) + len(histograms) * (len(buckets) + 2)
+        self.rows = rows
+        self.values = multiprocessing.RawArray('q', rows * self.width)
+        self.next_row = multiprocessing.Value('i', 1)
+        self.offset = 0
+
+    def bind(self, row=None):
+        """Assign a row to the current process, the given one or the next
+        one. Rows are reused when all of them are assigned, except row 0
+        which belongs to the main process."""
+        if row is None:
+            with self.next_row.get_lock():
+                row = self.next_row.value
+                self.next_row.value += 1
+        row = 1 + (row - 1) % (self.rows - 1)
+        self.offset = row * self.width
+
+    def incr(self, name, value=1):
+        self.values[self.offset + self.index[name]] += value
+
+    def observe(self, name, seconds):
+        """Add a value, in seconds, to a histogram."""
+        start = self.offset + self.histogram_index[name]
+        self.values[start + bisect.bisect_left(self.buckets, seconds)] += 1
+        self.values[start + len(self.buckets) + 1] += int(seconds * 1e9)
+
+    def get(self, name):
+        return sum(self.get_rows(name))
+
+    def get_rows(self, name):
+        """Return the value of a counter for each row."""
+        idx = self.index[name]
+        return [self.values[row * self.width + idx] for row in range(self.rows)]
+
+    def get_histogram(self, name):
+        """Return the cumulative counts of each bucket, the total count and
+        the sum in seconds of a histogram."""
+        start = self.histogram_index[name]
+        size = len(self.buckets) + 2
+        totals = [0] * size
+        for row in range(self.rows):
+            offset = row * self.width + start
+            for idx, value in enumerate(self.values[offset:offset + size]):
+                totals[idx] += value
+
+        cumulative = []
+        count = 0
+        for value in totals[:len(self.buckets)]:
+            count += value
+            cumulative.append(count)
+        return cumulative, count + totals[len(self.buckets)], totals[-1] / 1e9
+
+    def snapshot(self):
+        return {name: self.get(name) for name in self.names}
@@ -0,0 +1,142 @@
+import logging
+import os
+import signal
+import time
+
+
+logger = logging.getLogger("geotaxi")
+
+
+class Supervisor:
+    """Keep between min_workers and max_workers worker processes running.
+
+    start_worker(row) must start and return a worker process, which binds
+    the given row of counters. Rows are reused by the workers replacing dead
+    or retired ones, so the metrics of a worker keep the same label.
+
+    check() must be called regularly by the main process. Every interval
+    seconds, dead workers are restarted. A worker is added when load(), the
+    fill ratio of the queue of messages, reaches scale_up_load or when
+    workers are busy more than busy_high of the time. A worker is retired
+    with SIGTERM, which lets it store the data kept in memory, when the
+    queue is nearly empty and the remaining workers would still be busy less
+    than busy_low of the time. The busy time is the worker_busy_us counter
+    incremented by workers.
+    """
+
+    def __init__(self, start_worker, workers, min_workers=None, max_workers=None, counters=None, load=None,
+                 interval=5, scale_up_load=0.5, scale_down_load=0.05, busy_high=0.8, busy_low=0.3):
+        self.start_worker = start_worker
+        self.workers = workers
+        self.min_workers = workers if min_workers is None else min_workers
+        self.max_workers = workers if max_workers is None else max_workers
+        self.counters = counters
+        self.load = load
+        self.interval = interval
+        self.scale_up_load = scale_up_load
+        self.scale_down_load = scale_down_load
+        self.busy_high = busy_high
+        self.busy_low = busy_low
+
+        # Running workers, and workers stopping after SIGTERM, by row
+        self.procs = {}
+        self.retiring = {}
+        self.next_check = None
+        self.last_busy = None
+
+    def start(self):
+        for _ in range(self.workers):
+            self.spawn()
+        self.next_check = time.monotonic() + self.interval
+        self.last_busy = (time.monotonic(), self.counters.get('worker_busy_us'))
+
+    def spawn(self):
+        """Start a worker on the first free row. Row 0 belongs to the main
+        process."""
+        row = 1
+        while row in self.procs or row in self.retiring:
+            row += 1
+        self.procs[row] = self.start_worker(row)
+
+    def retire(self):
+        """Ask the worker of the last row to stop."""
+        row = max(self.procs)
+        proc = self.procs.pop(row)
+        self.retiring[row] = proc
+        os.kill(proc.pid, signal.SIGTERM)
+
+    def alive(self):
+        return sum(1 for proc in self.procs.values() if proc.is_alive())
+
+    def timeout(self):
+        """Time in seconds before the next check."""
+        return max(0, self.next_check - time.monotonic())
+
+    def busy_ratio(self):
+        """Average ratio of time spent by workers handling messages since
+        the previous call."""
+        now, busy = time.monotonic(), self.counters.get('worker_busy_us')
+        last_time, last_busy = self.last_busy
+        self.last_busy = (now, busy)
+        if now <= last_time or not self.procs:
+            return 0
+        return (busy - last_busy) / 1e6 / (now - last_time) / len(self.procs)
+
+    def check(self, force=False):
+        """Restart dead workers and scale the number of workers, if the
+        interval is over or if force is set."""
+        if not force and self.timeout() > 0:
+            return
+        self.next_check = time.monotonic() + self.interval
+
+        for row, proc in list(self.retiring.items()):
+            if not proc.is_alive():
+                proc.join()
+                del self.retiring[row]
+
+        for row, proc in list(self.procs.items()):
+            if proc.is_alive():
+                continue
+            proc.join()
+            logger.error('Worker %s (pid %s) exited with code %s, restart it', row, proc.pid, proc.exitcode)
+            self.counters.incr('workers_restarted')
+            self.procs[row] = self.start_worker(row)
+
+        busy = self.busy_ratio()
+        load = self.load() if self.load else 0
+        count = len(self.procs)
+        if count < self.max_workers and (load >= self.scale_up_load or busy >= self.busy_high):
+            logger.info('Queue %d%% full, workers %d%% busy: start a worker', load * 100, busy * 100)
+            self.spawn()
+        elif (
+            count > self.min_workers and load <= self.scale_down_load
+            and busy * count / (count - 1) < self.busy_low
+        ):
+            logger.info('Queue %d%% full, workers %d%% busy: retire a worker', load * 100, busy * 100)
+            self.retire()
+
+    def stop(self, timeout=0, drained=None):
+        """Stop workers gracefully. Wait for drained() to return True, then
+        send SIGTERM to workers so they handle their last batch, store the
+        data kept in memory and exit. Workers still alive timeout seconds
+        after the call are killed."""
+        deadline = time.monotonic() + timeout
+        while drained and not drained() and self.alive() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        procs = list(self.procs.values()) + list(self.retiring.values())
+        for proc in procs:
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGTERM)
+        for proc in procs:
+            proc.join(max(0, deadline - time.monotonic()))
+
+        alive = sum(1 for proc in procs if proc.is_alive())
+        if alive:
+            logger.warning('Workers not stopped after %s seconds, kill %s of them', timeout, alive)
+        self.kill()
+
+    def kill(self):
+        for proc in list(self.procs.values()) + list(self.retiring.values()):
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGKILL)
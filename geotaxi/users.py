@@ -0,0 +1,77 @@
+import multiprocessing
+import struct
+import time
+
+import orjson as json
+
+# Sequence number, time of the last successful update, duration of the last
+# refresh, number of failed refreshes and size of the serialized table.
+HEADER = struct.Struct('=QddQQ')
+SEQUENCE = struct.Struct('=Q')
+
+
+class UsersTable:
+    """Table {user_name: api_key} stored in shared memory, so it can be
+    refreshed by a single process and read by all the workers.
+
+    Updates are protected by a sequence lock: the sequence number is odd while
+    the table is being written, and incremented once the table is complete.
+    Each process decodes the table again only when the sequence number has
+    changed, so lookups don't access the shared memory segment. Keys are
+    returned encoded in UTF-8, ready to be hashed.
+    """
+
+    def __init__(self, users, capacity=1024 * 1024):
+        self.capacity = capacity
+        # Anonymous shared memory, inherited by workers and released with the
+        # last process using it.
+        self.view = memoryview(multiprocessing.RawArray('B', HEADER.size + capacity)).cast('B')
+
+        self.sequence = None
+        self.users = {}
+        self.update(users)
+
+    def get(self, name):
+        if SEQUENCE.unpack_from(self.view, 0)[0] != self.sequence:
+            self.load()
+        return self.users.get(name)
+
+    def load(self):
+        while True:
+            sequence, _, _, _, size = HEADER.unpack_from(self.view, 0)
+            # Table being written, try again
+            if sequence % 2:
+                time.sleep(0)
+                continue
+            data = self.view[HEADER.size:HEADER.size + size].tobytes()
+            if SEQUENCE.unpack_from(self.view, 0)[0] == sequence:
+                break
+
+        self.users = {
+            name: key.encode('utf8')
+            for name, key in json.loads(data).items()
+        }
+        self.sequence = sequence
+
+    def update(self, users, latency=0):
+        """Replace the table. Must only be called by a single process."""
+        data = json.dumps(users)
+        if len(data) > self.capacity:
+            raise ValueError('Users table is too large: %s bytes, capacity is %s' % (len(data), self.capacity))
+
+        sequence, _, _, failures, _ = HEADER.unpack_from(self.view, 0)
+        SEQUENCE.pack_into(self.view, 0, sequence + 1)
+        self.view[HEADER.size:HEADER.size + len(data)] = data
+        HEADER.pack_into(self.view, 0, sequence + 2, time.time(), latency, failures, len(data))
+
+    def record_failure(self):
+        sequence, updated_at, latency, failures, size = HEADER.unpack_from(self.view, 0)
+        HEADER.pack_into(self.view, 0, sequence, updated_at, latency, failures + 1, size)
+
+    def stats(self):
+        _, updated_at, latency, failures, _ = HEADER.unpack_from(self.view, 0)
+        return {
+            'users_table_age': time.time() - updated_at,
+            'users_refresh_latency': latency,
+            'users_refresh_failures': failures,
+        }
@@ -0,0 +1,65 @@
+import struct
+
+# Maximum size of the datagrams read from sockets, and default size of the
+# slots of the ring buffer. Longer datagrams are truncated by recvfrom, and
+# rejected as invalid messages.
+MAX_DATAGRAM_SIZE = 4096
+
+# Binary messages start with a byte which is not valid UTF-8, so they can't
+# be mistaken for JSON messages. It is followed by the version of the
+# format, and by the timestamp as a little-endian signed 64 bits integer.
+# The other fields follow in the order of BINARY_FIELDS, as UTF-8 strings
+# separated by null bytes. Coordinates are sent as strings, so the hash is
+# computed on the text sent by the operator, like for JSON messages.
+#
+# Version 1, a msgpack map, was slower to decode than JSON and is no longer
+# supported.
+BINARY_MAGIC = b'\xc1'
+BINARY_VERSION = 2
+BINARY_PREFIX = BINARY_MAGIC + bytes([BINARY_VERSION])
+BINARY_HEADER = struct.Struct('<2sq')
+BINARY_FIELDS = ('operator', 'taxi', 'lat', 'lon', 'device', 'status', 'version', 'hash')
+
+
+def is_binary(message):
+    return message[:1] == BINARY_MAGIC
+
+
+def encode_binary(data):
+    """Encode a message. Raise ValueError if a field contains a null byte."""
+    fields = [str(data[name]) for name in BINARY_FIELDS]
+    if any('\0' in field for field in fields):
+        raise ValueError('fields can\'t contain null bytes')
+    return BINARY_HEADER.pack(BINARY_PREFIX, int(data['timestamp'])) + '\0'.join(fields).encode('utf8')
+
+
+def decode_binary(message):
+    """Decode a binary message. Raise ValueError if it is invalid. Fields
+    have the types required by the schema, so the message doesn't need to be
+    validated."""
+    try:
+        prefix, timestamp = BINARY_HEADER.unpack_from(message)
+    except struct.error:
+        raise ValueError('truncated message')
+    if prefix != BINARY_PREFIX:
+        raise ValueError('unsupported version %s' % message[1:2].hex())
+
+    # UnicodeDecodeError is a ValueError, like unpacking the wrong number of
+    # fields
+    try:
+        operator, taxi, lat, lon, device, status, version, hash_ = (
+            message[BINARY_HEADER.size:].decode('utf8').split('\0')
+        )
+    except ValueError as exc:
+        raise ValueError('invalid fields: %s' % exc)
+    return {
+        'timestamp': timestamp,
+        'operator': operator,
+        'taxi': taxi,
+        'lat': lat,
+        'lon': lon,
+        'device': device,
+        'status': status,
+        'version': version,
+        'hash': hash_,
+    }
@@ -1,30 +1,170 @@
+import collections
 import hashlib
+import math
 import orjson as json
+import queue
 import time
 import urllib
 import requests
 import signal
 import socket
 import logging
-from redis.exceptions import RedisError
+import threading
+from redis.exceptions import NoScriptError, RedisError
 
 from geotaxi import jsonschema
+from geotaxi.cache import LRUCache
+from geotaxi.rejections import Rejections
+from geotaxi.resp import RespWriter
+from geotaxi.stats import Counters
+from geotaxi.users import UsersTable
+from geotaxi.wire import MAX_DATAGRAM_SIZE, decode_binary, is_binary
 
 logger = logging.getLogger("geotaxi")
 
+EARTH_RADIUS = 6371000
+# Maximum latitude accepted by GEOADD
+GEO_LAT_LIMIT = 85.05112878
+
+# Maximum time in seconds a worker waits for messages before checking if it
+# must stop
+STOP_CHECK_INTERVAL = 1
+
+# Store positions with a single script. ARGV[1] is the current time, followed
+# by 6 values per position: taxi, operator, lon, lat, value of the taxi hash
+# and flags (1: update geoindexes, 2: update the taxi hash). KEYS are
+# geoindex, geoindex_2, timestamps and timestamps_id, followed by the taxi
+# hash of each position.
+UPDATE_SCRIPT = """
+local now = ARGV[1]
+for i = 0, (#ARGV - 1) / 6 - 1 do
+    local taxi, operator, lon, lat, value, flags = unpack(ARGV, 2 + i * 6, 7 + i * 6)
+    local member = taxi .. ':' .. operator
+    flags = tonumber(flags)
+    if flags % 2 == 1 then
+        redis.call('GEOADD', KEYS[1], lon, lat, taxi)
+        redis.call('GEOADD', KEYS[2], lon, lat, member)
+    end
+    if flags >= 2 then
+        redis.call('HSET', KEYS[5 + i], operator, value)
+    end
+    redis.call('ZADD', KEYS[3], now, member)
+    redis.call('ZADD', KEYS[4], now, taxi)
+end
+return (#ARGV - 1) / 6
+"""
+UPDATE_SCRIPT_SHA = hashlib.sha1(UPDATE_SCRIPT.encode('utf8')).hexdigest()
+
+# Sorted sets counting bad hashes per operator, per taxi and per IP address
+BADHASH_KEYS = ('badhash_operators', 'badhash_taxis_ids', 'badhash_ips')
+
 
 class Worker:
     """GeoTaxi worker."""
 
-    def __init__(self, redis, fluent=None, auth_enabled=False, api_url=None, api_key=None):
+    def __init__(self, redis, fluent=None, auth_enabled=False, api_url=None, api_key=None,
+                 batch_size=1, batch_timeout=0, coalesce_timeout=0, users_refresh_interval=0,
+                 badhash_flush_interval=10, badhash_flush_threshold=1000, counters=None,
+                 throttle_cache_size=0, min_interval=0, operators_min_interval=None,
+                 min_distance=0, suppress_hset=False, movement_cache_size=100000, movement_max_age=300,
+                 janitor=None, redis_script=None, resp_writer=False, capture=None,
+                 rejections_log_interval=10, shed_high_water=0, shed_max_age=30, shed_cache_size=100000,
+                 stage_timing_sample=100):
         self.redis = redis
         self.fluent = fluent
+        self.counters = counters or Counters()
+
+        # Maximum number of messages sent to redis in a single pipeline, and
+        # maximum time in seconds to wait for a batch to fill up.
+        self.batch_size = max(1, batch_size)
+        self.batch_timeout = batch_timeout
+
+        # If set, positions are kept in memory for coalesce_timeout seconds
+        # and only the most recent position of each (taxi, operator) is
+        # stored in redis.
+        self.coalesce_timeout = coalesce_timeout
+        self.positions = {}
+        self.positions_deadline = None
+
+        # Bad hashes are counted in memory, and counters are stored in redis
+        # every badhash_flush_interval seconds, or as soon as
+        # badhash_flush_threshold bad hashes are counted.
+        self.badhash_flush_interval = badhash_flush_interval
+        self.badhash_flush_threshold = badhash_flush_threshold
+        self.badhash = {key: collections.Counter() for key in BADHASH_KEYS}
+        self.badhash_count = 0
+        self.badhash_deadline = None
+
+        # Rejected messages are counted per (reason, operator, IP), and
+        # summarized in the logs every rejections_log_interval seconds.
+        self.rejections = Rejections(rejections_log_interval)
+
+        # Timing the stages of a message costs more than some of the stages:
+        # only one message every stage_timing_sample is timed in the latency
+        # histograms. Set to 0 to time no message. Messages handled and
+        # parsed are counted once per batch.
+        self.stage_timing_sample = stage_timing_sample
+        self.timing_countdown = stage_timing_sample
+        self.parsed = 0
+
+        # If throttle_cache_size is set, the timestamp of the last position
+        # stored for each (taxi, operator) is kept in memory. Positions older
+        # than the last one, or received less than min_interval seconds after
+        # it, are not stored. min_interval can be overridden per operator.
+        self.throttle_cache = LRUCache(throttle_cache_size) if throttle_cache_size else None
+        self.min_interval = min_interval
+        self.operators_min_interval = operators_min_interval or {}
+
+        # If min_distance is set, the last position written for each (taxi,
+        # operator) is kept in memory. If the taxi moved less than
+        # min_distance meters and its status didn't change, GEOADD (and HSET
+        # if suppress_hset is set) are skipped. Positions are written anyway
+        # every movement_max_age seconds.
+        self.min_distance = min_distance
+        self.suppress_hset = suppress_hset
+        self.movement_cache = LRUCache(movement_cache_size) if min_distance else None
+        self.movement_max_age = movement_max_age
+
+        # If shed_high_water is set, the status of the last position accepted
+        # for each (taxi, operator) is kept in memory. When the queue of
+        # messages is fuller than shed_high_water (a ratio between 0 and 1),
+        # positions with the same status as a position accepted less than
+        # shed_max_age seconds before are dropped, until the queue is drained
+        # below half of shed_high_water. Status changes and taxis not seen
+        # recently are always kept. load is set by the server to a function
+        # returning the fill ratio of the queue.
+        self.shed_high_water = shed_high_water
+        self.shed_max_age = shed_max_age
+        self.shed_cache = LRUCache(shed_cache_size) if shed_high_water else None
+        self.shedding = False
+        self.load = None
+
+        # Set by SIGTERM: the worker process stores the data kept in memory
+        # and exits once the current batch is handled.
+        self.stopping = False
+
+        # Janitor run by the main process
+        self.janitor = janitor
+
+        # CaptureWriter of the datagrams received, written by the process
+        # which reads the socket.
+        self.capture = capture
+
+        # If set to "position" or "batch", positions are stored with
+        # UPDATE_SCRIPT, called once per position or once per batch.
+        self.redis_script = redis_script
+        self.script_positions = []
+
+        # If set, the commands of update_redis are encoded in RESP and sent
+        # without redis-py pipelines. Only for synchronous redis clients.
+        self.resp_writer = RespWriter(redis) if resp_writer else None
 
         self.auth_enabled = auth_enabled
         if self.auth_enabled:
             self.api_url = api_url
             self.api_key = api_key
-            self.users = self.get_api_users()
+            self.users = UsersTable(self.get_api_users())
+            self.users_refresh_interval = users_refresh_interval
 
     def get_api_users(self):
         """Retrieve {user_name: api_key} from APITaxi /users endpoint."""
@@ -34,7 +174,8 @@ class Worker:
             headers={
                 'X-Version': '2',
                 'X-Api-Key': self.api_key
-            }
+            },
+            timeout=30
         )
         resp.raise_for_status()
 
@@ -43,16 +184,103 @@ class Worker:
             for row in resp.json()['data']
         }
 
+    def refresh_users(self):
+        """Replace the users table. If the table can't be retrieved, keep
+        the last one."""
+        start = time.monotonic()
+        try:
+            self.users.update(self.get_api_users(), latency=time.monotonic() - start)
+        except Exception as exc:
+            logger.error('Unable to refresh users, keep the previous table: %s', exc)
+            self.users.record_failure()
+
+    def refresh_users_forever(self):
+        while True:
+            time.sleep(self.users_refresh_interval)
+            self.refresh_users()
+
+    def start_background_tasks(self):
+        """Start the threads of the main process: the users table refresh and
+        the janitor. The users table is shared with workers, so this must be
+        called by a single process, after workers are started."""
+        if self.auth_enabled and self.users_refresh_interval:
+            threading.Thread(target=self.refresh_users_forever, name='users-refresh', daemon=True).start()
+        if self.janitor:
+            self.janitor.start()
+
+    def stats(self):
+        """Metrics displayed by the main process on SIGUSR1."""
+        stats = self.counters.snapshot()
+        if self.auth_enabled:
+            stats.update(self.users.stats())
+        return stats
+
+    def start(self, row=None):
+        """Called at the beginning of the process which handles messages. row
+        is the row of the process in counters."""
+        self.counters.bind(row)
+        if self.fluent:
+            self.fluent.start()
+
+    def setup_signals(self):
+        """Install the signal handlers of worker processes.
+
+        Signal handlers and the wakeup fd are inherited from the main process
+        when a worker is restarted. Ctrl^C sends SIGINT to the whole process
+        group: workers ignore it, and are stopped by the SIGTERM of the main
+        process once the queue is drained. SIGUSR1 can be sent on the master
+        process to display the queue size. Let's ignore the signal on workers
+        in case the administrator sent the signal on the worker PID by
+        mistake."""
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+    def stop(self, *args):
+        """Ask the worker to exit once the current batch is handled. Used as
+        the SIGTERM handler of worker processes."""
+        self.stopping = True
+
+    def shutdown(self):
+        """Store the data kept in memory, and send the records waiting for
+        fluentd, before the worker process exits."""
+        pipe = self.redis.pipeline()
+        self.flush_pending(pipe, force=True)
+        self.execute(pipe)
+        if self.fluent:
+            self.fluent.close()
+        if self.capture:
+            self.capture.close()
+        logger.info('Worker stopped')
+
+    def load_script(self):
+        """Load UPDATE_SCRIPT in redis at startup, if redis_script is set. If
+        it fails, the script is loaded by the first pipeline using it."""
+        if not self.redis_script:
+            return
+        try:
+            self.redis.script_load(UPDATE_SCRIPT)
+        except RedisError as exc:
+            logger.warning('Unable to load script in redis: %s', exc)
+
     def check_hash(self, data, from_addr):
-        """If auth is enabled, make sure data has a valid hash."""
+        """If auth is enabled, make sure data has a valid hash. Bad hashes are
+        counted in memory until flush_badhash is called."""
         if not self.auth_enabled:
             return True
 
         user_key = self.users.get(data['operator'])
         if not user_key:
-            logger.warning('User %s not valid', data['operator'])
+            self.counters.incr('unknown_user_rejected')
+            self.rejections.add(
+                'unknown_user', data['operator'], from_addr,
+                'User %s not valid, received from %s:%s', data['operator'], *from_addr
+            )
             return False
 
+        # Fields are hashed as received, before coordinates are converted.
+        # The key is already encoded by the users table.
         valid_hash = hashlib.sha1(''.join(map(str, [
             data['timestamp'],
             data['operator'],
@@ -62,78 +290,140 @@ class Worker:
             data['device'],
             data['status'],
             data['version'],
-            user_key
-        ])).encode('utf8')).hexdigest()
+        ])).encode('utf8') + user_key).hexdigest()
 
         if valid_hash == data['hash']:
             return True
 
-        pipe = self.redis.pipeline()
+        self.counters.incr('badhash')
+        operators, taxis, ips = (self.badhash[key] for key in BADHASH_KEYS)
 
-        self.run_redis_action(
-            pipe,
-            'ZINCRBY',
-            'badhash_operators',
-            1,
-            data['operator']
-        )
-        self.run_redis_action(
-            pipe,
-            'ZINCRBY',
-            'badhash_taxis_ids',
-            1,
-            data['taxi']
-        )
-        from_ip = from_addr[0]
-        self.run_redis_action(
-            pipe,
-            'ZINCRBY',
-            'badhash_ips',
-            1,
-            from_ip
-        )
-        pipe.execute()
+        # Only log the first bad hash of each operator until the next flush
+        if not operators[data['operator']]:
+            logger.warning(
+                'Bad hash received from %s:%s, operator %s taxi %s',
+                *from_addr, data['operator'], data['taxi']
+            )
+
+        if not self.badhash_count:
+            self.badhash_deadline = time.monotonic() + self.badhash_flush_interval
+        self.badhash_count += 1
+        operators[data['operator']] += 1
+        taxis[data['taxi']] += 1
+        ips[from_addr[0]] += 1
         return False
 
+    def badhash_timeout(self):
+        """Time in seconds before bad hash counters must be stored, or None if
+        no bad hash was counted."""
+        if not self.badhash_count:
+            return None
+        if self.badhash_count >= self.badhash_flush_threshold:
+            return 0
+        return max(0, self.badhash_deadline - time.monotonic())
+
+    def flush_badhash(self, pipe, force=False):
+        """Queue the ZINCRBY of the bad hash counters in pipe, if the flush
+        interval is over, if the threshold is reached or if force is set."""
+        if not self.badhash_count or (not force and self.badhash_timeout() > 0):
+            return
+
+        for key, counter in self.badhash.items():
+            for member, count in counter.items():
+                self.run_redis_action(pipe, 'ZINCRBY', key, count, member)
+
+        for operator, count in self.badhash['badhash_operators'].items():
+            if count > 1:
+                logger.warning('%s bad hashes received for operator %s', count, operator)
+
+        self.badhash = {key: collections.Counter() for key in BADHASH_KEYS}
+        self.badhash_count = 0
+        self.badhash_deadline = None
+
     @staticmethod
     def validate_convert_coordinates(data):
-        lon, lat = str(data['lon']), str(data['lat'])
-        # Accept the French decimal format
-        lon, lat = lon.replace(',', '.'), lat.replace(',', '.')
+        lon, lat = data['lon'], data['lat']
         try:
+            # Accept the French decimal format
+            if isinstance(lon, str):
+                lon = lon.replace(',', '.')
+            if isinstance(lat, str):
+                lat = lat.replace(',', '.')
             data['lon'], data['lat'] = float(lon), float(lat)
-        except ValueError:
+        except (ValueError, OverflowError):
             return False
         return -90 <= data['lat'] <= 90 and -180 <= data['lon'] <= 180
 
+    def update_shedding(self):
+        """Start or stop shedding positions, depending on the load."""
+        if self.shed_cache is None or self.load is None:
+            return
+        load = self.load()
+        if not self.shedding and load >= self.shed_high_water:
+            self.shedding = True
+            logger.warning('Queue %d%% full, drop positions of taxis whose status did not change', load * 100)
+        elif self.shedding and load < self.shed_high_water / 2:
+            self.shedding = False
+            logger.warning('Queue %d%% full, stop dropping positions', load * 100)
+
+    def shed(self, data):
+        """Return True if data must be dropped because the worker is shedding
+        load, and data has the same status as the last position of the taxi
+        accepted recently."""
+        if not self.shedding:
+            return False
+        last = self.shed_cache.get((data['taxi'], data['operator']))
+        if last is None or time.monotonic() - last[1] > self.shed_max_age:
+            self.counters.incr('shed_kept_not_seen')
+            return False
+        if last[0] != data['status']:
+            self.counters.incr('shed_kept_status_change')
+            return False
+        self.counters.incr('shed_same_status')
+        return True
+
     def parse_message(self, b_message, from_addr):
-        try:
-            message = b_message.decode('utf-8')
-        except UnicodeDecodeError:
-            logger.warning('Invalid UTF-8 message received from %s:%s data: %s', *from_addr, b_message)
-            return None
+        """Decode a JSON or binary message, and validate it. Binary messages
+        always have the fields and the types of the schema."""
+        if is_binary(b_message):
+            try:
+                return decode_binary(b_message)
+            except ValueError as exc:
+                self.counters.incr('decode_rejected')
+                self.rejections.add(
+                    'binary', None, from_addr,
+                    'Badly formatted binary message received from %s:%s: %s', *from_addr, exc
+                )
+                return None
 
+        # orjson decodes and checks UTF-8 itself, the message is only decoded
+        # here to log errors.
         try:
-            data = json.loads(message)
+            data = json.loads(b_message)
         except ValueError:
-            logger.warning('Badly formatted JSON received from %s:%s: %s', *from_addr, message)
+            self.counters.incr('decode_rejected')
+            try:
+                message = b_message.decode('utf-8')
+            except UnicodeDecodeError:
+                self.rejections.add(
+                    'utf8', None, from_addr,
+                    'Invalid UTF-8 message received from %s:%s data: %s', *from_addr, b_message
+                )
+                return None
+            self.rejections.add(
+                'json', None, from_addr,
+                'Badly formatted JSON received from %s:%s: %s', *from_addr, message
+            )
             return None
 
         try:
             jsonschema.validate(data)
         except jsonschema.JsonSchemaValueException as exc:
-            logger.warning(
-                'Invalid request received from %s:%s: %s, data: %s',
-                *from_addr,
-                exc.message,
-                data
-            )
-            return None
-
-        if not self.validate_convert_coordinates(data):
-            logger.warning(
-                'Invalid coordinates: %s %s from %s',
-                data['lon'], data['lat'], data['operator']
+            self.counters.incr('schema_rejected')
+            operator = data.get('operator') if isinstance(data, dict) else None
+            self.rejections.add(
+                'schema', operator if isinstance(operator, str) else None, from_addr,
+                'Invalid request received from %s:%s: %s, data: %s', *from_addr, exc.message, data
             )
             return None
         return data
@@ -151,12 +441,14 @@ class Worker:
         try:
             action(*params)
         except socket.error:
+            self.counters.incr('redis_errors')
             logger.error(
                 'Error while running redis action %s %s',
                 action.__name__.upper(),
                 ' '.join([str(param) for param in params])
             )
         except RedisError as e:
+            self.counters.incr('redis_errors')
             logger.error(
                 'Error while running redis action %s %s %s',
                 action.__name__.upper(),
@@ -164,39 +456,88 @@ class Worker:
                 e
             )
 
+    def has_moved(self, data):
+        """Return True if the taxi moved more than min_distance meters since
+        the last position written, or if its status changed."""
+        if self.movement_cache is None:
+            return True
+
+        key = (data['taxi'], data['operator'])
+        lat, lon = float(data['lat']), float(data['lon'])
+        now = time.monotonic()
+
+        last = self.movement_cache.get(key)
+        if last is not None:
+            last_lat, last_lon, last_status, written_at = last
+            # Equirectangular approximation, precise enough for short distances
+            x = math.radians(lon - last_lon) * math.cos(math.radians((lat + last_lat) / 2))
+            y = math.radians(lat - last_lat)
+            if (
+                math.hypot(x, y) * EARTH_RADIUS < self.min_distance
+                and data['status'] == last_status
+                and now - written_at < self.movement_max_age
+            ):
+                return False
+
+        self.movement_cache[key] = (lat, lon, data['status'], now)
+        return True
+
+    @staticmethod
+    def taxi_hash_value(data):
+        return f"{data['timestamp']} {data['lat']} {data['lon']} {data['status']} {data['device']} {data['version']}"
+
+    def write_flags(self, data):
+        """Return (write_hset, write_geoindex): whether the taxi hash and the
+        geoindexes must be updated."""
+        moved = self.has_moved(data)
+        if not moved:
+            self.counters.incr('geoadd_suppressed')
+            if self.suppress_hset:
+                self.counters.incr('hset_suppressed')
+        return moved or not self.suppress_hset, moved
+
     def update_redis(self, pipe, data, from_addr):
         now = int(time.time())
+        write_hset, write_geoindex = self.write_flags(data)
+
+        if self.resp_writer is not None:
+            self.resp_writer.add_position(data, now, write_hset, write_geoindex)
+            return
 
         # HSET taxi:<id>
-        self.run_redis_action(
-            pipe,
-            'HSET',
-            f"taxi:{data['taxi']}",
-            data['operator'],
-            f"{data['timestamp']} {data['lat']} {data['lon']} {data['status']} {data['device']} {data['version']}"
-        )
-        # GEOADD geoindex
-        self.run_redis_action(
-            pipe,
-            'GEOADD',
-            'geoindex',
-            (
-                data['lon'],
-                data['lat'],
-                data['taxi']
+        if write_hset:
+            self.run_redis_action(
+                pipe,
+                'HSET',
+                f"taxi:{data['taxi']}",
+                data['operator'],
+                self.taxi_hash_value(data)
             )
-        )
-        # GEOADD geoindex_2
-        self.run_redis_action(
-            pipe,
-            'GEOADD',
-            'geoindex_2',
-            (
-                data['lon'],
-                data['lat'],
-                f"{data['taxi']}:{data['operator']}"
+
+        if write_geoindex:
+            # GEOADD geoindex
+            self.run_redis_action(
+                pipe,
+                'GEOADD',
+                'geoindex',
+                (
+                    data['lon'],
+                    data['lat'],
+                    data['taxi']
+                )
             )
-        )
+            # GEOADD geoindex_2
+            self.run_redis_action(
+                pipe,
+                'GEOADD',
+                'geoindex_2',
+                (
+                    data['lon'],
+                    data['lat'],
+                    f"{data['taxi']}:{data['operator']}"
+                )
+            )
+
         # ZADD timestamps
         self.run_redis_action(
             pipe,
@@ -212,33 +553,365 @@ class Worker:
             {data['taxi']: now}
         )
 
-    def handle_messages(self, msg_queue):
-        logger.info('Worker started!')
+    def run_update_script(self, pipe, positions):
+        """Queue in pipe a single EVALSHA of UPDATE_SCRIPT storing positions."""
+        keys = ['geoindex', 'geoindex_2', 'timestamps', 'timestamps_id']
+        args = [int(time.time())]
 
-        # SIGUSR1 can be sent on the master process to display the queue size.
-        # Let's ignore the signal on workers in case the administrator sent the
-        # signal on the worker PID by mistake.
-        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        for data in positions:
+            write_hset, write_geoindex = self.write_flags(data)
+            # An error in the script would abort the following positions
+            if write_geoindex and abs(float(data['lat'])) > GEO_LAT_LIMIT:
+                logger.error('Invalid latitude for GEOADD: %s from %s', data['lat'], data['operator'])
+                write_geoindex = False
 
-        while True:
+            keys.append(f"taxi:{data['taxi']}")
+            args.extend((
+                data['taxi'],
+                data['operator'],
+                data['lon'],
+                data['lat'],
+                self.taxi_hash_value(data),
+                write_geoindex | write_hset << 1,
+            ))
+
+        self.run_redis_action(pipe, 'EVALSHA', UPDATE_SCRIPT_SHA, len(keys), *keys, *args)
+
+    def store_position(self, pipe, data, from_addr):
+        """Queue in pipe the commands storing the position, or keep it until
+        the end of the batch if positions are stored with a script per batch."""
+        if self.redis_script == 'batch':
+            self.script_positions.append(data)
+        elif self.redis_script == 'position':
+            self.run_update_script(pipe, [data])
+        else:
+            self.update_redis(pipe, data, from_addr)
+
+    @staticmethod
+    def failed_scripts(commands, results):
+        """Return the commands which failed because the script isn't loaded in
+        redis, for example after SCRIPT FLUSH or a restart of redis. commands
+        is the command stack of the pipeline, copied before execution."""
+        return [
+            args for (args, _), result in zip(commands, results)
+            if isinstance(result, NoScriptError)
+        ]
+
+    def execute_pipeline(self, pipe):
+        """Execute pipe and log errors. Scripts which aren't loaded in redis
+        are loaded, and run again."""
+        commands = list(pipe.command_stack)
+        start = time.perf_counter()
+        results = pipe.execute(raise_on_error=False)
+
+        retries = self.failed_scripts(commands, results)
+        if retries:
+            logger.warning('Script not loaded in redis, load it and run %s commands again', len(retries))
+            self.redis.script_load(UPDATE_SCRIPT)
+            pipe = self.redis.pipeline()
+            for args in retries:
+                pipe.execute_command(*args)
+            results = [result for result in results if not isinstance(result, NoScriptError)]
+            results.extend(pipe.execute(raise_on_error=False))
+
+        self.counters.observe('redis', time.perf_counter() - start)
+        self.log_redis_errors(results)
+
+    def execute_resp_writer(self):
+        """Send the commands of the RESP writer and log errors."""
+        start = time.perf_counter()
+        results = self.resp_writer.execute()
+        self.counters.observe('redis', time.perf_counter() - start)
+        self.log_redis_errors(results)
+
+    def log_redis_errors(self, results):
+        """Log and count the errors of the results of a pipeline."""
+        for result in results:
+            if isinstance(result, Exception):
+                self.counters.incr('redis_errors')
+                logger.error('Error while running redis pipeline: %s', result)
+
+    @staticmethod
+    def position_time(data):
+        """Timestamp of the position as a float, used to find the most recent
+        position. Positions with an invalid timestamp are considered as the
+        most recent."""
+        try:
+            return float(data['timestamp'])
+        except ValueError:
+            return float('inf')
+
+    def throttle(self, data):
+        """Return True if the position must not be stored, because it is older
+        than the last position of the taxi, or too close in time."""
+        if self.throttle_cache is None:
+            return False
+
+        timestamp = self.position_time(data)
+        if math.isinf(timestamp):
+            return False
+
+        key = (data['taxi'], data['operator'])
+        last = self.throttle_cache.get(key)
+        if last is not None:
+            self.counters.incr('throttle_hits')
+            if timestamp < last:
+                self.counters.incr('reordered')
+                return True
+            if timestamp - last < self.operators_min_interval.get(data['operator'], self.min_interval):
+                self.counters.incr('throttled')
+                return True
+
+        self.throttle_cache[key] = timestamp
+        return False
+
+    def coalesce_position(self, data, from_addr):
+        """Keep the position, unless a more recent position of the same taxi
+        and operator is already waiting to be stored."""
+        if not self.positions:
+            self.positions_deadline = time.monotonic() + self.coalesce_timeout
+
+        key = (data['taxi'], data['operator'])
+        previous = self.positions.get(key)
+        if previous and self.position_time(previous[0]) > self.position_time(data):
+            return
+        self.positions[key] = (data, from_addr)
+
+    def positions_timeout(self):
+        """Time in seconds before coalesced positions must be stored, or None
+        if there is no position waiting."""
+        if not self.positions:
+            return None
+        return max(0, self.positions_deadline - time.monotonic())
+
+    def flush_positions(self, pipe, force=False):
+        """Queue the redis commands of the coalesced positions in pipe, if
+        the coalescing window is over or if force is set."""
+        if not self.positions or (not force and self.positions_timeout() > 0):
+            return
+
+        for data, from_addr in self.positions.values():
+            self.store_position(pipe, data, from_addr)
+        self.positions = {}
+        self.positions_deadline = None
+
+    def pending_timeout(self):
+        """Time in seconds before data kept in memory must be stored in redis,
+        or None if there is nothing to store. Captured datagrams are flushed
+        at the same time."""
+        capture_timeout = self.capture.timeout() if self.capture else None
+        timeouts = [
+            timeout for timeout in (
+                self.positions_timeout(), self.badhash_timeout(), self.rejections.timeout(), capture_timeout
+            )
+            if timeout is not None
+        ]
+        return min(timeouts, default=None)
+
+    def wait_timeout(self):
+        """Maximum time in seconds to wait for messages: until data kept in
+        memory must be stored, and at most STOP_CHECK_INTERVAL."""
+        timeout = self.pending_timeout()
+        return STOP_CHECK_INTERVAL if timeout is None else min(timeout, STOP_CHECK_INTERVAL)
+
+    def flush_pending(self, pipe, force=False):
+        """Queue in pipe the redis commands of the data kept in memory:
+        coalesced positions and bad hash counters if they are due or if force
+        is set, and positions waiting to be stored by the script. Log the
+        summary of rejected messages, and flush captured datagrams."""
+        self.flush_positions(pipe, force=force)
+        self.flush_badhash(pipe, force=force)
+        self.rejections.flush(force=force)
+        if self.capture:
+            self.capture.flush(force=force)
+
+        if self.script_positions:
+            self.run_update_script(pipe, self.script_positions)
+            self.script_positions = []
+
+    def get_batch(self, msg_queue):
+        """Block until an item is available in msg_queue, then read items
+        until batch_size messages are read. Items are lists of (message,
+        from_addr). Wait at most batch_timeout seconds for the batch to fill
+        up, and never wait once the deadline is reached: items already in the
+        queue are still taken.
+
+        If coalesced positions or bad hash counters are waiting, do not block
+        beyond the time they must be stored, and return an empty batch
+        instead."""
+        try:
+            batch = list(msg_queue.get(timeout=self.wait_timeout()))
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_timeout
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.extend(msg_queue.get(timeout=timeout))
+                else:
+                    batch.extend(msg_queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def recv_batch(self, sock):
+        """Block until a datagram is received, then read up to batch_size
+        datagrams from sock, waiting at most batch_timeout seconds. Like
+        get_batch, return an empty batch when data kept in memory must be
+        stored. Once the worker is stopping, do not wait for a datagram."""
+        sock.settimeout(0 if self.stopping else self.wait_timeout())
+        try:
+            batch = [sock.recvfrom(MAX_DATAGRAM_SIZE)]
+        except (BlockingIOError, socket.timeout):
+            return []
+        deadline = time.monotonic() + self.batch_timeout
+
+        while len(batch) < self.batch_size:
+            # A timeout of 0 makes the socket non-blocking
+            sock.settimeout(max(0, deadline - time.monotonic()))
+            try:
+                batch.append(sock.recvfrom(MAX_DATAGRAM_SIZE))
+            except (BlockingIOError, socket.timeout):
+                break
+        self.counters.incr('received', len(batch))
+        if self.capture:
+            self.capture.write(batch)
+        return batch
+
+    def handle_message(self, pipe, message, from_addr):
+        """Parse and check a message, then queue its redis commands in pipe.
+        The stages of one message every stage_timing_sample are timed."""
+        counters = self.counters
+        self.timing_countdown -= 1
+        timed = not self.timing_countdown
+        if timed:
+            self.timing_countdown = self.stage_timing_sample
+            start = time.perf_counter()
+
+        data = self.parse_message(message, from_addr)
+        if timed:
+            end = time.perf_counter()
+            counters.observe('parse', end - start)
+        if not data:
+            return
+        self.parsed += 1
+
+        logger.debug('Received from %s:%s: %s', *from_addr, data)
+
+        # Shed before the hash is computed, to save the most work
+        if self.shed(data):
+            return
+
+        valid_hash = self.check_hash(data, from_addr)
+        if timed:
+            start, end = end, time.perf_counter()
+            counters.observe('hash', end - start)
+        if not valid_hash:
+            return
+
+        # Coordinates are converted once the hash, computed on the original
+        # values, is verified.
+        if not self.validate_convert_coordinates(data):
+            counters.incr('coordinates_rejected')
+            self.rejections.add(
+                'coordinates', data['operator'], from_addr,
+                'Invalid coordinates: %s %s from %s', data['lon'], data['lat'], data['operator']
+            )
+            return
+
+        if self.shed_cache is not None:
+            self.shed_cache[(data['taxi'], data['operator'])] = (data['status'], time.monotonic())
+
+        if timed:
+            start = time.perf_counter()
+            self.send_fluent(data)
+            counters.observe('fluent', time.perf_counter() - start)
+        else:
+            self.send_fluent(data)
+
+        if self.throttle(data):
+            return
+
+        if self.coalesce_timeout:
+            self.coalesce_position(data, from_addr)
+        else:
+            self.store_position(pipe, data, from_addr)
+
+    def queue_batch(self, pipe, batch):
+        """Queue the redis commands of a list of (message, from_addr) in pipe.
+        An invalid message doesn't prevent the other messages of the batch
+        from being stored."""
+        self.update_shedding()
+        self.parsed = 0
+
+        for message, from_addr in batch:
             try:
-                message, from_addr = msg_queue.get()
+                self.handle_message(pipe, message, from_addr)
+            except Exception as exc:
+                logger.error('Exception %s, continue execution', str(exc))
 
-                data = self.parse_message(message, from_addr)
-                if not data:
-                    continue
+        if batch:
+            self.counters.incr('handled', len(batch))
+            self.counters.incr('parsed', self.parsed)
 
-                logger.debug('Received from %s:%s: %s', *from_addr, data)
+    def handle_batch(self, batch):
+        """Process a list of (message, from_addr) and send all the redis
+        commands in a single pipeline."""
+        pipe = self.redis.pipeline()
+        self.queue_batch(pipe, batch)
+        self.flush_pending(pipe)
+        self.execute(pipe)
+
+    def execute(self, pipe):
+        """Send the commands of the RESP writer and of pipe, if any."""
+        if self.resp_writer is not None and len(self.resp_writer):
+            self.execute_resp_writer()
+        if len(pipe):
+            self.execute_pipeline(pipe)
 
-                if not self.check_hash(data, from_addr):
-                    continue
+    def handle_messages(self, msg_queue, row=None):
+        logger.info('Worker started!')
+        self.start(row)
+        self.setup_signals()
 
-                self.send_fluent(data)
-                pipe = self.redis.pipeline()
-                self.update_redis(pipe, data, from_addr)
-                pipe.execute()
-            # Raised when parent calls os.kill()
-            except KeyboardInterrupt:
-                return
+        while not self.stopping:
+            try:
+                batch = self.get_batch(msg_queue)
+                # The time spent handling messages tells the supervisor how
+                # busy workers are.
+                start = time.perf_counter()
+                # A single queue item can hold more than batch_size messages.
+                # An empty batch is still handled to flush data kept in memory.
+                for idx in range(0, max(1, len(batch)), self.batch_size):
+                    self.handle_batch(batch[idx:idx + self.batch_size])
+                self.counters.incr('worker_busy_us', int((time.perf_counter() - start) * 1e6))
             except Exception as exc:
                 logger.error('Exception %s, continue execution', str(exc))
+        self.shutdown()
+
+    def handle_socket(self, sock, row=None):
+        """Like handle_messages, but receive messages directly from sock."""
+        logger.info('Worker started on %s:%s!', *sock.getsockname())
+        self.start(row)
+        self.setup_signals()
+
+        while not self.stopping:
+            try:
+                batch = self.recv_batch(sock)
+                start = time.perf_counter()
+                self.handle_batch(batch)
+                self.counters.incr('worker_busy_us', int((time.perf_counter() - start) * 1e6))
+            except Exception as exc:
+                logger.error('Exception %s, continue execution', str(exc))
+
+        # Datagrams waiting in the socket buffer would be lost once the
+        # socket is closed
+        while True:
+            batch = self.recv_batch(sock)
+            if not batch:
+                break
+            self.handle_batch(batch)
+        sock.close()
+        self.shutdown()
@@ -7,8 +7,10 @@ import socket
 import time
 import uuid
 
+from geotaxi.wire import encode_binary
 
-def run(host, port, num, sleep, api_key, operator):
+
+def run(host, port, num, sleep, api_key, operator, message_format='json'):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
     taxi_id = str(uuid.uuid4())
@@ -47,10 +49,12 @@ def run(host, port, num, sleep, api_key, operator):
 
         data['hash'] = h
 
-        sock.sendto(
-            json.dumps(data).encode('utf8'),
-            (host, port)
-        )
+        if message_format == 'binary':
+            message = encode_binary(data)
+        else:
+            message = json.dumps(data).encode('utf8')
+
+        sock.sendto(message, (host, port))
 
         if sleep > 0:
             time.sleep(sleep)
@@ -86,8 +90,13 @@ def main():
         help='Operator name. Must be the owner of --api-key if authentication is enabled.'
     )
 
+    parser.add_argument(
+        '--format', choices=('json', 'binary'), default='json',
+        help='Encoding of messages'
+    )
+
     args = parser.parse_args()
-    run(args.host, args.port, args.num, args.sleep, args.api_key, args.operator)
+    run(args.host, args.port, args.num, args.sleep, args.api_key, args.operator, args.format)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""Send the datagrams of capture files written by geotaxi --capture-path,
+keeping the original intervals between datagrams."""
+
+import argparse
+import hashlib
+import heapq
+import json
+import socket
+import time
+
+from geotaxi.capture import read_capture
+from geotaxi.wire import decode_binary, encode_binary, is_binary
+
+
+def shift_timestamp(data, shift, api_keys):
+    """Add shift seconds to the timestamp of a JSON or binary message. If the
+    API key of the operator is known, compute the hash again."""
+    binary = is_binary(data)
+    try:
+        message = decode_binary(data) if binary else json.loads(data)
+        timestamp = int(float(message['timestamp']) + shift)
+    except (ValueError, KeyError, TypeError):
+        return data
+    # Keep the type of the original timestamp
+    message['timestamp'] = str(timestamp) if isinstance(message['timestamp'], str) else timestamp
+
+    api_key = api_keys.get(message.get('operator'))
+    if api_key:
+        message['hash'] = hashlib.sha1(''.join(str(message.get(field, '')) for field in (
+            'timestamp', 'operator', 'taxi', 'lat', 'lon', 'device', 'status', 'version'
+        )).encode('utf8') + api_key.encode('utf8')).hexdigest()
+    if binary:
+        return encode_binary(message)
+    return json.dumps(message).encode('utf8')
+
+
+def run(paths, host, port, speed, shift_timestamps, api_keys, max_sockets):
+    records = heapq.merge(*(read_capture(path) for path in paths), key=lambda record: record[0])
+
+    # A socket per source address, so datagrams are spread between geotaxi
+    # workers like the original traffic.
+    sockets = {}
+    shared = []
+    start = capture_start = None
+    count = 0
+
+    for timestamp, data, source in records:
+        if start is None:
+            start, capture_start = time.monotonic(), timestamp
+            shift = time.time() - timestamp
+
+        if speed:
+            delay = start + (timestamp - capture_start) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        if shift_timestamps:
+            data = shift_timestamp(data, shift, api_keys)
+
+        sock = sockets.get(source)
+        if sock is None:
+            if len(sockets) < max_sockets:
+                sock = sockets[source] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                shared.append(sock)
+            else:
+                sock = shared[hash(source) % len(shared)]
+        sock.sendto(data, (host, port))
+        count += 1
+
+    elapsed = time.monotonic() - start if start is not None else 0
+    print('%s datagrams sent in %.2f seconds' % (count, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        'paths', nargs='+',
+        help='Capture files. Datagrams of several files are merged by arrival time'
+    )
+    parser.add_argument(
+        '--host', type=str, default='127.0.0.1',
+        help='geotaxi host'
+    )
+    parser.add_argument(
+        '--port', type=int, default=8080,
+        help='geotaxi port'
+    )
+    parser.add_argument(
+        '--speed', type=float, default=1,
+        help='Replay speed: 1 keeps the original timing, 2 is twice faster. Set to 0 to send as fast as possible'
+    )
+    parser.add_argument(
+        '--shift-timestamps', action='store_true',
+        help='Shift the timestamps of messages, as if the first datagram was sent now'
+    )
+    parser.add_argument(
+        '--api-key', type=str, action='append', default=[], metavar='OPERATOR=KEY',
+        help='With --shift-timestamps, compute the hash of the messages of OPERATOR again. Can be repeated'
+    )
+    parser.add_argument(
+        '--max-sockets', type=int, default=1000,
+        help='Maximum number of sockets, one per source address of the capture'
+    )
+
+    args = parser.parse_args()
+    api_keys = dict(value.split('=', 1) for value in args.api_key)
+    run(args.paths, args.host, args.port, args.speed, args.shift_timestamps, api_keys, args.max_sockets)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import os
+
+import fakeredis
+import pytest
+
+from geotaxi.capture import CaptureWriter, MAGIC, read_capture
+from geotaxi.worker import Worker
+
+
+def test_write_read(tmp_path):
+    writer = CaptureWriter(str(tmp_path / 'capture'))
+    writer.write([(b'message 1', ('127.0.0.1', 1234)), (b'message 2', ('10.0.0.2', 4321))])
+    writer.write([(b'', ('127.0.0.1', 1234))])
+    writer.close()
+
+    assert writer.path == str(tmp_path / ('capture.%s' % os.getpid()))
+    records = list(read_capture(writer.path))
+    assert [(data, source) for _, data, source in records] == [
+        (b'message 1', ('127.0.0.1', 1234)),
+        (b'message 2', ('10.0.0.2', 4321)),
+        (b'', ('127.0.0.1', 1234)),
+    ]
+    assert records[0][0] <= records[2][0]
+
+    # Truncated record
+    with open(writer.path, 'ab') as capture:
+        capture.write(b'\x00' * 5)
+    assert len(list(read_capture(writer.path))) == 3
+
+
+def test_rotate(tmp_path):
+    writer = CaptureWriter(str(tmp_path / 'capture'), max_size=len(MAGIC) + 100, backups=2)
+    for idx in range(5):
+        writer.write([(b'%d' % idx * 50, ('127.0.0.1', 1234))])
+    writer.close()
+
+    # Each file holds a single record, the oldest one is removed
+    assert sorted(os.listdir(tmp_path)) == [
+        os.path.basename(writer.path + suffix) for suffix in ('', '.1', '.2')
+    ]
+    assert [data for _, data, _ in read_capture(writer.path)] == [b'4' * 50]
+    assert [data for _, data, _ in read_capture(writer.path + '.2')] == [b'2' * 50]
+
+
+def test_flush_idle(tmp_path):
+    worker = Worker(fakeredis.FakeRedis(), capture=CaptureWriter(str(tmp_path / 'capture')))
+    capture = worker.capture
+    capture.write([(b'message 1', ('127.0.0.1', 1234))])
+    # Flushed by the first write, then buffered for flush_interval
+    capture.write([(b'message 2', ('127.0.0.1', 1234))])
+    assert len(list(read_capture(capture.path))) == 1
+    assert 0 < worker.pending_timeout() <= 1
+
+    # Flushed once due, even if no datagram is received
+    capture.flushed_at -= 1
+    worker.handle_batch([])
+    assert len(list(read_capture(capture.path))) == 2
+    assert capture.timeout() is None
+
+    # And closed when the worker stops
+    capture.write([(b'message 3', ('127.0.0.1', 1234))])
+    worker.shutdown()
+    assert capture.file is None
+    assert len(list(read_capture(capture.path))) == 3
+
+
+def test_read_invalid(tmp_path):
+    path = tmp_path / 'invalid'
+    path.write_bytes(b'not a capture')
+    with pytest.raises(ValueError):
+        list(read_capture(str(path)))
@@ -0,0 +1,122 @@
+import socket
+
+import msgpack
+
+from geotaxi.fluent import FluentForwarder
+
+
+def fluentd_server():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    return server
+
+
+def read_records(server, count):
+    conn, _ = server.accept()
+    conn.settimeout(5)
+    unpacker = msgpack.Unpacker(raw=False)
+    records = []
+    with conn:
+        while len(records) < count:
+            unpacker.feed(conn.recv(4096))
+            for tag, events in unpacker:
+                records.extend((tag, record) for _, record in events)
+    return records
+
+
+class TestFluentForwarder:
+
+    def test_send(self):
+        server = fluentd_server()
+        forwarder = FluentForwarder('geotaxi', *server.getsockname(), chunk_size=2)
+        try:
+            for idx in range(3):
+                forwarder.emit('position', {'taxi': 'taxi%d' % idx})
+            assert forwarder.counters.get('fluent_queued') == 3
+
+            # Records are sent in chunks of Forward mode messages
+            assert forwarder.send(forwarder.get_chunk())
+            assert forwarder.send(forwarder.get_chunk())
+            assert read_records(server, 3) == [
+                ('geotaxi.position', {'taxi': 'taxi0'}),
+                ('geotaxi.position', {'taxi': 'taxi1'}),
+                ('geotaxi.position', {'taxi': 'taxi2'}),
+            ]
+            assert forwarder.counters.get('fluent_sent') == 3
+        finally:
+            server.close()
+
+    def test_spill_replay(self, tmp_path):
+        server = fluentd_server()
+        host, port = server.getsockname()
+        server.close()
+
+        forwarder = FluentForwarder(
+            'geotaxi', host, port, buffer_size=1, spill_path=str(tmp_path / 'spill'), retry_interval=0
+        )
+        forwarder.emit('position', {'taxi': 'taxi0'})
+        # The buffer is full, the record is spilled
+        forwarder.emit('position', {'taxi': 'taxi1'})
+        assert forwarder.counters.get('fluent_spilled') == 1
+
+        # fluentd is down, the chunk is spilled
+        entries = forwarder.get_chunk()
+        assert not forwarder.send(entries)
+        forwarder.spill(entries)
+        assert forwarder.counters.get('fluent_spilled') == 2
+
+        # fluentd is up again, records are replayed
+        server = fluentd_server()
+        forwarder.port = server.getsockname()[1]
+        try:
+            assert forwarder.send([])
+            forwarder.replay()
+            assert read_records(server, 2) == [
+                ('geotaxi.position', {'taxi': 'taxi1'}),
+                ('geotaxi.position', {'taxi': 'taxi0'}),
+            ]
+            assert list(tmp_path.iterdir()) == []
+            assert forwarder.counters.get('fluent_sent') == 2
+        finally:
+            server.close()
+
+    def test_drop(self):
+        forwarder = FluentForwarder('geotaxi', buffer_size=1)
+        forwarder.emit('position', {'taxi': 'taxi0'})
+        forwarder.emit('position', {'taxi': 'taxi1'})
+        assert forwarder.counters.get('fluent_queued') == 1
+        assert forwarder.counters.get('fluent_spilled') == 0
+        assert forwarder.counters.get('fluent_dropped') == 1
+
+    def test_replay_orphans(self, tmp_path):
+        server = fluentd_server()
+        host, port = server.getsockname()
+        server.close()
+
+        spill_path = str(tmp_path / 'spill')
+        stopped = FluentForwarder('geotaxi', host, port, flush_interval=0.01, spill_path=spill_path)
+        stopped.start()
+        stopped.emit('position', {'taxi': 'taxi0'})
+        stopped.emit('position', {'taxi': 'taxi1'})
+
+        server = fluentd_server()
+        forwarder = FluentForwarder('geotaxi', *server.getsockname(), spill_path=spill_path)
+        try:
+            # The spill file is locked until the process stops
+            stopped.thread.join(0.5)
+            assert forwarder.connect()
+            forwarder.replay_orphans()
+            assert len(list(tmp_path.iterdir())) == 1
+
+            # Records spilled by a stopped process are replayed by another one
+            stopped.close()
+            forwarder.replay_orphans()
+            assert read_records(server, 2) == [
+                ('geotaxi.position', {'taxi': 'taxi0'}),
+                ('geotaxi.position', {'taxi': 'taxi1'}),
+            ]
+            assert list(tmp_path.iterdir()) == []
+            assert forwarder.counters.get('fluent_sent') == 2
+        finally:
+            server.close()
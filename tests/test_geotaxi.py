@@ -1,10 +1,21 @@
+import asyncio
+import multiprocessing
+import queue
+import socket
+import time
 from unittest import mock
 
 import fakeredis
+import orjson as json
 import pytest
 import requests
 
+from geotaxi.aio import GeotaxiProtocol
+from geotaxi.geotaxi import bind_socket, recv_datagrams
+from geotaxi.users import UsersTable
+from geotaxi.wire import encode_binary
 from geotaxi.worker import Worker
+from tests.utils import make_message
 
 
 class MockFluent:
@@ -49,6 +60,54 @@ class TestWorker:
         assert 'user1' in users and users['user1'] == 'key1'
         assert 'user2' in users and users['user2'] == 'key2'
 
+    def test_refresh_users(self, requests_mock):
+        requests_mock.get('http://api.tests/users', json={
+            'data': [
+                {'name': 'user1', 'apikey': 'key1'},
+            ]
+        })
+        worker = Worker(
+            None,
+            auth_enabled=True,
+            api_url='http://api.tests',
+            api_key='f4k3'
+        )
+        assert worker.users.get('user1') == b'key1'
+
+        # Key rotated
+        requests_mock.get('http://api.tests/users', json={
+            'data': [
+                {'name': 'user1', 'apikey': 'key2'},
+            ]
+        })
+        worker.refresh_users()
+        assert worker.users.get('user1') == b'key2'
+
+        # Refresh failed, the last table is kept
+        requests_mock.get('http://api.tests/users', status_code=500)
+        worker.refresh_users()
+        assert worker.users.get('user1') == b'key2'
+        assert worker.stats()['users_refresh_failures'] == 1
+
+    def test_users_table_shared(self):
+        users = UsersTable({'user1': 'key1'})
+        updated = multiprocessing.Event()
+        results = multiprocessing.Queue()
+
+        def read_users():
+            results.put(users.get('user1'))
+            updated.wait(5)
+            results.put(users.get('user1'))
+
+        # The table is updated after the worker process started
+        proc = multiprocessing.Process(target=read_users)
+        proc.start()
+        assert results.get(timeout=5) == b'key1'
+        users.update({'user1': 'key2'})
+        updated.set()
+        assert results.get(timeout=5) == b'key2'
+        proc.join(5)
+
     def test_check_hash(self, requests_mock):
         requests_mock.get('http://api.tests/users', json={
             'data': [
@@ -88,6 +147,16 @@ class TestWorker:
         }, ('127.0.2.3', 9999))
         assert is_valid is False
 
+        is_valid = worker.check_hash({'operator': 'user2'}, ('127.0.2.3', 9999))
+        assert is_valid is False
+        assert worker.counters.get('unknown_user_rejected') == 1
+
+        # Bad hashes are counted in memory until the next flush
+        assert redis.keys() == []
+        pipe = redis.pipeline()
+        worker.flush_badhash(pipe, force=True)
+        pipe.execute()
+
         assert b'badhash_operators' in redis.keys()
         assert redis.zrange(b'badhash_operators', 0, -1, withscores=True) == [(b'user1', 1.0)]
 
@@ -97,6 +166,65 @@ class TestWorker:
         assert b'badhash_ips' in redis.keys()
         assert redis.zrange(b'badhash_ips', 0, -1, withscores=True) == [(b'127.0.2.3', 1.0)]
 
+    def test_handle_message_hash_original_values(self, requests_mock):
+        requests_mock.get('http://api.tests/users', json={
+            'data': [
+                {'name': 'user1', 'apikey': 'key1'},
+            ]
+        })
+        redis = fakeredis.FakeRedis()
+        worker = Worker(
+            redis,
+            auth_enabled=True,
+            api_url='http://api.tests',
+            api_key='f4k3'
+        )
+        # The hash is computed with "17" and "18", not with the converted
+        # coordinates 17.0 and 18.0.
+        message = make_message('taxi', lat='17', lon='18', hash='63f3d6cf5f25e96bd085aca81d715a695c9c36e2')
+        worker.handle_batch([(message, ('127.0.2.3', 9999))])
+
+        assert redis.hget('taxi:taxi', 'user1') == b'1 17.0 18.0 free mobile 1'
+        assert b'badhash_operators' not in redis.keys()
+
+    def test_flush_badhash(self, requests_mock):
+        requests_mock.get('http://api.tests/users', json={
+            'data': [
+                {'name': 'user1', 'apikey': 'key1'},
+            ]
+        })
+        redis = fakeredis.FakeRedis()
+        worker = Worker(
+            redis,
+            auth_enabled=True,
+            api_url='http://api.tests',
+            api_key='f4k3',
+            badhash_flush_interval=60,
+            badhash_flush_threshold=3
+        )
+
+        worker.handle_batch([
+            (make_message('taxi1'), ('127.0.2.3', 9999)),
+            (make_message('taxi1'), ('127.0.2.4', 9999)),
+        ])
+        # Neither the interval nor the threshold are reached
+        assert redis.keys() == []
+        assert 0 < worker.pending_timeout() <= 60
+
+        with mock.patch.object(worker, 'run_redis_action', wraps=worker.run_redis_action) as run_redis_action:
+            worker.handle_batch([
+                (make_message('taxi2'), ('127.0.2.3', 9999)),
+            ])
+        # A single ZINCRBY per member
+        assert run_redis_action.call_count == 5
+
+        assert worker.pending_timeout() is None
+        assert redis.zrange(b'badhash_operators', 0, -1, withscores=True) == [(b'user1', 3.0)]
+        assert redis.zrange(b'badhash_taxis_ids', 0, -1, withscores=True) == [(b'taxi2', 1.0), (b'taxi1', 2.0)]
+        assert redis.zrange(b'badhash_ips', 0, -1, withscores=True) == [
+            (b'127.0.2.4', 1.0), (b'127.0.2.3', 2.0)
+        ]
+
     def test_parse_message(self):
         worker = Worker(None)
         fromaddr = ('127.0.2.3', 8909)
@@ -135,6 +263,45 @@ class TestWorker:
             "hash": "b4dhash"
         }''', fromaddr), dict)
 
+    def test_parse_message_binary(self, requests_mock):
+        requests_mock.get('http://api.tests/users', json={
+            'data': [
+                {'name': 'user1', 'apikey': 'key1'},
+            ]
+        })
+        redis = fakeredis.FakeStrictRedis()
+        worker = Worker(redis, auth_enabled=True, api_url='http://api.tests', api_key='f4k3')
+        fromaddr = ('127.0.2.3', 8909)
+        message = {
+            'timestamp': '1',
+            'operator': 'user1',
+            'taxi': 'taxi',
+            'lat': '17',
+            'lon': '18',
+            'device': 'mobile',
+            'status': 'free',
+            'version': '1',
+            'hash': '63f3d6cf5f25e96bd085aca81d715a695c9c36e2'
+        }
+
+        # Decoded and hashed like JSON, the timestamp is an integer
+        data = worker.parse_message(encode_binary(message), fromaddr)
+        assert data == dict(worker.parse_message(json.dumps(message), fromaddr), timestamp=1)
+        assert worker.check_hash(data, fromaddr)
+
+        # Unknown version, truncated header, missing field, invalid UTF-8
+        assert worker.parse_message(b'\xc1\x01' + encode_binary(message)[2:], fromaddr) is None
+        assert worker.parse_message(encode_binary(message)[:6], fromaddr) is None
+        assert worker.parse_message(encode_binary(message).rpartition(b'\0')[0], fromaddr) is None
+        assert worker.parse_message(encode_binary(message) + b'\xff', fromaddr) is None
+        assert worker.counters.get('decode_rejected') == 4
+
+        with pytest.raises(ValueError):
+            encode_binary(dict(message, taxi='taxi\0'))
+
+        worker.handle_batch([(encode_binary(message), fromaddr)])
+        assert redis.hgetall('taxi:taxi') == {b'user1': b'1 17.0 18.0 free mobile 1'}
+
     def test_send_fluent(self):
         fluent = MockFluent()
         worker = Worker(None, fluent=fluent)
@@ -210,3 +377,370 @@ class TestWorker:
             'lat': "48,865 546 846 846 846",
         }
         assert not worker.validate_convert_coordinates(data)
+
+        # Integers, and out of range values
+        data = {'lon': 2, 'lat': '48'}
+        assert worker.validate_convert_coordinates(data)
+        assert data == {'lon': 2.0, 'lat': 48.0}
+        assert not worker.validate_convert_coordinates({'lon': 2, 'lat': 91})
+        assert not worker.validate_convert_coordinates({'lon': 10 ** 400, 'lat': 48})
+
+    def test_get_batch(self):
+        fromaddr = ('127.0.0.1', 1234)
+        msg_queue = queue.Queue()
+        for idx in range(5):
+            msg_queue.put([(b'message %d' % idx, fromaddr)])
+
+        worker = Worker(None, batch_size=3)
+        assert [message for message, _ in worker.get_batch(msg_queue)] == [
+            b'message 0', b'message 1', b'message 2'
+        ]
+        # Only two messages are left: do not wait for the third one
+        assert len(worker.get_batch(msg_queue)) == 2
+
+        # Without batching, queue items are read one by one
+        msg_queue.put([(b'message', fromaddr), (b'message', fromaddr)])
+        msg_queue.put([(b'message', fromaddr)])
+        assert len(Worker(None).get_batch(msg_queue)) == 2
+        assert len(Worker(None).get_batch(msg_queue)) == 1
+
+    def test_handle_batch(self):
+        redis = fakeredis.FakeRedis()
+        worker = Worker(redis, batch_size=10)
+        fromaddr = ('127.0.3.4', 9132)
+
+        # The invalid message in the middle is ignored, other messages are
+        # stored with a single pipeline.
+        with mock.patch.object(redis, 'pipeline', wraps=redis.pipeline) as pipeline:
+            worker.handle_batch([
+                (make_message('taxi1'), fromaddr),
+                (b'{badjson', fromaddr),
+                (make_message('taxi2'), fromaddr),
+            ])
+        assert pipeline.call_count == 1
+
+        assert sorted(redis.zrange(b'timestamps_id', 0, -1)) == [b'taxi1', b'taxi2']
+        assert b'user1' in redis.hgetall('taxi:taxi1')
+        assert b'user1' in redis.hgetall('taxi:taxi2')
+
+    def test_recv_batch(self):
+        server = bind_socket('127.0.0.1', 0, reuseport=True)
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for idx in range(5):
+                client.sendto(b'message %d' % idx, server.getsockname())
+
+            worker = Worker(None, batch_size=3, batch_timeout=0.01)
+            batch = worker.recv_batch(server)
+            assert [message for message, _ in batch] == [b'message 0', b'message 1', b'message 2']
+            assert batch[0][1] == ('127.0.0.1', client.getsockname()[1])
+
+            # Only two datagrams are left: do not wait more than batch_timeout
+            assert len(worker.recv_batch(server)) == 2
+        finally:
+            client.close()
+            server.close()
+
+    def test_coalesce_positions(self):
+        redis = fakeredis.FakeRedis()
+        worker = Worker(redis, batch_size=10, coalesce_timeout=60)
+        fromaddr = ('127.0.3.4', 9132)
+
+        worker.handle_batch([
+            (make_message('taxi1', timestamp='10', lat='48.1'), fromaddr),
+            (make_message('taxi1', timestamp='12', lat='48.3'), fromaddr),
+            # Out of order, older than the previous message
+            (make_message('taxi1', timestamp='11', lat='48.2'), fromaddr),
+            (make_message('taxi2', timestamp='10', lat='48.4'), fromaddr),
+        ])
+        # Nothing is stored until the end of the coalescing window
+        assert redis.keys() == []
+        assert 0 < worker.positions_timeout() <= 60
+
+        pipe = redis.pipeline()
+        worker.flush_positions(pipe, force=True)
+        pipe.execute()
+
+        assert worker.positions_timeout() is None
+        assert redis.hget('taxi:taxi1', 'user1').split()[:2] == [b'12', b'48.3']
+        assert redis.hget('taxi:taxi2', 'user1').split()[:2] == [b'10', b'48.4']
+
+    def test_handle_messages_stop(self):
+        redis = fakeredis.FakeRedis()
+        worker = Worker(redis, batch_size=10, coalesce_timeout=60)
+        message = make_message(timestamp='10', lat='48.1')
+
+        class StoppingQueue(queue.Queue):
+            # SIGTERM received while the batch is handled
+            def get(self, *args, **kwargs):
+                worker.stop()
+                return super().get(*args, **kwargs)
+
+        msg_queue = StoppingQueue()
+        msg_queue.put([(message, ('127.0.3.4', 9132))])
+        with mock.patch('geotaxi.worker.signal') as signal_mock:
+            worker.handle_messages(msg_queue, row=3)
+        # Ctrl^C doesn't stop workers, the main process drains them
+        signal_mock.signal.assert_any_call(signal_mock.SIGINT, signal_mock.SIG_IGN)
+        signal_mock.signal.assert_any_call(signal_mock.SIGTERM, worker.stop)
+
+        # The batch is handled, and coalesced positions are stored on exit
+        assert worker.counters.offset == 3 * worker.counters.width
+        assert worker.counters.get('handled') == 1
+        assert redis.hget('taxi:taxi1', 'user1').split()[:2] == [b'10', b'48.1']
+
+    def test_get_batch_coalesce_timeout(self):
+        worker = Worker(None, coalesce_timeout=0.01)
+        worker.coalesce_position({'taxi': 'taxi1', 'operator': 'user1', 'timestamp': '1'}, None)
+
+        # Do not block when coalesced positions are waiting
+        assert worker.get_batch(queue.Queue()) == []
+
+    def test_throttle(self):
+        worker = Worker(
+            None, throttle_cache_size=2, min_interval=5, operators_min_interval={'user2': 0}
+        )
+
+        def position(taxi, timestamp, operator='user1'):
+            return {'taxi': taxi, 'operator': operator, 'timestamp': timestamp}
+
+        assert not worker.throttle(position('taxi1', '100'))
+        # Too close to the previous position
+        assert worker.throttle(position('taxi1', '103'))
+        assert not worker.throttle(position('taxi1', '105'))
+        # Older than the last position stored
+        assert worker.throttle(position('taxi1', '104'))
+
+        # No minimum interval for user2, but out of order positions are
+        # still rejected.
+        assert not worker.throttle(position('taxi1', '100', 'user2'))
+        assert not worker.throttle(position('taxi1', '101', 'user2'))
+        assert worker.throttle(position('taxi1', '99', 'user2'))
+
+        assert worker.counters.get('throttle_hits') == 5
+        assert worker.counters.get('throttled') == 1
+        assert worker.counters.get('reordered') == 2
+
+        # The least recently used taxi is evicted
+        assert not worker.throttle(position('taxi2', '100'))
+        assert ('taxi1', 'user1') not in worker.throttle_cache
+        assert not worker.throttle(position('taxi1', '104'))
+
+    def test_shed(self):
+        worker = Worker(fakeredis.FakeStrictRedis(), shed_high_water=0.8, shed_max_age=30)
+        load = [0]
+        worker.load = lambda: load[0]
+
+        from_addr = ('127.0.0.1', 1234)
+        worker.handle_batch([(make_message('taxi1', status='free'), from_addr)])
+        assert not worker.shedding
+
+        load[0] = 0.9
+        worker.handle_batch([
+            (make_message('taxi1', status='free'), from_addr),
+            (make_message('taxi1', status='occupied'), from_addr),
+            (make_message('taxi2', status='free'), from_addr),
+            (make_message('taxi2', status='free'), from_addr),
+        ])
+        assert worker.shedding
+        assert worker.counters.get('shed_same_status') == 2
+        assert worker.counters.get('shed_kept_status_change') == 1
+        assert worker.counters.get('shed_kept_not_seen') == 1
+        assert worker.shed_cache.get(('taxi1', 'user1'))[0] == 'occupied'
+
+        # Positions accepted too long ago are kept
+        worker.shed_cache[('taxi2', 'user1')] = ('free', time.monotonic() - 31)
+        worker.handle_batch([(make_message('taxi2', status='free'), from_addr)])
+        assert worker.counters.get('shed_kept_not_seen') == 2
+
+        # Shedding stops below half of the high water mark
+        load[0] = 0.5
+        worker.handle_batch([(make_message('taxi1', status='occupied'), from_addr)])
+        assert worker.shedding
+        load[0] = 0.3
+        worker.handle_batch([(make_message('taxi1', status='occupied'), from_addr)])
+        assert not worker.shedding
+        assert worker.counters.get('shed_same_status') == 3
+
+    def test_update_redis_min_distance(self):
+        redis = fakeredis.FakeRedis()
+        worker = Worker(redis, min_distance=50, suppress_hset=True)
+        fromaddr = ('127.0.3.4', 9132)
+
+        def update(lat, lon, status='free'):
+            pipe = redis.pipeline()
+            worker.update_redis(pipe, {
+                'timestamp': '1',
+                'operator': 'user1',
+                'taxi': 'taxi',
+                'lat': lat,
+                'lon': lon,
+                'device': 'mobile',
+                'status': status,
+                'version': '1',
+            }, fromaddr)
+            return [command[0][0] for command in pipe.command_stack]
+
+        assert update(48.85, 2.35) == ['HSET', 'GEOADD', 'GEOADD', 'ZADD', 'ZADD']
+        # About 11 meters north: only update timestamps
+        assert update(48.8501, 2.35) == ['ZADD', 'ZADD']
+        # Status changed
+        assert update(48.8501, 2.35, 'occupied') == ['HSET', 'GEOADD', 'GEOADD', 'ZADD', 'ZADD']
+        # About 110 meters east
+        assert update(48.8501, 2.3515, 'occupied') == ['HSET', 'GEOADD', 'GEOADD', 'ZADD', 'ZADD']
+
+        assert worker.counters.get('geoadd_suppressed') == 1
+        assert worker.counters.get('hset_suppressed') == 1
+
+    @pytest.mark.parametrize('redis_script', ['position', 'batch'])
+    def test_redis_script(self, redis_script):
+        redis = fakeredis.FakeRedis()
+        worker = Worker(redis, batch_size=10, redis_script=redis_script)
+        fromaddr = ('127.0.3.4', 9132)
+
+        # The script isn't loaded yet: it is loaded, and commands are run again
+        with mock.patch.object(redis, 'script_load', wraps=redis.script_load) as script_load:
+            worker.handle_batch([
+                (make_message('taxi1', operator='user1'), fromaddr),
+                (make_message('taxi1', operator='user2'), fromaddr),
+                (make_message('taxi2', operator='user1'), fromaddr),
+            ])
+            assert script_load.call_count == 1
+
+            worker.handle_batch([(make_message('taxi3', operator='user1'), fromaddr)])
+            assert script_load.call_count == 1
+
+        assert redis.hgetall('taxi:taxi1') == {
+            b'user1': b'1 48.85 2.35 free mobile 1',
+            b'user2': b'1 48.85 2.35 free mobile 1',
+        }
+        assert sorted(redis.zrange('geoindex', 0, -1)) == [b'taxi1', b'taxi2', b'taxi3']
+        assert sorted(redis.zrange('geoindex_2', 0, -1)) == [
+            b'taxi1:user1', b'taxi1:user2', b'taxi2:user1', b'taxi3:user1'
+        ]
+        assert sorted(redis.zrange('timestamps', 0, -1)) == [
+            b'taxi1:user1', b'taxi1:user2', b'taxi2:user1', b'taxi3:user1'
+        ]
+        assert sorted(redis.zrange('timestamps_id', 0, -1)) == [b'taxi1', b'taxi2', b'taxi3']
+
+    def test_resp_writer(self):
+        """Positions are stored the same way with and without the RESP writer."""
+        fromaddr = ('127.0.3.4', 9132)
+        batch = [
+            (make_message(taxi, operator=operator), fromaddr)
+            for taxi, operator in (('taxi1', 'user1'), ('taxi1', 'user2'), ('taxi2', 'user1'))
+        ]
+
+        def dump(redis):
+            return (
+                redis.hgetall('taxi:taxi1'),
+                redis.geopos('geoindex', 'taxi1', 'taxi2'),
+                redis.geopos('geoindex_2', 'taxi1:user1', 'taxi1:user2', 'taxi2:user1'),
+                sorted(redis.zrange('timestamps', 0, -1)),
+                sorted(redis.zrange('timestamps_id', 0, -1)),
+            )
+
+        expected = fakeredis.FakeRedis()
+        Worker(expected, batch_size=10).handle_batch(batch)
+
+        redis = fakeredis.FakeRedis()
+        worker = Worker(redis, batch_size=10, resp_writer=True)
+        with mock.patch.object(redis, 'pipeline', wraps=redis.pipeline) as pipeline:
+            worker.handle_batch(batch)
+            # The pipeline is created, but never executed
+            assert pipeline.return_value.execute.call_count == 0
+
+        assert dump(redis) == dump(expected)
+
+    def test_redis_script_min_distance(self):
+        redis = fakeredis.FakeRedis()
+        worker = Worker(redis, redis_script='batch', min_distance=50, suppress_hset=True)
+        worker.load_script()
+
+        def update(lat):
+            pipe = redis.pipeline()
+            worker.run_update_script(pipe, [{
+                'timestamp': '1',
+                'operator': 'user1',
+                'taxi': 'taxi',
+                'lat': lat,
+                'lon': '2.35',
+                'device': 'mobile',
+                'status': 'free',
+                'version': '1',
+            }])
+            worker.execute_pipeline(pipe)
+
+        update('48.85')
+        redis.delete('geoindex', 'taxi:taxi')
+        # The taxi didn't move: only timestamps are updated
+        update('48.8501')
+        assert not redis.exists('geoindex', 'taxi:taxi')
+        assert redis.zrange('timestamps', 0, -1) == [b'taxi:user1']
+
+
+def test_recv_datagrams():
+    server = bind_socket('127.0.0.1', 0)
+    server.setblocking(False)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        assert recv_datagrams(server, 10) == []
+
+        for idx in range(5):
+            client.sendto(b'message %d' % idx, server.getsockname())
+        time.sleep(0.01)
+
+        assert [message for message, _ in recv_datagrams(server, 3)] == [
+            b'message 0', b'message 1', b'message 2'
+        ]
+        assert [message for message, _ in recv_datagrams(server, 10)] == [
+            b'message 3', b'message 4'
+        ]
+    finally:
+        client.close()
+        server.close()
+
+
+class TestGeotaxiProtocol:
+
+    @pytest.mark.parametrize('redis_script', [None, 'position', 'batch'])
+    def test_flush(self, redis_script):
+        redis = fakeredis.FakeAsyncRedis()
+        fluent = MockFluent()
+        worker = Worker(redis, fluent=fluent, batch_size=2, redis_script=redis_script)
+        fromaddr = ('127.0.3.4', 9132)
+
+        async def run():
+            protocol = GeotaxiProtocol(worker, max_pipelines=1)
+            protocol.datagram_received(make_message('taxi1'), fromaddr)
+            protocol.datagram_received(b'{badjson', fromaddr)
+            protocol.datagram_received(make_message('taxi2'), fromaddr)
+            protocol.datagram_received(make_message('taxi3'), fromaddr)
+
+            # Wait for the flush, and for the pipelines to be executed
+            while protocol.pending or protocol.inflight:
+                await asyncio.sleep(0.01)
+
+            return await redis.zrange('timestamps_id', 0, -1)
+
+        assert sorted(asyncio.run(run())) == [b'taxi1', b'taxi2', b'taxi3']
+        assert [data['taxi'] for _, data in fluent._records] == ['taxi1', 'taxi2', 'taxi3']
+
+    def test_drain(self):
+        redis = fakeredis.FakeAsyncRedis()
+        worker = Worker(redis, batch_size=2, coalesce_timeout=60)
+        fromaddr = ('127.0.3.4', 9132)
+
+        async def run():
+            protocol = GeotaxiProtocol(worker, max_pipelines=1)
+            for idx in range(5):
+                protocol.datagram_received(make_message('taxi%d' % idx), fromaddr)
+
+            # Messages waiting and coalesced positions are stored without
+            # waiting for the end of the coalescing window
+            await protocol.drain()
+            assert not protocol.pending and not protocol.inflight
+            assert protocol.pending_timer is None
+            return await redis.zrange('timestamps_id', 0, -1)
+
+        assert sorted(asyncio.run(run())) == [b'taxi%d' % idx for idx in range(5)]
@@ -0,0 +1,42 @@
+import time
+
+import fakeredis
+
+from geotaxi.janitor import Janitor
+
+
+class TestJanitor:
+
+    def test_run_once(self):
+        redis = fakeredis.FakeRedis()
+        now = int(time.time())
+
+        # taxi1 is stale for both operators, taxi2 only for user1
+        for taxi, operator, timestamp in (
+            ('taxi1', 'user1', now - 1000),
+            ('taxi1', 'user2', now - 1000),
+            ('taxi2', 'user1', now - 1000),
+            ('taxi2', 'user2', now),
+        ):
+            redis.hset(f'taxi:{taxi}', operator, 'position')
+            redis.geoadd('geoindex_2', (2.35, 48.85, f'{taxi}:{operator}'))
+            redis.zadd('timestamps', {f'{taxi}:{operator}': timestamp})
+        for taxi, timestamp in (('taxi1', now - 1000), ('taxi2', now)):
+            redis.geoadd('geoindex', (2.35, 48.85, taxi))
+            redis.zadd('timestamps_id', {taxi: timestamp})
+
+        # Small chunks, to remove members in several iterations
+        janitor = Janitor(redis, ttl=600, chunk_size=2, pause=0)
+        assert janitor.run_once() == (3, 1)
+
+        assert redis.zrange('timestamps', 0, -1) == [b'taxi2:user2']
+        assert redis.zrange('geoindex_2', 0, -1) == [b'taxi2:user2']
+        assert redis.zrange('timestamps_id', 0, -1) == [b'taxi2']
+        assert redis.zrange('geoindex', 0, -1) == [b'taxi2']
+        assert not redis.exists('taxi:taxi1')
+        assert redis.hgetall('taxi:taxi2') == {b'user2': b'position'}
+
+        assert janitor.counters.get('janitor_evicted') == 3
+        assert janitor.counters.get('janitor_evicted_ids') == 1
+
+        assert janitor.run_once() == (0, 0)
@@ -0,0 +1,69 @@
+import fastjsonschema
+import pytest
+
+from geotaxi import jsonschema
+from geotaxi.jsonschema_definition import API_SCHEMA, generate_validator
+
+
+VALID = {
+    'timestamp': 1,
+    'operator': 'user1',
+    'taxi': 'taxi',
+    'lat': '17',
+    'lon': 18.5,
+    'device': 'mobile',
+    'status': 'free',
+    'version': '1',
+    'hash': 'b4dhash',
+}
+
+
+@pytest.mark.parametrize('data', [
+    VALID,
+    dict(VALID, extra=None),
+    None,
+    [],
+    'string',
+    {},
+    {key: value for key, value in VALID.items() if key != 'hash'},
+    {key: value for key, value in VALID.items() if key != 'operator'},
+    dict(VALID, operator=1),
+    dict(VALID, lat=True),
+    dict(VALID, lon=None),
+    dict(VALID, timestamp=[]),
+    dict(VALID, version={}),
+    dict(VALID, hash=False),
+    dict(VALID, status=1.5, taxi=2),
+])
+def test_same_as_fastjsonschema(data):
+    """The generated validator accepts and rejects the same messages as
+    fastjsonschema, with the same errors."""
+    expected = fastjsonschema.compile(API_SCHEMA)
+    try:
+        expected(data)
+    except fastjsonschema.JsonSchemaValueException as exc:
+        with pytest.raises(jsonschema.JsonSchemaValueException) as excinfo:
+            jsonschema.validate(data)
+        assert (excinfo.value.name, excinfo.value.rule) == (exc.name, exc.rule)
+        if exc.rule == 'required':
+            # Like the code generated by fastjsonschema 2.15, all the required
+            # properties are listed, and not only the missing ones.
+            assert excinfo.value.message == 'data must contain %s properties' % API_SCHEMA['required']
+        else:
+            assert excinfo.value.message == exc.message
+        assert excinfo.value.value is exc.value
+        assert excinfo.value.definition == exc.definition
+    else:
+        assert jsonschema.validate(data) is data
+
+
+def test_generated_file_up_to_date():
+    with open(jsonschema.__file__) as f:
+        assert f.read().endswith(generate_validator(API_SCHEMA))
+
+
+def test_unsupported_schema():
+    with pytest.raises(ValueError):
+        generate_validator({'type': 'object', 'properties': {'lat': {'type': 'number', 'minimum': -90}}})
+    with pytest.raises(ValueError):
+        generate_validator({'type': 'array'})
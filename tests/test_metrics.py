@@ -0,0 +1,66 @@
+import urllib.request
+
+import fakeredis
+import requests
+
+from geotaxi.metrics import MetricsServer
+from geotaxi.stats import Counters
+from geotaxi.worker import Worker
+from tests.utils import make_message
+
+
+def test_histogram():
+    counters = Counters(names=(), histograms=('redis',), buckets=(0.001, 0.01))
+    counters.observe('redis', 0.0005)
+    counters.bind()
+    counters.observe('redis', 0.005)
+    counters.observe('redis', 2)
+
+    buckets, count, total = counters.get_histogram('redis')
+    assert buckets == [1, 2]
+    assert count == 3
+    assert round(total, 6) == 2.0055
+
+
+def test_metrics():
+    worker = Worker(fakeredis.FakeRedis(), batch_size=10, stage_timing_sample=1)
+    fromaddr = ('127.0.3.4', 9132)
+    worker.start()
+
+    worker.handle_batch([
+        (make_message(lat='48.85'), fromaddr),
+        (make_message(lat='148.85'), fromaddr),
+        (b'{badjson', fromaddr),
+    ])
+
+    metrics = MetricsServer(worker, host='127.0.0.1', port=0)
+    metrics.gauges['queue_size'] = lambda: 12
+    server = metrics.start()
+    try:
+        url = 'http://127.0.0.1:%s/metrics' % server.server_address[1]
+        with urllib.request.urlopen(url) as resp:
+            lines = resp.read().decode('utf8').splitlines()
+        assert requests.get(url.replace('/metrics', '/other')).status_code == 404
+    finally:
+        server.shutdown()
+
+    assert 'geotaxi_handled_total 3' in lines
+    assert 'geotaxi_parsed_total 2' in lines
+    assert 'geotaxi_decode_rejected_total 1' in lines
+    assert 'geotaxi_schema_rejected_total 0' in lines
+    assert 'geotaxi_coordinates_rejected_total 1' in lines
+    assert 'geotaxi_redis_errors_total 0' in lines
+    assert 'geotaxi_queue_size 12' in lines
+    assert 'geotaxi_parse_duration_seconds_count 3' in lines
+    assert 'geotaxi_redis_duration_seconds_count 1' in lines
+    assert any(line.startswith('geotaxi_worker_handled_total{worker="') and line.endswith('"} 3') for line in lines)
+
+
+def test_stage_timing_sample():
+    worker = Worker(fakeredis.FakeRedis(), stage_timing_sample=2)
+    worker.handle_batch([(b'{badjson', ('127.0.3.4', 9132))] * 5)
+
+    # Only one message every 2 is timed, all of them are counted
+    assert worker.counters.get_histogram('parse')[1] == 2
+    assert worker.counters.get('handled') == 5
+    assert worker.counters.get('decode_rejected') == 5
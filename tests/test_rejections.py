@@ -0,0 +1,61 @@
+import logging
+
+from geotaxi.rejections import OTHER, Rejections
+from geotaxi.worker import Worker
+
+
+def test_summary(caplog):
+    rejections = Rejections(interval=10, max_keys=3, summary_size=2)
+    with caplog.at_level(logging.WARNING, logger='geotaxi'):
+        for _ in range(3):
+            rejections.add('json', None, ('127.0.0.1', 1234), 'Bad JSON from %s:%s: %s', '127.0.0.1', 1234, b'{')
+        rejections.add('coordinates', 'operator', ('127.0.0.2', 1234), 'Invalid coordinates %s', 200)
+        rejections.add('coordinates', 'operator', ('127.0.0.3', 1234), 'Invalid coordinates %s', 300)
+        # Beyond max_keys, the operator and the address are not kept
+        rejections.add('coordinates', 'operator', ('127.0.0.4', 1234), 'Invalid coordinates %s', 400)
+
+        # Nothing is logged before the end of the interval
+        assert caplog.messages == []
+        assert 0 < rejections.timeout() <= 10
+        rejections.flush()
+        assert caplog.messages == []
+
+        rejections.flush(force=True)
+
+    assert caplog.messages == [
+        '6 messages rejected in the last 10 seconds',
+        '3 rejected (json), operator - from 127.0.0.1',
+        '1 rejected (coordinates), operator operator from 127.0.0.2',
+        'and 2 other operators and addresses',
+        "Example of rejection (json): Bad JSON from 127.0.0.1:1234: b'{'",
+        'Example of rejection (coordinates): Invalid coordinates 200',
+    ]
+    assert rejections.timeout() is None
+    assert not rejections.counts and not rejections.samples
+
+    rejections.add('coordinates', 'operator', ('127.0.0.5', 1234), 'Invalid coordinates %s', 500)
+    assert ('coordinates', OTHER, OTHER) not in rejections.counts
+
+
+def test_no_interval(caplog):
+    rejections = Rejections(interval=0)
+    with caplog.at_level(logging.WARNING, logger='geotaxi'):
+        rejections.add('json', None, ('127.0.0.1', 1234), 'Bad JSON: %s', b'{')
+    assert caplog.messages == ["Bad JSON: b'{'"]
+    assert rejections.timeout() is None
+
+
+def test_worker(caplog):
+    worker = Worker(None, rejections_log_interval=10)
+    with caplog.at_level(logging.DEBUG, logger='geotaxi'):
+        worker.handle_message(None, b'{badjson', ('127.0.0.1', 1234))
+        worker.handle_message(None, b'\xff', ('127.0.0.1', 1234))
+        worker.handle_message(None, b'{"operator": "op"}', ('127.0.0.1', 1234))
+    # Each rejection is logged with its payload at debug level
+    assert [record.levelno for record in caplog.records] == [logging.DEBUG] * 3
+    assert dict(worker.rejections.counts) == {
+        ('json', None, '127.0.0.1'): 1,
+        ('utf8', None, '127.0.0.1'): 1,
+        ('schema', 'op', '127.0.0.1'): 1,
+    }
+    assert worker.pending_timeout() is not None
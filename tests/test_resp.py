@@ -0,0 +1,56 @@
+import fakeredis
+import pytest
+from redis.connection import Connection
+from redis.exceptions import ResponseError
+
+from geotaxi.resp import RespWriter
+
+
+POSITION = {
+    'timestamp': 1700000000,
+    'operator': 'user1',
+    'taxi': 'taxi1',
+    'lat': 48.85,
+    'lon': '2.35',
+    'device': 'mobile',
+    'status': 'free',
+    'version': '2',
+}
+
+
+@pytest.mark.parametrize('write_hset,write_geoindex', [(True, True), (False, True), (False, False)])
+def test_add_position(write_hset, write_geoindex):
+    writer = RespWriter(fakeredis.FakeRedis())
+    writer.add_position(POSITION, 1700000001, write_hset, write_geoindex)
+
+    # Same bytes as the commands packed by redis-py
+    commands = []
+    if write_hset:
+        commands.append(('HSET', 'taxi:taxi1', 'user1', '1700000000 48.85 2.35 free mobile 2'))
+    if write_geoindex:
+        commands.append(('GEOADD', 'geoindex', '2.35', 48.85, 'taxi1'))
+        commands.append(('GEOADD', 'geoindex_2', '2.35', 48.85, 'taxi1:user1'))
+    commands.append(('ZADD', 'timestamps', 1700000001, 'taxi1:user1'))
+    commands.append(('ZADD', 'timestamps_id', 1700000001, 'taxi1'))
+
+    connection = Connection()
+    assert bytes(writer.buffer) == b''.join(
+        b''.join(connection.pack_command(*command)) for command in commands
+    )
+    assert len(writer) == len(commands)
+
+
+def test_execute():
+    redis = fakeredis.FakeRedis()
+    redis.set('timestamps', 'not a sorted set')
+    writer = RespWriter(redis)
+
+    writer.add_position(POSITION, 1700000001)
+    results = writer.execute()
+
+    assert results[:3] == [1, 1, 1]
+    assert isinstance(results[3], ResponseError)
+    assert results[4] == 1
+    assert redis.zrange('timestamps_id', 0, -1, withscores=True) == [(b'taxi1', 1700000001)]
+    # The buffer is reused for the next batch
+    assert len(writer) == 0 and not writer.buffer
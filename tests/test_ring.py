@@ -0,0 +1,143 @@
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+import pytest
+
+from geotaxi.ring import RingBuffer
+from geotaxi.wire import MAX_DATAGRAM_SIZE
+
+
+@pytest.fixture
+def ring():
+    ring = RingBuffer(size=4, slot_size=16, burst=3)
+    yield ring
+    ring.close()
+
+
+class TestRingBuffer:
+
+    def test_put_get(self, ring):
+        with pytest.raises(queue.Empty):
+            ring.get_nowait()
+
+        ring.put([(b'message 1', ('127.0.0.1', 1234)), (b'message 2', ('10.0.0.1', 4321))])
+        assert ring.qsize() == 2
+        assert ring.get(timeout=1) == [
+            (b'message 1', ('127.0.0.1', 1234)),
+            (b'message 2', ('10.0.0.1', 4321)),
+        ]
+        assert ring.qsize() == 0
+
+        with pytest.raises(queue.Empty):
+            ring.get(timeout=0.01)
+
+    def test_burst(self, ring):
+        ring.put([(b'message %d' % idx, ('127.0.0.1', 1234)) for idx in range(4)])
+        # Claim at most burst slots at once, the remaining slot is available
+        # for the next get.
+        assert len(ring.get_nowait()) == 3
+        assert len(ring.get_nowait()) == 1
+
+    def test_full(self, ring):
+        fromaddr = ('127.0.0.1', 1234)
+        ring.put([(b'message', fromaddr)] * 3)
+
+        # Not enough free slots: nothing is stored
+        with pytest.raises(queue.Full):
+            ring.put([(b'message', fromaddr)] * 2)
+        assert ring.stats() == {'occupancy': 3, 'overruns': 2, 'oversized': 0}
+
+        # Slots are reused once read
+        ring.get_nowait()
+        ring.put([(b'message', fromaddr)] * 2)
+        assert ring.qsize() == 2
+
+        # Datagrams too long for a slot are dropped
+        ring.put([(b'x' * 17, fromaddr)])
+        assert ring.stats() == {'occupancy': 2, 'overruns': 2, 'oversized': 1}
+
+
+def test_default_slot_size():
+    # Slots hold the longest datagram read from the socket
+    ring = RingBuffer(size=2)
+    try:
+        datagram = b'x' * MAX_DATAGRAM_SIZE
+        ring.put([(datagram, ('127.0.0.1', 1234))])
+        assert ring.get_nowait() == [(datagram, ('127.0.0.1', 1234))]
+        assert ring.stats()['oversized'] == 0
+    finally:
+        ring.close()
+
+
+def consume(ring, count, results):
+    received = 0
+    while received < count:
+        items = ring.get(timeout=5)
+        received += len(items)
+        results.put([data for data, _ in items])
+
+
+def test_ring_buffer_processes():
+    ring = RingBuffer(size=8, slot_size=32, burst=4)
+    results = multiprocessing.Queue()
+    try:
+        consumer = multiprocessing.Process(target=consume, args=(ring, 100, results))
+        consumer.start()
+
+        sent = 0
+        while sent < 100:
+            try:
+                ring.put([(b'message %d' % sent, ('127.0.0.1', 1234))])
+            except queue.Full:
+                continue
+            sent += 1
+
+        received = []
+        while len(received) < 100:
+            received.extend(results.get(timeout=5))
+        consumer.join(5)
+
+        assert received == [b'message %d' % idx for idx in range(100)]
+    finally:
+        ring.close()
+
+
+def die_while_claiming(ring, claimed):
+    # Stop after the slots are claimed, before they are freed
+    free_claimed = ring.free_claimed
+    calls = []
+
+    def stop_before_free():
+        if calls:
+            claimed.set()
+            time.sleep(60)
+        calls.append(None)
+        free_claimed()
+
+    ring.free_claimed = stop_before_free
+    ring.get(timeout=5)
+
+
+def test_consumer_killed():
+    ring = RingBuffer(size=4, slot_size=32, burst=4)
+    fromaddr = ('127.0.0.1', 1234)
+    try:
+        ring.put([(b'lost 1', fromaddr), (b'lost 2', fromaddr)])
+        claimed = multiprocessing.Event()
+        consumer = multiprocessing.Process(target=die_while_claiming, args=(ring, claimed))
+        consumer.start()
+        assert claimed.wait(5)
+        # Killed with the lock, and with claimed slots not freed
+        os.kill(consumer.pid, signal.SIGKILL)
+        consumer.join(5)
+
+        # The lock is released, and the slots are freed by the next consumer
+        for lap in range(5):
+            ring.put([(b'message %d' % lap, fromaddr)] * 2)
+            assert ring.get(timeout=1) == [(b'message %d' % lap, fromaddr)] * 2
+        assert ring.stats()['overruns'] == 0
+    finally:
+        ring.close()
@@ -0,0 +1,127 @@
+import time
+
+import fakeredis
+from geotaxi.janitor import Janitor
+from geotaxi.shards import HashRing, ShardedRedis, geohash
+from geotaxi.worker import Worker
+from tests.utils import make_message
+
+
+def sharded_redis(count=3, cell_precision=4):
+    """ShardedRedis over count independent fake servers."""
+    return ShardedRedis(
+        [fakeredis.FakeRedis(server=fakeredis.FakeServer()) for _ in range(count)],
+        ['redis%s:6379' % idx for idx in range(count)],
+        cell_precision=cell_precision
+    )
+
+
+def test_geohash():
+    assert geohash(48.85, 2.35, 5) == 'u09tv'
+    assert geohash(-33.86, 151.2, 4) == 'r3gx'
+
+
+def test_hash_ring():
+    keys = ['taxi%s' % idx for idx in range(3000)]
+    ring = HashRing(['a', 'b', 'c'])
+    owners = [ring.get(key) for key in keys]
+    assert all(owners.count(node) > 700 for node in range(3))
+
+    # Adding a node only moves the keys assigned to the new node
+    bigger = HashRing(['a', 'b', 'c', 'd'])
+    moved = [key for key, owner in zip(keys, owners) if bigger.get(key) != owner]
+    assert all(bigger.get(key) == 3 for key in moved)
+    assert len(moved) < len(keys) / 3
+
+
+def test_worker():
+    sharded = sharded_redis()
+    worker = Worker(sharded, batch_size=10)
+    fromaddr = ('127.0.3.4', 9132)
+
+    taxis = ['taxi%s' % idx for idx in range(20)]
+    worker.handle_batch([(make_message(taxi, lat='48.85', lon='2.35'), fromaddr) for taxi in taxis])
+
+    for taxi in taxis:
+        shard = sharded.shards[sharded.shard_for_taxi(taxi)]
+        assert shard.hgetall('taxi:%s' % taxi) == {b'user1': b'1 48.85 2.35 free mobile 1'}
+        assert shard.zscore('timestamps_id', taxi) is not None
+        assert shard.zscore('timestamps', '%s:user1' % taxi) is not None
+    assert sum(shard.zcard('timestamps_id') for shard in sharded.shards) == len(taxis)
+
+    # All the taxis are in the same cell, listed in the directory
+    cell_shard = sharded.shards[sharded.shard_for_cell('u09t')]
+    assert cell_shard.zcard('geoindex:u09t') == len(taxis)
+    assert cell_shard.zcard('geoindex_2:u09t') == len(taxis)
+    assert sharded.cells() == {'u09t': sharded.shard_for_cell('u09t')}
+
+    # The taxi moves to another cell: it is removed from the previous one
+    worker.handle_batch([(make_message('taxi0', lat='43.3', lon='5.37'), fromaddr)])
+    assert cell_shard.geopos('geoindex:u09t', 'taxi0') == [None]
+    assert cell_shard.geopos('geoindex_2:u09t', 'taxi0:user1') == [None]
+    assert sorted(sharded.cells()) == ['spey', 'u09t']
+    assert sharded.shards[sharded.shard_for_cell('spey')].geopos('geoindex:spey', 'taxi0') != [None]
+
+
+def test_worker_other_process():
+    sharded = sharded_redis()
+    fromaddr = ('127.0.3.4', 9132)
+    Worker(sharded).handle_batch([(make_message('taxi0', lat='48.85', lon='2.35'), fromaddr)])
+
+    # Another process, sharing the same servers, stores the next position:
+    # the taxi is removed from the previous cell too
+    other = ShardedRedis(sharded.shards, sharded.names)
+    Worker(other).handle_batch([(make_message('taxi0', lat='43.3', lon='5.37'), fromaddr)])
+    cell_shard = sharded.shards[sharded.shard_for_cell('u09t')]
+    assert cell_shard.zcard('geoindex:u09t') == 0
+    assert cell_shard.zcard('geoindex_2:u09t') == 0
+    taxi_shard = sharded.shards[sharded.shard_for_taxi('taxi0')]
+    assert taxi_shard.hgetall('geoindex_member_cells') == {
+        b'geoindex:taxi0': b'spey',
+        b'geoindex_2:taxi0:user1': b'spey',
+    }
+
+
+def test_script_flushed():
+    sharded = sharded_redis()
+    worker = Worker(sharded)
+    fromaddr = ('127.0.3.4', 9132)
+    worker.handle_batch([(make_message('taxi0', lat='48.85', lon='2.35'), fromaddr)])
+
+    # The servers lost the script: it is loaded again, and the cell swapped
+    for shard in sharded.shards:
+        shard.script_flush()
+    worker.handle_batch([(make_message('taxi0', lat='43.3', lon='5.37'), fromaddr)])
+    assert sharded.shards[sharded.shard_for_cell('u09t')].zcard('geoindex:u09t') == 0
+    assert sharded.shards[sharded.shard_for_taxi('taxi0')].hget('geoindex_member_cells', 'geoindex:taxi0') == b'spey'
+
+
+def test_janitor():
+    sharded = sharded_redis()
+    worker = Worker(sharded, batch_size=10)
+    fromaddr = ('127.0.3.4', 9132)
+    worker.handle_batch([
+        (make_message('taxi%s' % idx, lat='48.85', lon='2.35'), fromaddr)
+        for idx in range(10)
+    ] + [(make_message('taxi10', lat='43.3', lon='5.37'), fromaddr)])
+
+    # Make half of the taxis stale
+    old = int(time.time()) - 1000
+    for idx in range(0, 11, 2):
+        shard = sharded.shards[sharded.shard_for_taxi('taxi%s' % idx)]
+        shard.zadd('timestamps', {'taxi%s:user1' % idx: old})
+        shard.zadd('timestamps_id', {'taxi%s' % idx: old})
+
+    janitor = Janitor(sharded, 100, chunk_size=2, pause=0)
+    assert janitor.run_once() == (6, 6)
+
+    remaining = sorted(
+        member
+        for cell, shard in sharded.cells().items()
+        for member in sharded.shards[shard].zrange('geoindex:%s' % cell, 0, -1)
+    )
+    assert remaining == [b'taxi1', b'taxi3', b'taxi5', b'taxi7', b'taxi9']
+    assert sum(sharded.shards[shard].zcard('geoindex_2:%s' % cell) for cell, shard in sharded.cells().items()) == 5
+    assert not sharded.shards[sharded.shard_for_taxi('taxi0')].exists('taxi:taxi0')
+    assert not sharded.shards[sharded.shard_for_taxi('taxi0')].hexists('geoindex_member_cells', 'geoindex:taxi0')
+    assert sharded.shards[sharded.shard_for_taxi('taxi1')].hexists('geoindex_member_cells', 'geoindex:taxi1')
@@ -0,0 +1,105 @@
+import multiprocessing
+import os
+import signal
+import time
+
+from geotaxi.stats import Counters
+from geotaxi.supervisor import Supervisor
+
+
+def test_supervisor():
+    load = [0]
+    started = []
+
+    def start_worker(row):
+        proc = multiprocessing.Process(target=time.sleep, args=(30,))
+        proc.start()
+        started.append(row)
+        return proc
+
+    counters = Counters()
+    supervisor = Supervisor(
+        start_worker, 2, min_workers=1, max_workers=3, counters=counters, load=lambda: load[0], interval=60
+    )
+    supervisor.start()
+    try:
+        assert started == [1, 2]
+        assert supervisor.alive() == 2
+        assert supervisor.timeout() > 0
+
+        # Dead workers are restarted on the same row. The queue is neither
+        # empty nor full, so the number of workers doesn't change.
+        load[0] = 0.2
+        dead = supervisor.procs[1]
+        os.kill(dead.pid, signal.SIGKILL)
+        dead.join()
+        supervisor.check(force=True)
+        assert started == [1, 2, 1]
+        assert supervisor.procs[1] is not dead
+        assert counters.get('workers_restarted') == 1
+
+        # The queue fills up: start a worker
+        load[0] = 0.6
+        supervisor.check(force=True)
+        assert sorted(supervisor.procs) == [1, 2, 3]
+        supervisor.check(force=True)
+        assert len(supervisor.procs) == 3
+
+        # Busy workers
+        load[0] = 0
+        counters.incr('worker_busy_us', 10 ** 9)
+        supervisor.check(force=True)
+        assert len(supervisor.procs) == 3
+
+        # Idle workers: the last one is retired with SIGTERM
+        supervisor.check(force=True)
+        assert sorted(supervisor.procs) == [1, 2]
+        retired = supervisor.retiring[3]
+        retired.join(5)
+        assert retired.exitcode == -signal.SIGTERM
+        # Retired workers are forgotten once stopped, down to min_workers
+        supervisor.check(force=True)
+        assert sorted(supervisor.procs) == [1] and sorted(supervisor.retiring) == [2]
+        supervisor.retiring[2].join(5)
+        supervisor.check(force=True)
+        assert sorted(supervisor.procs) == [1] and not supervisor.retiring
+    finally:
+        supervisor.kill()
+
+
+def ignore_sigterm():
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    time.sleep(30)
+
+
+def test_stop():
+    counters = Counters()
+    targets = iter([time.sleep, ignore_sigterm])
+    supervisor = Supervisor(
+        lambda row: start_process(next(targets)), 2, counters=counters
+    )
+    supervisor.start()
+    # Let the second worker ignore SIGTERM
+    time.sleep(0.2)
+
+    checks = []
+
+    def drained():
+        checks.append(True)
+        return len(checks) > 3
+
+    start = time.monotonic()
+    supervisor.stop(0.5, drained=drained)
+    assert len(checks) == 4
+    # The first worker stops on SIGTERM, the second one is killed at the
+    # deadline
+    assert supervisor.procs[1].exitcode == -signal.SIGTERM
+    supervisor.procs[2].join(5)
+    assert supervisor.procs[2].exitcode == -signal.SIGKILL
+    assert 0.5 <= time.monotonic() - start < 5
+
+
+def start_process(target):
+    proc = multiprocessing.Process(target=target, args=(30,) if target is time.sleep else ())
+    proc.start()
+    return proc
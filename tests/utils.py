@@ -0,0 +1,17 @@
+import orjson as json
+
+
+def make_message(taxi='taxi1', **fields):
+    """Return a JSON message of taxi, with a bad hash. fields replace the
+    default values."""
+    return json.dumps(dict({
+        'timestamp': '1',
+        'operator': 'user1',
+        'taxi': taxi,
+        'lat': '48.85',
+        'lon': '2.35',
+        'device': 'mobile',
+        'status': 'free',
+        'version': '1',
+        'hash': 'b4dhash',
+    }, **fields))